@@ -8,13 +8,20 @@ import os
 import json
 import re
 import random
+import time
+import asyncio
+import functools
 import logging
+from collections import Counter, deque
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import httpx
 
 import database as db
+import intent_model
+import token_budget
+from token_budget import PROMPT_INPUT_TOKEN_BUDGET, Section
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +29,19 @@ BKK = ZoneInfo("Asia/Bangkok")  # UTC+7
 
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
 MODEL = "claude-sonnet-4-20250514"
-API_URL = "https://api.anthropic.com/v1/messages"
+# เปลี่ยน URL ได้ (เช่นชี้ไป mock server ตอนทดสอบ)
+API_URL = os.getenv("ANTHROPIC_API_URL", "https://api.anthropic.com/v1/messages")
+ANTHROPIC_VERSION = "2023-06-01"
+
+# HTTP client settings (ปรับผ่าน env ได้)
+ANTHROPIC_HTTP2 = os.getenv("ANTHROPIC_HTTP2", "0") == "1"
+ANTHROPIC_CONNECT_TIMEOUT = float(os.getenv("ANTHROPIC_CONNECT_TIMEOUT", "5"))
+ANTHROPIC_READ_TIMEOUT = float(os.getenv("ANTHROPIC_READ_TIMEOUT", "30"))
+ANTHROPIC_MAX_CONNECTIONS = int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", "20"))
+ANTHROPIC_KEEPALIVE_SECONDS = float(os.getenv("ANTHROPIC_KEEPALIVE_SECONDS", "60"))
+ANTHROPIC_MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "2"))
+RETRY_STATUS_CODES = {429, 529}  # rate limited / overloaded
+RETRY_BASE_DELAY = 0.5  # วินาที — backoff = base * 2^attempt แบบ full jitter
 
 # Log API key status on import (masked)
 if ANTHROPIC_API_KEY:
@@ -31,6 +50,238 @@ else:
     logger.error("ANTHROPIC_API_KEY is NOT set! Claude API will fail.")
 
 
+# ==================== Shared HTTP Client ====================
+# ใช้ client เดียวทั้ง process → connection ไป api.anthropic.com ถูก keep-alive ไว้
+# ไม่ต้องจ่าย TCP + TLS handshake ใหม่ทุกข้อความ (เปิด/ปิดผ่าน FastAPI lifespan)
+
+_http_client: httpx.AsyncClient | None = None
+
+_llm_stats = {
+    "requests": 0,
+    "retries": 0,
+    "transport_errors": 0,
+    "status": Counter(),
+    "latencies_ms": deque(maxlen=1000),
+    "ttft_ms": deque(maxlen=1000),  # time-to-first-token ของ /chat/stream
+    "usage": Counter(),             # token รวม (input / output / cache read / cache write)
+    "prompt_trimmed": 0,            # call ที่ prompt เกินงบ token จนถูกตัดบาง section
+}
+
+USAGE_FIELDS = (
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+)
+
+
+def _create_http_client() -> httpx.AsyncClient:
+    http2 = ANTHROPIC_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401 — httpx ต้องมี package h2 สำหรับ HTTP/2
+        except ImportError:
+            logger.warning("ANTHROPIC_HTTP2=1 but package 'h2' is not installed — using HTTP/1.1")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(ANTHROPIC_READ_TIMEOUT, connect=ANTHROPIC_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=ANTHROPIC_MAX_CONNECTIONS,
+            max_keepalive_connections=ANTHROPIC_MAX_CONNECTIONS,
+            keepalive_expiry=ANTHROPIC_KEEPALIVE_SECONDS,
+        ),
+        headers={
+            "x-api-key": ANTHROPIC_API_KEY,
+            "anthropic-version": ANTHROPIC_VERSION,
+            "content-type": "application/json",
+        },
+    )
+
+
+async def start_http_client():
+    """สร้าง shared client — เรียกตอน server start"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _create_http_client()
+
+
+async def close_http_client():
+    """ปิด shared client — เรียกตอน server shutdown"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """ดึง shared client (สร้างให้อัตโนมัติถ้ายังไม่ได้ start เช่นตอนทดสอบ)"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _create_http_client()
+    return _http_client
+
+
+def _retry_delay(response: httpx.Response | None, attempt: int) -> float:
+    """เวลารอก่อน retry — ใช้ retry-after จาก server ถ้ามี ไม่งั้น exponential backoff + jitter"""
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), 30.0)
+            except ValueError:
+                pass
+    return random.uniform(0, RETRY_BASE_DELAY * (2 ** attempt))
+
+
+async def post_messages(payload: dict) -> httpx.Response:
+    """
+    POST ไปที่ Messages API ผ่าน shared client
+    retry อัตโนมัติเมื่อเจอ 429/529 หรือ connection error (jittered backoff)
+    """
+    client = get_http_client()
+    last_error: Exception | None = None
+
+    for attempt in range(ANTHROPIC_MAX_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            response = await client.post(API_URL, json=payload)
+        except httpx.TransportError as e:
+            _llm_stats["transport_errors"] += 1
+            last_error = e
+            if attempt < ANTHROPIC_MAX_RETRIES:
+                _llm_stats["retries"] += 1
+                await asyncio.sleep(_retry_delay(None, attempt))
+                continue
+            raise
+
+        _record_llm_request(response.status_code, (time.perf_counter() - start) * 1000)
+        if response.status_code in RETRY_STATUS_CODES and attempt < ANTHROPIC_MAX_RETRIES:
+            delay = _retry_delay(response, attempt)
+            logger.warning(f"Claude API {response.status_code} — retry {attempt + 1} in {delay:.2f}s")
+            _llm_stats["retries"] += 1
+            await asyncio.sleep(delay)
+            continue
+        return response
+
+    raise last_error or RuntimeError("Claude API retry loop exhausted")
+
+
+async def stream_messages(payload: dict):
+    """
+    เรียก Messages API แบบ stream (SSE) ผ่าน shared client
+    yield (event_type, data) ทีละ event — retry ได้เฉพาะก่อนเริ่มอ่าน body (429/529 / connection error)
+    """
+    client = get_http_client()
+    request_payload = {**payload, "stream": True}
+
+    for attempt in range(ANTHROPIC_MAX_RETRIES + 1):
+        start = time.perf_counter()
+        request = client.build_request("POST", API_URL, json=request_payload)
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.TransportError:
+            _llm_stats["transport_errors"] += 1
+            if attempt < ANTHROPIC_MAX_RETRIES:
+                _llm_stats["retries"] += 1
+                await asyncio.sleep(_retry_delay(None, attempt))
+                continue
+            raise
+
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                _record_llm_request(response.status_code, (time.perf_counter() - start) * 1000)
+                if response.status_code in RETRY_STATUS_CODES and attempt < ANTHROPIC_MAX_RETRIES:
+                    delay = _retry_delay(response, attempt)
+                    logger.warning(f"Claude API {response.status_code} (stream) — retry {attempt + 1} in {delay:.2f}s")
+                    _llm_stats["retries"] += 1
+                    await asyncio.sleep(delay)
+                    continue
+                raise httpx.HTTPStatusError(
+                    f"Claude API error {response.status_code}: {response.text[:500]}",
+                    request=request, response=response,
+                )
+
+            event_type = None
+            first_token = True
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event_type = line[6:].strip()
+                elif line.startswith("data:") and event_type:
+                    data = json.loads(line[5:].strip())
+                    if first_token and event_type == "content_block_delta":
+                        _llm_stats["ttft_ms"].append((time.perf_counter() - start) * 1000)
+                        first_token = False
+                    yield event_type, data
+            _record_llm_request(response.status_code, (time.perf_counter() - start) * 1000)
+            return
+        finally:
+            await response.aclose()
+
+
+def _record_llm_request(status_code: int, latency_ms: float):
+    _llm_stats["requests"] += 1
+    _llm_stats["status"][status_code] += 1
+    _llm_stats["latencies_ms"].append(latency_ms)
+
+
+def record_usage(usage: dict | None) -> dict:
+    """บันทึก token usage จาก response (รวม cache read/write) → คืนค่าที่อ่านได้ของ call นี้"""
+    counted = {}
+    for field in USAGE_FIELDS:
+        value = (usage or {}).get(field) or 0
+        counted[field] = value
+        _llm_stats["usage"][field] += value
+    return counted
+
+
+def _format_usage(usage: dict) -> str:
+    return (
+        f"in={usage['input_tokens']}, out={usage['output_tokens']}, "
+        f"cache_read={usage['cache_read_input_tokens']}, cache_write={usage['cache_creation_input_tokens']}"
+    )
+
+
+def _percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return round(ordered[k], 1)
+
+
+def get_llm_stats() -> dict:
+    """สถิติการเรียก Claude API — latency ต่อ request (1000 ครั้งล่าสุด), retries, status codes"""
+    latencies = list(_llm_stats["latencies_ms"])
+    ttft = list(_llm_stats["ttft_ms"])
+    usage = _llm_stats["usage"]
+    prompt_tokens = (
+        usage["input_tokens"] + usage["cache_creation_input_tokens"] + usage["cache_read_input_tokens"]
+    )
+    return {
+        "requests": _llm_stats["requests"],
+        "retries": _llm_stats["retries"],
+        "transport_errors": _llm_stats["transport_errors"],
+        "status": dict(_llm_stats["status"]),
+        "latency_ms": {
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+        },
+        "stream_ttft_ms": {
+            "p50": _percentile(ttft, 50),
+            "p95": _percentile(ttft, 95),
+            "p99": _percentile(ttft, 99),
+        },
+        "tokens": {field: usage[field] for field in USAGE_FIELDS},
+        "prompt_budget": {"budget": PROMPT_INPUT_TOKEN_BUDGET, "trimmed_calls": _llm_stats["prompt_trimmed"]},
+        # สัดส่วน prompt token ที่อ่านจาก cache (ยิ่งสูงยิ่งถูก/เร็ว)
+        "cache_hit_ratio": round(usage["cache_read_input_tokens"] / prompt_tokens, 3) if prompt_tokens else None,
+    }
+
+
 # ==================== Smart Context Builder ====================
 
 def _build_live_context(user_context: dict) -> str:
@@ -91,9 +342,11 @@ def _build_live_context(user_context: dict) -> str:
     if streak >= 2:
         parts.append(f"Streak: {streak} วันติดต่อกัน ({total_points} points)")
 
-    # 6. เตือนภัย / ข่าวด่วน (ดึงจาก DB ตรง)
+    # 6. เตือนภัย / ข่าวด่วน (ใช้ที่โหลดมากับ context ถ้ามี ไม่งั้นดึงจาก DB ตรง)
     try:
-        critical_alerts = db.get_latest_critical_alerts(hours_back=6)
+        critical_alerts = user_context.get("critical_alerts")
+        if critical_alerts is None:
+            critical_alerts = db.get_latest_critical_alerts(hours_back=6)
         if critical_alerts:
             alert_lines = []
             for a in critical_alerts[:3]:
@@ -106,84 +359,43 @@ def _build_live_context(user_context: dict) -> str:
 
 
 # ==================== System Prompt ====================
+# แบ่ง system prompt เป็น 3 block เรียงจากนิ่งที่สุด → เปลี่ยนบ่อยที่สุด (รองรับ prompt caching)
+#   1. persona + กฎ + format (เหมือนกันทุกคนที่ personality เดียวกัน)  ← cache_control
+#   2. ข้อมูลผู้ใช้ + memory (เปลี่ยนเมื่อ memory อัปเดต)                  ← cache_control
+#   3. เวลา / live context / หุ้น (เปลี่ยนทุกข้อความ — ไม่ cache)
+# ห้ามใส่ของที่เปลี่ยนบ่อย (เวลา, วันที่, ชื่อผู้ใช้) ใน block 1 ไม่งั้น cache จะ miss ทุกครั้ง
+
+PERSONALITY_STYLES = {
+    "friendly": "เป็นเพื่อนสนิท พูดเป็นกันเอง สนุกสนาน ใช้ภาษาไม่เป็นทางการ",
+    "caring": "เป็นพี่สาวที่อบอุ่น ห่วงใย พูดนุ่มนวล คอยดูแล",
+    "cheerful": "เป็นน้องร่าเริง สดใส ให้กำลังใจเก่ง พลังบวก",
+    "professional": "เป็นพี่เลี้ยงที่สุภาพ จัดระเบียบดี พูดชัดเจน",
+}
 
-def build_system_prompt(
-    user_name: str,
-    personality: str,
-    memory: dict,
-    user_context: dict | None = None,
-    stock_context: str | None = None,
-) -> str:
-    """สร้าง System Prompt ที่ฉลาด — รวม memory + live context + emotional tone"""
-
-    personality_styles = {
-        "friendly": "เป็นเพื่อนสนิท พูดเป็นกันเอง สนุกสนาน ใช้ภาษาไม่เป็นทางการ",
-        "caring": "เป็นพี่สาวที่อบอุ่น ห่วงใย พูดนุ่มนวล คอยดูแล",
-        "cheerful": "เป็นน้องร่าเริง สดใส ให้กำลังใจเก่ง พลังบวก",
-        "professional": "เป็นพี่เลี้ยงที่สุภาพ จัดระเบียบดี พูดชัดเจน",
-    }
-
-    style = personality_styles.get(personality, personality_styles["friendly"])
-    memory_text = _summarize_memory(memory)
-    live_context = _build_live_context(user_context) if user_context else ""
-
-    today = datetime.now(BKK)
-    day_names = ["จันทร์", "อังคาร", "พุธ", "พฤหัสบดี", "ศุกร์", "เสาร์", "อาทิตย์"]
-    day_name = day_names[today.weekday()]
-    time_str = today.strftime("%H:%M")
-    date_str = today.strftime("%Y-%m-%d")    # สำหรับตัวอย่าง REMINDER
-    plus30_str = (today + timedelta(minutes=30)).strftime("%H:%M")  # ตัวอย่าง +30 นาที
-    hour = today.hour
-
-    if 5 <= hour < 12:
-        time_context = "ตอนเช้า"
-    elif 12 <= hour < 17:
-        time_context = "ตอนบ่าย"
-    elif 17 <= hour < 21:
-        time_context = "ตอนเย็น"
-    else:
-        time_context = "ตอนกลางคืน"
-
-    # Emotional Intelligence — ปรับ tone ตามอารมณ์
-    tone_hint = ""
-    if user_context:
-        moods = user_context.get("mood_history", [])
-        if moods:
-            latest_score = moods[-1]["score"]
-            if latest_score <= 2:
-                tone_hint = "\n- อารมณ์ผู้ใช้ไม่ค่อยดี -> ตอบด้วยความเห็นอกเห็นใจ รับฟังก่อน อย่าเพิ่งแนะนำ"
-            elif latest_score >= 4:
-                tone_hint = "\n- อารมณ์ผู้ใช้ดี -> ร่วมยินดี ตอบสนุก มีพลัง"
+_CACHE_CONTROL = {"type": "ephemeral"}
 
-    live_section = ""
-    if live_context:
-        live_section = f"\nสถานการณ์ตอนนี้:\n{live_context}\n"
 
-    stock_section = ""
-    if stock_context:
-        stock_section = f"\n{stock_context}\n"
+@functools.lru_cache(maxsize=len(PERSONALITY_STYLES))
+def _static_rules_prompt(personality: str) -> str:
+    """persona + กฎ + รูปแบบคำตอบ — ข้อความคงที่ต่อ personality (cache ได้ข้าม user)"""
+    style = PERSONALITY_STYLES.get(personality, PERSONALITY_STYLES["friendly"])
 
     return f"""คุณชื่อ "ฟ้า" {style}
 คุณเป็นผู้เชี่ยวชาญด้านการลงทุนและตลาดหุ้นด้วย สามารถวิเคราะห์หุ้นแบบมืออาชีพ
 
-ผู้ใช้ชื่อ: {user_name}
-วันนี้: วัน{day_name} เวลา {time_str} ({time_context})
-{live_section}
-ข้อมูลที่รู้เกี่ยวกับ {user_name}:
-{memory_text}
-{stock_section}
 กฎสำคัญ:
 - ตอบสั้น ๆ 1-3 ประโยค เหมือนแชทกับเพื่อน
-- ใช้ชื่อ {user_name} บ้าง
+- ใช้ชื่อผู้ใช้บ้าง
 - ใส่ emoji บ้างแต่ไม่เยอะ
 - ถ้าเขาเล่าปัญหา -> รับฟังก่อน อย่าเพิ่งแนะนำ
 - ถ้าเขาบอกนัดหรือสิ่งที่ต้องทำ -> จดและเตือนให้
 - ถ้ากิจวัตรยังไม่ครบ -> ทักเตือนเบา ๆ ถ้าเหมาะกับบทสนทนา
 - อ้างอิงสิ่งที่รู้เกี่ยวกับผู้ใช้ เพื่อให้รู้สึกว่าจำเขาได้
-- ถ้ามีข่าวด่วน/เตือนภัย -> แจ้งผู้ใช้แบบห่วงใย เช่น "ฟ้าเพิ่งเห็นข่าวว่า..." อย่าตกใจผู้ใช้{tone_hint}
+- ถ้ามีข่าวด่วน/เตือนภัย -> แจ้งผู้ใช้แบบห่วงใย เช่น "ฟ้าเพิ่งเห็นข่าวว่า..." อย่าตกใจผู้ใช้
+- ดูวันที่/เวลาปัจจุบัน และสถานการณ์ของผู้ใช้จากหัวข้อ "ตอนนี้" ด้านล่าง
 
 กฎวิเคราะห์หุ้น:
-- ถ้ามีข้อมูล Technical อยู่ด้านบน -> วิเคราะห์ให้ครบ (ราคา, แนวโน้ม, แนวรับ/ต้าน, RSI, Volume)
+- ถ้ามีข้อมูล Technical อยู่ด้านล่าง -> วิเคราะห์ให้ครบ (ราคา, แนวโน้ม, แนวรับ/ต้าน, RSI, Volume)
 - ตอบเรื่องหุ้นได้ยาวกว่าปกติ (3-6 ประโยค) เพื่อให้ข้อมูลครบ
 - ให้ความเห็นตรง ๆ ว่าน่าสนใจหรือไม่ พร้อมเหตุผล
 - บอกจุดเข้าซื้อ/จุดขาย ถ้าข้อมูลเพียงพอ
@@ -200,12 +412,13 @@ MEMORY_UPDATE: (ข้อมูลใหม่ที่ได้เรียน
 REMINDER: (YYYY-MM-DD HH:MM ข้อความเตือน | หรือ NONE)
 STOCK_ALERT: (symbol|alert_type|target_value | หรือ NONE)
 
-ตัวอย่าง REMINDER ที่ถูกต้อง:
-- ผู้ใช้: "เตือนตอน 3 โมง ไปหาหมอ" → REMINDER: {date_str} 15:00 ไปหาหมอ
-- ผู้ใช้: "พรุ่งนี้ 8 โมง ประชุม" → REMINDER: (พรุ่งนี้ในรูปแบบ YYYY-MM-DD) 08:00 ประชุม
-- ผู้ใช้: "อีก 30 นาทีเตือนกินยา" → REMINDER: {date_str} {plus30_str} กินยา
+ตัวอย่าง REMINDER ที่ถูกต้อง (สมมติวันนี้คือ 2025-03-01 เวลา 14:10):
+- ผู้ใช้: "เตือนตอน 3 โมง ไปหาหมอ" → REMINDER: 2025-03-01 15:00 ไปหาหมอ
+- ผู้ใช้: "พรุ่งนี้ 8 โมง ประชุม" → REMINDER: 2025-03-02 08:00 ประชุม
+- ผู้ใช้: "อีก 30 นาทีเตือนกินยา" → REMINDER: 2025-03-01 14:40 กินยา
 - ผู้ใช้: "เตือนอีก 1 นาที ทดสอบ" → REMINDER: อีก 1 นาที ทดสอบ
 - ไม่มีนัดหมาย → REMINDER: NONE
+ใช้วันที่/เวลาจริงจากหัวข้อ "ตอนนี้" เสมอ (ตัวอย่างข้างบนเป็นแค่รูปแบบ)
 สำคัญ: REMINDER format ได้ 2 แบบ:
 1) YYYY-MM-DD HH:MM ข้อความ (ถ้ารู้เวลาแน่นอน)
 2) อีก X นาที ข้อความ (ถ้าผู้ใช้บอกเป็น relative time)
@@ -220,6 +433,109 @@ alert_type: price_above (ขึ้นเกิน), price_below (ตกต่ำ
 ถ้าไม่ระบุเงื่อนไข → ใช้ change_pct|3 (เตือนเมื่อเปลี่ยน 3%)"""
 
 
+def _user_memory_prompt(user_name: str, memory: dict) -> str:
+    """ข้อมูลผู้ใช้ — นิ่งระหว่างบทสนทนา (เปลี่ยนเมื่อมี MEMORY_UPDATE)"""
+    return f"""ผู้ใช้ชื่อ: {user_name}
+
+ข้อมูลที่รู้เกี่ยวกับ {user_name}:
+{_summarize_memory(memory)}"""
+
+
+def _live_sections(user_context: dict | None, stock_context: str | None) -> dict[str, str]:
+    """ส่วนที่เปลี่ยนทุกข้อความ — เวลา, สถานการณ์, tone, ข้อมูลหุ้น (แยกกันให้ token_budget ตัดทีละส่วน)"""
+    live_context = _build_live_context(user_context) if user_context else ""
+
+    today = datetime.now(BKK)
+    day_names = ["จันทร์", "อังคาร", "พุธ", "พฤหัสบดี", "ศุกร์", "เสาร์", "อาทิตย์"]
+    day_name = day_names[today.weekday()]
+    time_str = today.strftime("%H:%M")
+    date_str = today.strftime("%Y-%m-%d")    # สำหรับ REMINDER
+    hour = today.hour
+
+    if 5 <= hour < 12:
+        time_context = "ตอนเช้า"
+    elif 12 <= hour < 17:
+        time_context = "ตอนบ่าย"
+    elif 17 <= hour < 21:
+        time_context = "ตอนเย็น"
+    else:
+        time_context = "ตอนกลางคืน"
+
+    # Emotional Intelligence — ปรับ tone ตามอารมณ์
+    tone_hint = ""
+    if user_context:
+        moods = user_context.get("mood_history", [])
+        if moods:
+            latest_score = moods[-1]["score"]
+            if latest_score <= 2:
+                tone_hint = "\n- อารมณ์ผู้ใช้ไม่ค่อยดี -> ตอบด้วยความเห็นอกเห็นใจ รับฟังก่อน อย่าเพิ่งแนะนำ"
+            elif latest_score >= 4:
+                tone_hint = "\n- อารมณ์ผู้ใช้ดี -> ร่วมยินดี ตอบสนุก มีพลัง"
+
+    return {
+        "now": f"ตอนนี้: วัน{day_name} {date_str} เวลา {time_str} ({time_context})",
+        "live": f"สถานการณ์ตอนนี้:\n{live_context}" if live_context else "",
+        "tone": f"โทนการตอบ:{tone_hint}" if tone_hint else "",
+        "stock": stock_context or "",
+    }
+
+
+def _summary_block(summary: str) -> str:
+    return f"\n\nสรุปบทสนทนาก่อนหน้า (เรื่องที่คุยกันไปแล้ว):\n{summary}" if summary else ""
+
+
+def build_prompt(
+    message: str,
+    user_name: str,
+    personality: str,
+    memory: dict,
+    recent_messages: list[dict],
+    user_context: dict | None = None,
+    stock_context: str | None = None,
+    conversation_summary: str | None = None,
+    budget: int = PROMPT_INPUT_TOKEN_BUDGET,
+) -> tuple[list[dict], list[dict], dict]:
+    """
+    สร้าง System Prompt ที่ฉลาด — รวม memory + live context + emotional tone
+    แล้วตัดให้อยู่ในงบ token → (system blocks, messages, budget report)
+    system blocks: 2 block แรกติด cache_control (block 2 = memory + สรุปบทสนทนาเก่า)
+
+    ลำดับการตัดเมื่อเกินงบ (ตัดก่อน → หลัง):
+      ประวัติแชทเก่าสุด (เหลืออย่างน้อย 2) → บรรทัดท้าย ๆ ของข้อมูลหุ้น (watchlist, ภาพรวมตลาด)
+      → tone → ข้อท้าย ๆ ของสรุปบทสนทนา → สถานการณ์ → memory (เหลือชื่อผู้ใช้)
+    """
+    live = _live_sections(user_context, stock_context)
+    rules = Section.of_text("rules", _static_rules_prompt(personality))
+    user_memory = Section.of_text("memory", _user_memory_prompt(user_name, memory), priority=1, min_units=1)
+    summary = Section.of_text("summary", (conversation_summary or "").strip(), priority=2)
+    now = Section.of_text("now", live["now"])
+    live_context = Section.of_text("live", live["live"], priority=2)
+    tone = Section.of_text("tone", live["tone"], priority=3)
+    stock = Section.of_text("stock", live["stock"], priority=4)
+    history = Section.of_messages(
+        "history",
+        [{"role": m["role"], "content": m["content"]} for m in recent_messages],
+        priority=5,
+        min_units=2,
+    )
+    current = Section.of_text("message", message)
+
+    report = token_budget.fit(
+        [rules, user_memory, summary, now, live_context, tone, stock, history, current], budget,
+    )
+    # ประวัติถูกตัดจากหัว → ให้เริ่มที่ข้อความของผู้ใช้เสมอ
+    while history.dropped and history.units and history.units[0]["role"] != "user":
+        history.drop_one()
+
+    system = [
+        {"type": "text", "text": rules.text, "cache_control": _CACHE_CONTROL},
+        {"type": "text", "text": user_memory.text + _summary_block(summary.text), "cache_control": _CACHE_CONTROL},
+        {"type": "text", "text": "\n\n".join(s.text for s in (now, live_context, tone, stock) if s.units)},
+    ]
+    messages = history.units + [{"role": "user", "content": message}]
+    return system, messages, report
+
+
 def _summarize_memory(memory: dict) -> str:
     """แปลง memory dict -> ข้อความสั้น ๆ สำหรับ prompt"""
     parts = []
@@ -250,6 +566,8 @@ def _summarize_memory(memory: dict) -> str:
 
 
 # ==================== Local Quick Replies (ฟรี 100%) ====================
+# intent_model (char n-gram NB) เลือก intent → ตอบจาก template / ข้อมูลผู้ใช้ที่โหลดไว้แล้ว
+# หมวดใน QUICK_REPLIES เป็น intent ของ model ด้วย — triggers ใช้เป็นตัวอย่างใน data/intents_train.tsv
 
 QUICK_REPLIES = {
     "greetings": {
@@ -343,51 +661,177 @@ QUICK_REPLIES = {
 }
 
 
+_local_stats = Counter()  # จำนวนข้อความที่ตอบเองต่อ intent ("llm" = ส่งต่อให้ Claude)
+
+
+def detect_local_intent(message: str) -> str | None:
+    """intent ที่ตอบเองได้ (ผ่าน threshold ของ intent_model) — None = ส่งให้ Claude"""
+    intent, _ = intent_model.classify(message)
+    return intent
+
+
+def _reply_reminder_list(user_name: str, user_context: dict) -> str:
+    reminders = user_context.get("pending_reminders", [])
+    if not reminders:
+        return f"ตอนนี้ยังไม่มีนัดที่รออยู่เลย {user_name}~ อยากให้ฟ้าเตือนอะไรบอกได้เลยนะ 📅"
+    now = datetime.now(BKK)
+    day_labels = {
+        now.strftime("%Y-%m-%d"): "วันนี้",
+        (now + timedelta(days=1)).strftime("%Y-%m-%d"): "พรุ่งนี้",
+    }
+    lines = []
+    for r in reminders[:5]:
+        date_part, _, time_part = r.get("remind_at", "").partition(" ")
+        when = f"{day_labels.get(date_part, date_part)} {time_part}".strip()
+        lines.append(f"• {when} — {r['message']}")
+    more = f"\n(และอีก {len(reminders) - 5} รายการ)" if len(reminders) > 5 else ""
+    return f"{user_name} มีนัด {len(reminders)} รายการนะ 📅\n" + "\n".join(lines) + more
+
+
+def _reply_routine_status(user_name: str, user_context: dict) -> str:
+    routines = user_context.get("routine_status", [])
+    if not routines:
+        return f"{user_name} ยังไม่มีกิจวัตรเลย~ อยากเริ่มสร้างนิสัยอะไรบอกฟ้าได้นะ 📋"
+    undone = [r["title"] for r in routines if not r["done"]]
+    done = len(routines) - len(undone)
+    if not undone:
+        return f"วันนี้ {user_name} ทำกิจวัตรครบทั้ง {done} อย่างแล้ว! เก่งมาก 🎉"
+    return (
+        f"วันนี้ทำไปแล้ว {done}/{len(routines)} อย่าง~ "
+        f"ยังเหลือ: {', '.join(undone[:5])} สู้ ๆ นะ {user_name} 💪"
+    )
+
+
+def _reply_streak(user_name: str, user_context: dict) -> str:
+    streak = user_context.get("streak", 0)
+    points = user_context.get("total_points", 0)
+    if streak <= 0:
+        return f"ตอนนี้ยังไม่มี streak เลย {user_name} (แต้มสะสม {points}) วันนี้ทำกิจวัตรให้ครบเพื่อเริ่มนับกันนะ 🔥"
+    return f"{user_name} ทำต่อเนื่องมา {streak} วันแล้ว! 🔥 แต้มสะสม {points} แต้ม"
+
+
+def _reply_stock_price(stock_quotes: dict) -> str:
+    lines = []
+    for symbol, quote in stock_quotes.items():
+        display = symbol.replace(".BK", "")
+        change = quote.get("change_pct")
+        change_text = f" ({change:+.2f}%)" if change is not None else ""
+        lines.append(f"{display} {quote['price']:,.2f} {quote.get('currency') or ''}".rstrip() + change_text)
+    return "ราคาล่าสุด 📈\n" + "\n".join(lines)
+
+
+def local_reply_for(
+    intent: str | None,
+    user_name: str,
+    user_context: dict | None = None,
+    stock_quotes: dict | None = None,
+) -> str | None:
+    """
+    สร้างคำตอบของ intent ที่ตรวจได้ — None ถ้าตอบเองไม่ได้ (ส่งให้ Claude)
+    intent ที่ต้องใช้ข้อมูลผู้ใช้ (นัด/กิจวัตร/streak) ต้องมี user_context
+    stock_price ต้องมีราคาใน cache (stock_quotes) ไม่งั้นให้ Claude ตอบพร้อม stock context
+    """
+    result = None
+    if intent in QUICK_REPLIES:
+        reply = random.choice(QUICK_REPLIES[intent]["replies"])
+        result = reply.replace("{name}", user_name)
+
+        # Context-aware: เบื่อ + มี routine ยังไม่ทำ
+        if intent == "bored" and user_context:
+            undone = [
+                r["title"] for r in user_context.get("routine_status", [])
+                if not r["done"]
+            ]
+            if undone:
+                result = f"เบื่อเหรอ {user_name}~ ยังมี '{undone[0]}' ที่ยังไม่ได้ทำนะ! 📋"
+
+        # Context-aware: อรุณสวัสดิ์ + มีนัดวันนี้
+        if intent == "goodmorning" and user_context:
+            today_str = datetime.now(BKK).strftime("%Y-%m-%d")
+            today_rem = [
+                r["message"] for r in user_context.get("pending_reminders", [])
+                if r.get("remind_at", "").startswith(today_str)
+            ]
+            if today_rem:
+                result += f" วันนี้มีนัด: {today_rem[0]} ด้วยนะ! 📅"
+
+        # Context-aware: ฝันดี + streak
+        if intent == "goodnight" and user_context:
+            streak = user_context.get("streak", 0)
+            if streak >= 3:
+                result += f" (Streak {streak} วันแล้ว! เก่งมาก 🔥)"
+
+    elif intent == "reminder_list" and user_context is not None:
+        result = _reply_reminder_list(user_name, user_context)
+    elif intent == "routine_status" and user_context is not None:
+        result = _reply_routine_status(user_name, user_context)
+    elif intent == "streak_query" and user_context is not None:
+        result = _reply_streak(user_name, user_context)
+    elif intent == "stock_price" and stock_quotes:
+        result = _reply_stock_price(stock_quotes)
+
+    _local_stats[intent if result else "llm"] += 1
+    return result
+
+
 def try_local_reply(
     message: str,
     user_name: str,
     user_context: dict | None = None,
 ) -> str | None:
     """พยายามตอบจาก template ก่อน (ไม่เสียเงิน API) — Context-Aware"""
-    msg_lower = message.strip().lower()
-
-    for category, data in QUICK_REPLIES.items():
-        for trigger in data["triggers"]:
-            if trigger in msg_lower and len(msg_lower) < 40:
-                reply = random.choice(data["replies"])
-                result = reply.replace("{name}", user_name)
-
-                # Context-aware: เบื่อ + มี routine ยังไม่ทำ
-                if category == "bored" and user_context:
-                    undone = [
-                        r["title"] for r in user_context.get("routine_status", [])
-                        if not r["done"]
-                    ]
-                    if undone:
-                        result = f"เบื่อเหรอ {user_name}~ ยังมี '{undone[0]}' ที่ยังไม่ได้ทำนะ! 📋"
-
-                # Context-aware: อรุณสวัสดิ์ + มีนัดวันนี้
-                if category == "goodmorning" and user_context:
-                    today_str = datetime.now(BKK).strftime("%Y-%m-%d")
-                    today_rem = [
-                        r["message"] for r in user_context.get("pending_reminders", [])
-                        if r.get("remind_at", "").startswith(today_str)
-                    ]
-                    if today_rem:
-                        result += f" วันนี้มีนัด: {today_rem[0]} ด้วยนะ! 📅"
-
-                # Context-aware: ฝันดี + streak
-                if category == "goodnight" and user_context:
-                    streak = user_context.get("streak", 0)
-                    if streak >= 3:
-                        result += f" (Streak {streak} วันแล้ว! เก่งมาก 🔥)"
-
-                return result
-    return None
+    return local_reply_for(detect_local_intent(message), user_name, user_context)
+
+
+def get_local_reply_stats() -> dict:
+    """จำนวนข้อความที่ตอบเองต่อ intent + deflection rate (สัดส่วนที่ไม่ต้องเรียก Claude)"""
+    total = sum(_local_stats.values())
+    local = total - _local_stats["llm"]
+    return {
+        "messages": total,
+        "local": local,
+        "deflection_rate": round(local / total, 3) if total else None,
+        "by_intent": {k: v for k, v in _local_stats.items() if k != "llm"},
+    }
 
 
 # ==================== Call Claude Haiku ====================
 
+def _build_chat_payload(
+    message: str,
+    user_name: str,
+    personality: str,
+    memory: dict,
+    recent_messages: list[dict],
+    user_context: dict | None = None,
+    stock_context: str | None = None,
+    conversation_summary: str | None = None,
+) -> dict:
+    """สร้าง request body ของ Messages API (ใช้ร่วมกันทั้งแบบปกติและแบบ stream)"""
+    system_prompt, messages, report = build_prompt(
+        message, user_name, personality, memory, recent_messages, user_context, stock_context,
+        conversation_summary,
+    )
+    logger.info(token_budget.format_report(report))
+    if report["dropped"]:
+        _llm_stats["prompt_trimmed"] += 1
+
+    return {
+        "model": MODEL,
+        "max_tokens": 1024,  # Sonnet 4: ตอบละเอียดขึ้น + วิเคราะห์หุ้นเชิงลึก
+        "system": system_prompt,
+        "messages": messages,
+    }
+
+
+def _api_error_result(user_name: str) -> dict:
+    return {
+        "reply": f"อุ๊ปส์ ฟ้าตอบไม่ได้ชั่วคราว ลองใหม่นะ {user_name}~ 😅",
+        "memory_update": None,
+        "reminder": None,
+    }
+
+
 async def call_haiku(
     message: str,
     user_name: str,
@@ -396,55 +840,160 @@ async def call_haiku(
     recent_messages: list[dict],
     user_context: dict | None = None,
     stock_context: str | None = None,
+    conversation_summary: str | None = None,
 ) -> dict:
-    """เรียก Claude Haiku API — ได้ reply + memory_update + reminder"""
-
-    system_prompt = build_system_prompt(user_name, personality, memory, user_context, stock_context)
-
-    # สร้าง messages array
-    messages = []
-    for msg in recent_messages:
-        messages.append({
-            "role": msg["role"],
-            "content": msg["content"],
-        })
-    messages.append({"role": "user", "content": message})
-
-    # เรียก API
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            API_URL,
-            headers={
-                "x-api-key": ANTHROPIC_API_KEY,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            },
-            json={
-                "model": MODEL,
-                "max_tokens": 1024,  # Sonnet 4: ตอบละเอียดขึ้น + วิเคราะห์หุ้นเชิงลึก
-                "system": system_prompt,
-                "messages": messages,
-            },
-        )
+    """เรียก Claude Haiku API — ได้ reply + memory_update + reminder (+ usage ของ call นี้)"""
+
+    # เรียก API (shared client + retry)
+    response = await post_messages(_build_chat_payload(
+        message, user_name, personality, memory, recent_messages, user_context, stock_context,
+        conversation_summary,
+    ))
 
     if response.status_code != 200:
         logger.error(
             f"Claude API error {response.status_code} for user '{user_name}': "
             f"{response.text[:500]}"
         )
-        return {
-            "reply": f"อุ๊ปส์ ฟ้าตอบไม่ได้ชั่วคราว ลองใหม่นะ {user_name}~ 😅",
-            "memory_update": None,
-            "reminder": None,
-        }
+        return _api_error_result(user_name)
 
     data = response.json()
     raw_text = data["content"][0]["text"]
-    logger.info(f"Claude API success for '{user_name}', tokens: "
-                f"in={data.get('usage', {}).get('input_tokens', '?')}, "
-                f"out={data.get('usage', {}).get('output_tokens', '?')}")
+    usage = record_usage(data.get("usage"))
+    logger.info(f"Claude API success for '{user_name}', tokens: {_format_usage(usage)}")
+
+    result = parse_ai_response(raw_text)
+    result["usage"] = usage
+    return result
+
+
+async def stream_haiku(
+    message: str,
+    user_name: str,
+    personality: str,
+    memory: dict,
+    recent_messages: list[dict],
+    user_context: dict | None = None,
+    stock_context: str | None = None,
+    conversation_summary: str | None = None,
+):
+    """
+    เรียก Claude แบบ stream — yield {"type": "token", "text": ...} ทีละส่วนของ REPLY
+    แล้วจบด้วย {"type": "done", "result": ...} (ผลเดียวกับ call_haiku)
+    ส่วน MEMORY_UPDATE / REMINDER / STOCK_ALERT ถูกกั้นไว้ ไม่ส่งให้ client
+    """
+    payload = _build_chat_payload(
+        message, user_name, personality, memory, recent_messages, user_context, stock_context,
+        conversation_summary,
+    )
+    parser = ReplyStreamParser()
+    usage = {}
+
+    try:
+        async for event_type, data in stream_messages(payload):
+            if event_type == "content_block_delta":
+                delta = data.get("delta", {})
+                if delta.get("type") == "text_delta":
+                    text = parser.feed(delta.get("text", ""))
+                    if text:
+                        yield {"type": "token", "text": text}
+            elif event_type == "message_start":
+                # input / cache tokens มากับ message_start
+                usage.update(data.get("message", {}).get("usage", {}))
+            elif event_type == "message_delta":
+                # output_tokens สะสมมากับ message_delta
+                usage.update(data.get("usage", {}))
+            elif event_type == "error":
+                raise RuntimeError(f"Claude stream error: {data.get('error')}")
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Claude API stream failed for user '{user_name}': {e}")
+        result = _api_error_result(user_name)
+        if not parser.emitted:
+            yield {"type": "token", "text": result["reply"]}
+        yield {"type": "done", "result": result}
+        return
+
+    usage = record_usage(usage)
+    logger.info(f"Claude API stream success for '{user_name}', tokens: {_format_usage(usage)}")
+    result = parser.finish()
+    result["usage"] = usage
+
+    # ส่วนท้ายที่ถูกกั้นไว้ (เช่น reply จบด้วยคำที่คล้าย marker) → ส่งให้ครบก่อน done
+    if result["reply"].startswith(parser.emitted):
+        rest = result["reply"][len(parser.emitted):]
+        if rest:
+            yield {"type": "token", "text": rest}
+    yield {"type": "done", "result": result}
+
+
+# ==================== Incremental Response Parser ====================
+
+STRUCTURED_MARKERS = ("MEMORY_UPDATE:", "REMINDER:", "STOCK_ALERT:")
+_REPLY_MARKER = "REPLY:"
+_MAX_MARKER_LEN = max(len(m) for m in STRUCTURED_MARKERS)
+
+
+class ReplyStreamParser:
+    """
+    แยก REPLY ออกจาก stream ทีละ chunk
+    - ตัด "REPLY:" ที่ขึ้นต้นออก
+    - หยุดส่งเมื่อเจอ MEMORY_UPDATE: / REMINDER: / STOCK_ALERT:
+    - กั้นท้าย buffer ที่อาจเป็นต้นของ marker (เช่น "REM") และ whitespace ท้าย ไว้ก่อนจนกว่าจะแน่ใจ
+    เมื่อ stream จบ เรียก finish() → parse ทั้งก้อนด้วย parse_ai_response ตามเดิม
+    """
 
-    return parse_ai_response(raw_text)
+    def __init__(self):
+        self.raw = ""
+        self.emitted = ""
+        self._pos = 0          # index ใน raw ที่ส่งไปแล้ว
+        self._started = False  # ผ่านช่วงตรวจ "REPLY:" แล้วหรือยัง
+        self._stopped = False  # เจอ marker แล้ว → ไม่ส่งอะไรเพิ่ม
+
+    def feed(self, chunk: str) -> str:
+        """รับ text ชิ้นใหม่ → คืน text ที่ส่งให้ client ได้แล้ว (อาจเป็น "")"""
+        self.raw += chunk
+        if self._stopped:
+            return ""
+
+        if not self._started:
+            stripped = self.raw.lstrip()
+            if len(stripped) < len(_REPLY_MARKER) and _REPLY_MARKER.startswith(stripped):
+                return ""  # ยังไม่รู้ว่าเป็น "REPLY:" หรือไม่
+            self._pos = len(self.raw) - len(stripped)
+            if stripped.startswith(_REPLY_MARKER):
+                self._pos += len(_REPLY_MARKER)
+            self._started = True
+
+        end = len(self.raw)
+        search_from = max(self._pos - _MAX_MARKER_LEN, 0)
+        hits = [i for i in (self.raw.find(m, search_from) for m in STRUCTURED_MARKERS) if i >= 0]
+        if hits:
+            end = min(hits)
+            self._stopped = True
+        else:
+            # กั้นท้ายที่อาจเป็นต้นของ marker
+            for k in range(min(_MAX_MARKER_LEN - 1, end - self._pos), 0, -1):
+                tail = self.raw[end - k:]
+                if any(m.startswith(tail) for m in STRUCTURED_MARKERS):
+                    end -= k
+                    break
+
+        # whitespace ท้ายรอไว้ก่อน (ถ้าต่อด้วย marker จะถูกตัดทิ้ง)
+        while end > self._pos and self.raw[end - 1].isspace():
+            end -= 1
+        if end <= self._pos:
+            return ""
+
+        text = self.raw[self._pos:end]
+        if not self.emitted:
+            text = text.lstrip()
+        self._pos = end
+        self.emitted += text
+        return text
+
+    def finish(self) -> dict:
+        """stream จบแล้ว → parse ทั้งก้อน (reply, memory_update, reminder, stock_alert)"""
+        return parse_ai_response(self.raw)
 
 
 def parse_ai_response(raw_text: str) -> dict:
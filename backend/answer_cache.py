@@ -0,0 +1,192 @@
+"""
+answer_cache.py — Cache คำตอบของคำถามที่ไม่ขึ้นกับตัวผู้ใช้ (เช่น "SET วันนี้เป็นไง", "วิเคราะห์ PTT หน่อย")
+คำถามเรื่องหุ้นที่ระบุหุ้น/ตลาดชัดเจน ไม่พูดถึงพอร์ต/การตั้งเตือน และไม่ต่อจากประโยคก่อน
+→ คำตอบขึ้นกับข้อมูลกลาง (stock/market cache) เท่านั้น
+ผู้ใช้หลายคนถามซ้ำในรอบ cache เดียวกัน → ตอบจาก cache ไม่ต้องเรียก Claude
+miss → Claude ตอบจากข้อมูลกลางเท่านั้น (shared_llm_args — ไม่มี memory / กิจวัตร / นัด / mood /
+สรุปบทสนทนา / ประวัติแชทของผู้ถาม) แล้วเก็บคำตอบไว้ให้คนถัดไป — ข้อมูลส่วนตัวไม่หลุดไปถึงผู้ใช้อื่น
+
+key = (ข้อความที่ normalize แล้ว, personality, hash ของ stock context ที่ส่งให้ Claude)
+  stock context สร้างจาก stock_cache / market_cache → refresh รอบใหม่ = hash ใหม่ = key ใหม่ (ไม่ต้อง invalidate)
+TTL ต่อ entry ตามความสดของข้อมูล (ตลาดเปิด = สั้น, ตลาดปิด = ราคาไม่เปลี่ยน เก็บได้นาน) + LRU eviction
+
+คำตอบที่เก็บเป็น template — เฉพาะชื่อผู้ใช้ที่อยู่ตรงคำทักต้นคำตอบถูกแทนด้วยชื่อของคนที่ถาม
+ชื่อโผล่ที่อื่นในคำตอบ (หรือชื่อสั้นกว่า 2 ตัวอักษร) → ไม่ cache (ชื่ออาจเป็นคำทั่วไป/ชื่อหุ้น)
+ทุก method เรียกจาก event loop เท่านั้น (ไม่ thread-safe)
+"""
+
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_MAX_CHARS = int(os.getenv("ANSWER_CACHE_MAX_CHARS", "120"))
+# อายุคำตอบ: ตลาดเปิด = เท่ารอบ stock cache (10 นาที), ตลาดปิด = ข้อมูลนิ่งจนกว่าจะเปิดรอบหน้า
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "600"))
+ANSWER_CACHE_CLOSED_TTL = int(os.getenv("ANSWER_CACHE_CLOSED_TTL", "21600"))
+
+# ราคา Claude ต่อ 1M tokens (USD) — ใช้ประเมินค่าใช้จ่ายที่ประหยัดได้
+LLM_USD_PER_MTOK = {
+    "input_tokens": float(os.getenv("LLM_INPUT_USD_PER_MTOK", "3.0")),
+    "output_tokens": float(os.getenv("LLM_OUTPUT_USD_PER_MTOK", "15.0")),
+    "cache_creation_input_tokens": float(os.getenv("LLM_CACHE_WRITE_USD_PER_MTOK", "3.75")),
+    "cache_read_input_tokens": float(os.getenv("LLM_CACHE_READ_USD_PER_MTOK", "0.3")),
+}
+
+# คำที่ทำให้คำตอบขึ้นกับตัวผู้ใช้ (พอร์ต/watchlist) หรือมี side effect (ตั้งเตือน) → ไม่ cache
+PERSONAL_MARKERS = (
+    "พอร์ต", "ของฉัน", "ของผม", "ของเรา", "ของหนู", "ที่ถือ", "ถืออยู่", "watchlist",
+    "เตือน", "แจ้ง", "ตั้ง", "จำไว้", "my ", "alert", "remind",
+)
+
+# คำที่อ้างถึงบทสนทนาก่อนหน้า ("แล้วตัวนั้นล่ะ", "อันเมื่อกี้") → คำตอบขึ้นกับประวัติแชท ไม่ cache
+FOLLOWUP_MARKERS = (
+    "ตัวนั้น", "ตัวนี้", "อันนั้น", "อันนี้", "ตัวเดิม", "เมื่อกี้", "เมื่อกี๊", "ที่ว่า", "ที่บอก",
+    "ล่ะ", "แล้ว", "ต่อ", "เหมือนกัน", "ด้วยไหม", "that", "this one", "it ",
+)
+
+# คำถามภาพรวมตลาดที่ไม่ต้องระบุชื่อหุ้น
+MARKET_TERMS = ("set", "ตลาด", "ดัชนี", "nasdaq", "s&p", "dow", "ดาวโจนส์")
+
+# field ของ call_haiku / stream_haiku ที่ส่งต่อได้เมื่อคำตอบจะถูกใช้ซ้ำ — ที่เหลือ (ข้อมูลส่วนตัว) ถูกตัดทิ้ง
+SHARED_LLM_FIELDS = ("message", "user_name", "personality")
+
+# คำทักต้นคำตอบ — ชื่อต้องอยู่ต้นคำตอบ (หลังคำทักเหล่านี้ได้) ถึงจะแทนเป็นชื่อของคนถามได้
+_GREETING_RE = re.compile(r"^\W*(?:(?:สวัสดี|หวัดดี|ว้าว|โอ้โห|โอ้|เฮ้|ฮัลโหล|hi|hello|hey)\W*)?$", re.IGNORECASE)
+
+_SPACE_RE = re.compile(r"\s+")
+# คำลงท้าย / เครื่องหมายท้ายประโยค — "วิเคราะห์ PTT หน่อยครับ?" = "วิเคราะห์ PTT"
+_TRAILING_RE = re.compile(r"(?:ครับ|คับ|ค่ะ|คะ|จ้า|จ้ะ|นะ|หน่อย|ที|ด้วย|[?!.~]+)+$")
+
+
+def normalize_question(message: str) -> str:
+    text = _SPACE_RE.sub("", message.strip().lower())
+    return _TRAILING_RE.sub("", text)
+
+
+def is_cacheable(message: str, symbols: list[str]) -> bool:
+    """
+    คำถามสั้นที่มีเรื่องชัดเจนในตัว (ชื่อหุ้น หรือถามภาพรวมตลาด) ไม่พูดถึงข้อมูลส่วนตัว/การตั้งเตือน
+    และไม่ต่อจากบทสนทนาก่อนหน้า (ผู้เรียกเช็คเองว่าเป็นคำถามเรื่องหุ้น)
+    """
+    text = message.strip().lower()
+    if not 0 < len(text) <= ANSWER_CACHE_MAX_CHARS:
+        return False
+    if any(m in text for m in PERSONAL_MARKERS) or any(m in text for m in FOLLOWUP_MARKERS):
+        return False
+    return bool(symbols) or any(t in text for t in MARKET_TERMS)
+
+
+def to_template(reply: str, user_name: str, source: str = "") -> tuple[str, str | None] | None:
+    """
+    แยกคำตอบเป็น (ก่อนชื่อ, หลังชื่อ) — ชื่อต้องอยู่ตรงคำทักต้นคำตอบ จบคำตรงนั้น และมีแค่ที่เดียว
+    ไม่มีชื่อเลย → (reply, None) ใช้ได้กับทุกคน / ชื่ออยู่ที่อื่น → None (ไม่ cache)
+    source: คำถาม + ข้อมูลหุ้นที่ส่งให้ Claude — ชื่อที่ซ้ำกับในนี้ (เช่นชื่อผู้ใช้ "PTT") แยกไม่ออก → None
+    """
+    if len(user_name) < 2 or user_name.lower() in source.lower():
+        return None
+    index = reply.find(user_name)
+    if index < 0:
+        return reply, None
+    end = index + len(user_name)
+    if not _GREETING_RE.match(reply[:index]) or reply[end:end + 1].isalpha() or reply.find(user_name, end) >= 0:
+        return None
+    return reply[:index], reply[end:]
+
+
+def shared_llm_args(llm_args: dict, stock_context: str) -> dict:
+    """
+    kwargs ของ call_haiku / stream_haiku สำหรับคำถามที่จะเก็บลง cache — เก็บเฉพาะ SHARED_LLM_FIELDS
+    + stock context กลาง (ไม่มี watchlist) ส่วนตัวอื่นทั้งหมดไม่ถูกส่งให้ Claude
+    """
+    return {
+        **{field: llm_args[field] for field in SHARED_LLM_FIELDS},
+        "memory": {},
+        "recent_messages": [],
+        "stock_context": stock_context,
+    }
+
+
+def ttl_for(market_open: bool) -> int:
+    return ANSWER_CACHE_TTL if market_open else ANSWER_CACHE_CLOSED_TTL
+
+
+def context_digest(context: str | None) -> str:
+    return hashlib.blake2b((context or "").encode("utf-8"), digest_size=8).hexdigest()
+
+
+def usage_cost_usd(usage: dict) -> float:
+    return sum(usage.get(field, 0) * price for field, price in LLM_USD_PER_MTOK.items()) / 1_000_000
+
+
+class AnswerCache:
+    """LRU ของ key → ((ก่อนชื่อ, หลังชื่อ) หรือ (reply, None), usage, expires_at)"""
+
+    def __init__(self, maxsize: int = ANSWER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: OrderedDict[tuple, tuple[tuple, dict, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.skipped = 0   # คำตอบที่มีชื่อผู้ใช้นอกคำทัก → ไม่ cache
+        self.evictions = 0
+        self.expired = 0
+        self.saved_tokens = {field: 0 for field in LLM_USD_PER_MTOK}
+        self.saved_usd = 0.0
+
+    @staticmethod
+    def key(message: str, personality: str, context: str | None) -> tuple:
+        return normalize_question(message), personality, context_digest(context)
+
+    def get(self, key: tuple, user_name: str) -> str | None:
+        """คำตอบที่ cache ไว้ (เติมชื่อผู้ใช้แล้ว) — None ถ้าไม่มีหรือหมดอายุ"""
+        entry = self._data.get(key)
+        if entry is not None and entry[2] <= time.time():
+            del self._data[key]
+            self.expired += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        (head, tail), usage, _ = entry
+        self.hits += 1
+        for field in self.saved_tokens:
+            self.saved_tokens[field] += usage.get(field, 0)
+        self.saved_usd += usage_cost_usd(usage)
+        return head + user_name + tail if tail is not None else head
+
+    def put(self, key: tuple, reply: str, user_name: str, usage: dict, ttl: float, source: str = "") -> bool:
+        """เก็บคำตอบ — Returns: False ถ้าใช้ซ้ำกับคนอื่นไม่ได้ (ชื่อผู้ถามอยู่นอกคำทัก)"""
+        template = to_template(reply, user_name, source)
+        if template is None:
+            self.skipped += 1
+            return False
+        self._data[key] = (template, usage, time.time() + ttl)
+        self._data.move_to_end(key)
+        self.stores += 1
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "stores": self.stores,
+            "skipped": self.skipped,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "saved_tokens": dict(self.saved_tokens),
+            "saved_usd": round(self.saved_usd, 4),
+        }
+
+
+cache = AnswerCache()
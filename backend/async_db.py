@@ -0,0 +1,121 @@
+"""
+async_db.py — Async Database Layer
+ห่อฟังก์ชันใน database.py ให้ await ได้ — รัน query ใน thread pool ของ DB โดยเฉพาะ
+handler แบบ async def จะไม่ block event loop (ซึ่งต้องรัน call_haiku, TTS, scheduler ด้วย)
+
+ใช้งาน:
+    import async_db as adb
+    user = await adb.get_user(user_id)
+    await adb.run(process_memory_update, user_id, text)   # ฟังก์ชัน sync อื่นที่แตะ DB
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+
+# จำนวน thread ของ DB — แต่ละ thread มี connection ของตัวเองจาก pool ใน database.py
+# SQLite (WAL) อ่านพร้อมกันได้หลาย connection แต่เขียนได้ทีละ 1 จึงไม่ต้องมี thread เยอะ
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+async def run(func, *args, **kwargs):
+    """รันฟังก์ชัน sync ที่แตะ DB ใน DB executor แล้ว await ผลลัพธ์"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _wrap(func):
+    """สร้าง async version ของฟังก์ชันใน database.py (signature เดิม)"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+def shutdown():
+    """รอ query ที่ค้างอยู่ให้เสร็จ แล้วปิด executor — เรียกตอน server shutdown"""
+    _executor.shutdown(wait=True)
+
+
+# ==================== Mirrors of database.py ====================
+
+init_db = _wrap(db.init_db)
+rebuild_user_streaks = _wrap(db.rebuild_user_streaks)
+
+# User
+create_user = _wrap(db.create_user)
+get_user = _wrap(db.get_user)
+update_user_memory = _wrap(db.update_user_memory)
+update_user_field = _wrap(db.update_user_field)
+
+# Messages
+save_message = _wrap(db.save_message)
+get_recent_messages = _wrap(db.get_recent_messages)
+
+# Conversation Summaries
+get_conversation_summary = _wrap(db.get_conversation_summary)
+get_unsummarized_messages = _wrap(db.get_unsummarized_messages)
+save_conversation_summary = _wrap(db.save_conversation_summary)
+
+# Reminders
+add_reminder = _wrap(db.add_reminder)
+get_pending_reminders = _wrap(db.get_pending_reminders)
+mark_reminder_done = _wrap(db.mark_reminder_done)
+
+# Moods
+save_mood = _wrap(db.save_mood)
+get_mood_history = _wrap(db.get_mood_history)
+
+# Routines
+create_routine = _wrap(db.create_routine)
+get_routines = _wrap(db.get_routines)
+is_routine_done_today = _wrap(db.is_routine_done_today)
+complete_routine = _wrap(db.complete_routine)
+delete_routine = _wrap(db.delete_routine)
+
+# Stats / Chat Context
+get_user_stats = _wrap(db.get_user_stats)
+load_chat_context = _wrap(db.load_chat_context)
+
+# Alerts
+save_alert = _wrap(db.save_alert)
+get_active_alerts = _wrap(db.get_active_alerts)
+get_latest_critical_alerts = _wrap(db.get_latest_critical_alerts)
+expire_old_alerts = _wrap(db.expire_old_alerts)
+
+# Device Tokens (FCM)
+save_device_token = _wrap(db.save_device_token)
+get_user_fcm_tokens = _wrap(db.get_user_fcm_tokens)
+delete_fcm_token = _wrap(db.delete_fcm_token)
+get_fcm_tokens_for_users = _wrap(db.get_fcm_tokens_for_users)
+delete_fcm_tokens = _wrap(db.delete_fcm_tokens)
+
+# Stock Watchlist
+add_stock_alert = _wrap(db.add_stock_alert)
+get_user_stock_alerts = _wrap(db.get_user_stock_alerts)
+get_all_active_stock_alerts = _wrap(db.get_all_active_stock_alerts)
+update_stock_price = _wrap(db.update_stock_price)
+mark_stock_notified = _wrap(db.mark_stock_notified)
+get_stock_watchlist_fingerprint = _wrap(db.get_stock_watchlist_fingerprint)
+update_stock_alert_state = _wrap(db.update_stock_alert_state)
+delete_stock_alert = _wrap(db.delete_stock_alert)
+
+# Stock Cache
+upsert_stock_cache = _wrap(db.upsert_stock_cache)
+upsert_stock_cache_many = _wrap(db.upsert_stock_cache_many)
+get_stock_cache = _wrap(db.get_stock_cache)
+get_all_stock_cache = _wrap(db.get_all_stock_cache)
+upsert_market_cache = _wrap(db.upsert_market_cache)
+upsert_market_cache_many = _wrap(db.upsert_market_cache_many)
+get_market_cache = _wrap(db.get_market_cache)
+
+# Price Bars
+upsert_price_bars_many = _wrap(db.upsert_price_bars_many)
+get_price_bars = _wrap(db.get_price_bars)
+get_price_bar_coverage = _wrap(db.get_price_bar_coverage)
+prune_price_bars = _wrap(db.prune_price_bars)
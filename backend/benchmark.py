@@ -0,0 +1,610 @@
+"""
+benchmark.py — เครื่องมือวัด performance ของ backend (รันแยก ไม่ได้ถูก import โดย server)
+
+    python benchmark.py load --url http://localhost:8000 --user-id abc123 -c 50 -n 2000
+
+    python benchmark.py indicators --sizes 1 100 5000 --bars 126
+
+    python benchmark.py alerts --alerts 100000 --symbols 500
+
+    python benchmark.py push --notifications 20000 --latency-ms 80
+
+    python benchmark.py scanner --symbols 80 1000 5000
+
+    python benchmark.py summaries --turns 200
+
+load: ยิง /health และ /chat พร้อมกันหลาย request แล้วสรุป latency p50/p95/p99
+      /chat ใช้ข้อความที่ตอบด้วย local reply ("สวัสดี") → วัดเฉพาะ DB + event loop ไม่เสียค่า LLM
+indicators: เทียบเวลา pandas ทีละ symbol (วิธีเดิม) กับ indicators.compute_indicators (NumPy ทั้งชุด)
+      บนข้อมูลสุ่ม แล้วตรวจว่าค่าที่ปัดแล้วตรงกันทุก field
+alerts: เวลาเช็ค stock alerts 1 รอบ (ไม่รวม network/push) — วนทุก alert + update ทีละแถว (วิธีเดิม)
+      เทียบกับ threshold index + batch update ใน transaction เดียว บน SQLite ชั่วคราว
+push: throughput (msgs/sec) ของ push_sender.send_push_batch ผ่าน FCM transport ปลอม
+      (หน่วงตาม --latency-ms ต่อ HTTP call) เทียบกับส่งทีละ message แบบเดิม
+scanner: เวลาต่อข้อความของการหาชื่อหุ้น/keyword — วนทุก symbol (วิธีเดิม) vs StockScanner (regex ตัวเดียว)
+      ที่ขนาดรายชื่อหุ้นต่าง ๆ
+summaries: prompt token ต่อข้อความ (ประมาณด้วย token_budget) ของประวัติดิบ --window ข้อความ (baseline เดิม = 6)
+      เทียบกับ summary + ข้อความที่ยังไม่ถูกสรุป รวมค่าเรียก LLM สรุป — จำลองบทสนทนาบน SQLite ชั่วคราว สรุปด้วย LLM ปลอม
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    """percentile แบบ nearest-rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[k]
+
+
+def _print_latency(label: str, latencies_ms: list[float], errors: int, elapsed: float):
+    print(
+        f"{label:<10} n={len(latencies_ms):<6} err={errors:<4} "
+        f"rps={len(latencies_ms) / elapsed if elapsed else 0:8.1f}  "
+        f"p50={_percentile(latencies_ms, 50):7.2f}ms  "
+        f"p95={_percentile(latencies_ms, 95):7.2f}ms  "
+        f"p99={_percentile(latencies_ms, 99):7.2f}ms  "
+        f"mean={statistics.fmean(latencies_ms) if latencies_ms else 0:7.2f}ms"
+    )
+
+
+# ==================== HTTP Load Test ====================
+# import httpx ภายในฟังก์ชัน → subcommand อื่นรันได้โดยไม่ต้องมี httpx
+
+async def _load_worker(client, queue: asyncio.Queue, results: dict):
+    while True:
+        item = await queue.get()
+        if item is None:
+            queue.task_done()
+            return
+        label, method, path, body = item
+        start = time.perf_counter()
+        try:
+            resp = await client.request(method, path, json=body)
+            ok = resp.status_code < 500
+        except Exception:
+            ok = False
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if ok:
+            results[label]["latencies"].append(elapsed_ms)
+        else:
+            results[label]["errors"] += 1
+        queue.task_done()
+
+
+async def run_load(url: str, user_id: str | None, concurrency: int, requests: int):
+    """ยิง /health และ /chat สลับกัน (concurrency = จำนวน worker พร้อมกัน)"""
+    import httpx
+
+    results = {
+        "/health": {"latencies": [], "errors": 0},
+        "/chat": {"latencies": [], "errors": 0},
+    }
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(requests):
+        if user_id and i % 2:
+            queue.put_nowait(("/chat", "POST", "/chat", {"user_id": user_id, "message": "สวัสดี"}))
+        else:
+            queue.put_nowait(("/health", "GET", "/health", None))
+    for _ in range(concurrency):
+        queue.put_nowait(None)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=60.0, limits=limits) as client:
+        start = time.perf_counter()
+        workers = [asyncio.create_task(_load_worker(client, queue, results)) for _ in range(concurrency)]
+        await asyncio.gather(*workers)
+        elapsed = time.perf_counter() - start
+
+    print(f"Load test: {url} concurrency={concurrency} requests={requests} ({elapsed:.2f}s)")
+    for label, data in results.items():
+        if data["latencies"] or data["errors"]:
+            _print_latency(label, data["latencies"], data["errors"], elapsed)
+
+
+# ==================== Indicator Engine ====================
+
+INDICATOR_FIELDS = (
+    "sma_20", "sma_50", "sma_200", "sma_20_prev", "sma_50_prev", "rsi_14",
+    "avg_volume_20d", "support_30d", "resistance_30d", "high_52w", "low_52w",
+    "perf_1w", "perf_1m", "perf_3m",
+)
+
+
+def _random_series(bars: int, rng: random.Random) -> tuple[list, list, list, list]:
+    """random walk (ค่าผ่าน float32 เหมือนที่ Yahoo ส่งมา) + None ประปราย"""
+    import numpy as np
+
+    price = rng.uniform(1, 500)
+    closes, highs, lows, volumes = [], [], [], []
+    for _ in range(bars):
+        price *= 1 + rng.gauss(0, 0.02)
+        p = float(np.float32(price))
+        if rng.random() > 0.01:
+            closes.append(p)
+            highs.append(float(np.float32(p * 1.01)))
+            lows.append(float(np.float32(p * 0.99)))
+        volumes.append(rng.randint(0, 10_000_000) if rng.random() > 0.03 else 0)
+    return closes, highs, lows, volumes
+
+
+def _pandas_indicators(closes: list, highs: list, lows: list, volumes: list) -> dict:
+    """วิธีเดิม (pandas Series ต่อ symbol) — ใช้เป็น baseline ทั้งเวลาและความถูกต้อง"""
+    import pandas as pd
+
+    c, h, l, v = pd.Series(closes), pd.Series(highs), pd.Series(lows), pd.Series(volumes)
+    n = len(c)
+    out = {}
+    for w in (20, 50, 200):
+        out[f"sma_{w}"] = c.rolling(w).mean().iloc[-1] if n >= w else None
+    out["sma_20_prev"] = c.rolling(20).mean().iloc[-2] if n >= 21 else None
+    out["sma_50_prev"] = c.rolling(50).mean().iloc[-2] if n >= 51 else None
+    out["rsi_14"] = None
+    if n >= 15:
+        d = c.diff()
+        gain = d.where(d > 0, 0.0).rolling(14).mean().iloc[-1]
+        loss = (-d).where(d < 0, 0.0).rolling(14).mean().iloc[-1]
+        out["rsi_14"] = 100.0 if loss == 0 else 100 - (100 / (1 + gain / loss))
+    out["avg_volume_20d"] = v.rolling(20).mean().iloc[-1] if len(v) >= 20 else None
+    out["support_30d"] = l.tail(30).min()
+    out["resistance_30d"] = h.tail(30).max()
+    out["high_52w"] = h.max()
+    out["low_52w"] = l.min()
+    for name, days in (("perf_1w", 5), ("perf_1m", 22), ("perf_3m", 66)):
+        old = c.iloc[-days - 1] if n > days else None
+        out[name] = (c.iloc[-1] - old) / old * 100 if old else None
+    return out
+
+
+def _rounded(value, decimals: int):
+    if value is None or value != value:  # None / NaN
+        return None
+    return round(float(value), decimals)
+
+
+def run_indicators(sizes: list[int], bars: int, seed: int):
+    """เทียบเวลา + ความถูกต้องของ indicator engine กับ pandas ที่จำนวน symbol ต่าง ๆ"""
+    import indicators
+
+    rng = random.Random(seed)
+    _pandas_indicators(*_random_series(bars, random.Random(0)))  # warm-up (import pandas)
+    print(f"Indicator engine benchmark: bars={bars}")
+    for size in sizes:
+        data = [_random_series(bars, rng) for _ in range(size)]
+
+        start = time.perf_counter()
+        baseline = [_pandas_indicators(*d) for d in data]
+        pandas_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        arrays = [indicators.pack_rows([d[k] for d in data]) for k in range(4)]
+        packed_s = time.perf_counter() - start
+        result = indicators.compute_indicators(*arrays)
+        numpy_s = time.perf_counter() - start
+
+        mismatches = 0
+        for i, ref in enumerate(baseline):
+            for field in INDICATOR_FIELDS:
+                decimals = 1 if field == "rsi_14" else 0 if field == "avg_volume_20d" else 2
+                if _rounded(ref[field], decimals) != _rounded(result[field][i], decimals):
+                    mismatches += 1
+
+        print(
+            f"  symbols={size:<6} pandas={pandas_s * 1000:9.1f}ms  "
+            f"numpy={numpy_s * 1000:8.1f}ms (pack {packed_s * 1000:.1f}ms)  "
+            f"speedup={pandas_s / numpy_s if numpy_s else 0:6.1f}x  "
+            f"mismatched_fields={mismatches}/{size * len(INDICATOR_FIELDS)}"
+        )
+
+
+# ==================== Stock Alert Engine ====================
+
+def _seed_alerts(db, count: int, symbols: list[str], rng: random.Random):
+    kinds = ("price_above", "price_below", "change_pct")
+    rows = []
+    for i in range(count):
+        kind = kinds[i % 3]
+        # เป้าส่วนใหญ่อยู่ห่างจากราคาปัจจุบัน (~100) → แต่ละรอบมีแค่ส่วนน้อยที่ถึงเป้า
+        if kind == "change_pct":
+            target = rng.uniform(2, 15)
+        elif kind == "price_above":
+            target = rng.uniform(100, 140)
+        else:
+            target = rng.uniform(60, 100)
+        rows.append((f"user{i % 5000}", rng.choice(symbols), "X", kind, round(target, 2)))
+    with db.get_db() as conn:
+        conn.executemany(
+            """INSERT INTO stock_watchlist (user_id, symbol, display_name, alert_type, target_value)
+               VALUES (?, ?, ?, ?, ?)""",
+            rows,
+        )
+
+
+def run_alerts(count: int, n_symbols: int, seed: int):
+    """จับเวลา 1 รอบเช็ค alert: วิธีเดิม (วนทุกแถว) vs threshold index + batch write"""
+    import database as db
+    import stock_service
+    from pathlib import Path
+
+    rng = random.Random(seed)
+    symbols = [f"S{i:04d}.BK" for i in range(n_symbols)]
+    # ราคาแกว่งรอบ 100 → ส่วนใหญ่ไม่ถึงเป้า (เหมือนของจริง)
+    prices = {s: {"price": round(rng.uniform(95, 105), 2), "change_pct": round(rng.gauss(0, 1.5), 2)}
+              for s in symbols}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = Path(os.path.join(tmp, "bench.db"))
+        db.init_db()
+        _seed_alerts(db, count, symbols, rng)
+        print(f"Stock alert benchmark: alerts={count} symbols={n_symbols}")
+
+        # --- วิธีเดิม: โหลดทุกแถว, update ทีละ alert (commit ทุกครั้ง), เช็คทีละ alert ---
+        start = time.perf_counter()
+        alerts = db.get_all_active_stock_alerts()
+        loaded_s = time.perf_counter() - start
+        hits_old = 0
+        for alert in alerts:
+            price_data = prices[alert["symbol"]]
+            db.update_stock_price(alert["id"], price_data["price"])
+            if stock_service._evaluate_stock_alert(alert, price_data):
+                hits_old += 1
+        old_s = time.perf_counter() - start
+        print(f"  loop+per-row update: {old_s * 1000:9.1f}ms (load {loaded_s * 1000:.1f}ms)  triggered={hits_old}")
+
+        # --- index: สร้างครั้งเดียว (เฉพาะตอน watchlist เปลี่ยน) ---
+        start = time.perf_counter()
+        index = stock_service._AlertIndex(db.get_all_active_stock_alerts(), db.get_stock_watchlist_fingerprint())
+        build_s = time.perf_counter() - start
+
+        # --- 1 รอบปกติ: fingerprint + crossed + batch write ---
+        rng_prices = {s: dict(p, price=round(p["price"] * 1.001, 2)) for s, p in prices.items()}
+        start = time.perf_counter()
+        db.get_stock_watchlist_fingerprint()
+        crossed = []
+        for symbol, p in rng_prices.items():
+            crossed.extend(index.crossed(symbol, p["price"], p["change_pct"]))
+        eval_s = time.perf_counter() - start
+        db.update_stock_alert_state([(s, p["price"]) for s, p in rng_prices.items()], crossed)
+        cycle_s = time.perf_counter() - start
+        print(
+            f"  index cycle:         {cycle_s * 1000:9.1f}ms (evaluate {eval_s * 1000:.1f}ms, "
+            f"index build {build_s * 1000:.1f}ms once)  triggered={len(crossed)}  "
+            f"speedup={old_s / cycle_s if cycle_s else 0:.1f}x"
+        )
+        db.close_db_pool()
+
+
+# ==================== Push Fan-out ====================
+
+class _FakeFCM:
+    """transport ปลอมแทน messaging.send_each — หน่วงเท่ากับ 1 HTTP call ต่อ batch, token ที่ขึ้นต้น 'dead' = unregistered"""
+
+    def __init__(self, latency_s: float):
+        from firebase_admin import messaging
+
+        self.latency_s = latency_s
+        self.calls = 0
+        self._unregistered = messaging.UnregisteredError("unregistered", cause=None, http_response=None)
+
+    def __call__(self, messages: list):
+        from types import SimpleNamespace
+
+        self.calls += 1
+        time.sleep(self.latency_s)
+        return SimpleNamespace(responses=[
+            SimpleNamespace(success=False, exception=self._unregistered)
+            if m.token.startswith("dead") else SimpleNamespace(success=True, exception=None)
+            for m in messages
+        ])
+
+
+def run_push(count: int, latency_ms: float, dead_pct: float, seed: int):
+    """จับเวลา fan-out: batch (send_each ทีละ 500) vs ทีละ message (เทียบจาก latency ต่อ call)"""
+    import database as db
+    import push_sender
+    from pathlib import Path
+
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = Path(os.path.join(tmp, "bench.db"))
+        db.init_db()
+        users = [f"user{i}" for i in range(count)]
+        with db.get_db() as conn:
+            conn.executemany(
+                "INSERT INTO device_tokens (user_id, fcm_token) VALUES (?, ?)",
+                [(u, f"{'dead' if rng.random() < dead_pct else 'tok'}-{u}") for u in users],
+            )
+        notifications = [(u, "📈 แจ้งเตือนหุ้น X", "X ขึ้นถึง 100 THB! (เป้า 99)") for u in users]
+
+        fake = _FakeFCM(latency_ms / 1000)
+        stats = push_sender.send_push_batch(notifications, notification_type="stock_alert", transport=fake)
+        sequential_s = count * latency_ms / 1000  # send() ทีละ token = 1 HTTP call ต่อ message
+        print(f"Push fan-out benchmark: notifications={count} latency={latency_ms}ms/call")
+        print(
+            f"  batch:      {stats['duration_s'] * 1000:9.1f}ms  calls={fake.calls}  "
+            f"sent={stats['sent']} pruned={stats['pruned']}  {stats['msgs_per_sec']:.0f} msgs/sec"
+        )
+        print(
+            f"  sequential: {sequential_s * 1000:9.1f}ms  calls={count}  (ประมาณจาก latency)  "
+            f"{count / sequential_s if sequential_s else 0:.0f} msgs/sec"
+        )
+        db.close_db_pool()
+
+
+# ==================== Message Scanner ====================
+
+SCANNER_MESSAGES = (
+    "ราคาหุ้น PTT วันนี้เป็นไงบ้าง",
+    "ptt กับ pttep ตัวไหนน่าเก็บกว่ากัน",
+    "วันนี้เหนื่อยมากเลย อยากพักผ่อน",
+    "ช่วยดู RSI ของ KBANK หน่อย แล้วก็ AAPL ด้วย",
+    "พรุ่งนี้เตือนให้ไปหาหมอตอนบ่ายสองนะ",
+    "Dow Jones ลงเยอะเมื่อคืน NVDA โดนหนักไหม",
+    # ticker ที่ขึ้นต้นด้วย keyword (SMA, SET, RSI) — ต้องยังเจอชื่อหุ้น
+    "SMAR กับ SETI ตัวไหนน่าสนใจ",
+    "RSIX และ SMALL ขึ้นแรงมาก stocks ตัวเล็ก",
+    "set กับ ptt วันนี้เป็นยังไง",
+)
+
+
+def _legacy_scan(message: str, hints: set, keywords: tuple, common: set) -> tuple[bool, list[str]]:
+    """วิธีเดิม: substring ทุก keyword + วนทุก symbol แล้ว compile regex word boundary ต่อ hit"""
+    import re
+
+    related = any(kw.lower() in message.lower() for kw in keywords)
+    symbols = []
+    msg_upper = message.upper()
+    for sym in hints:
+        if sym in msg_upper and re.search(r"\b" + re.escape(sym) + r"\b", msg_upper):
+            symbols.append(sym)
+    for sym in re.findall(r"\b([A-Z]{2,5})\b", message):
+        if sym not in common and sym not in hints and sym not in symbols:
+            symbols.append(sym)
+    return related or bool(symbols), symbols[:3]
+
+
+def scanner_mismatches(scanner, hints: set, keywords: tuple, common: set, messages) -> list[tuple]:
+    """
+    ข้อความที่ StockScanner ให้ผลต่างจากวิธีเดิม → [(message, เดิม, ใหม่)]
+    เทียบ (เกี่ยวกับหุ้นไหม, ชุดชื่อหุ้น) — วิธีเดิมวน set ของ hint จึงไม่มีลำดับที่แน่นอน
+    """
+    mismatches = []
+    for message in messages:
+        related, legacy_symbols = _legacy_scan(message, hints, keywords, common)
+        found_keywords, symbols = scanner.scan(message)
+        if related != bool(found_keywords or symbols) or set(legacy_symbols) != set(symbols[:3]):
+            mismatches.append((message, (related, sorted(legacy_symbols)), (found_keywords, symbols)))
+    return mismatches
+
+
+def run_scanner(sizes: list[int], rounds: int, seed: int):
+    """ตรวจว่าผลตรงกับวิธีเดิม แล้วจับเวลาต่อข้อความ ของวิธีเดิม vs StockScanner เมื่อรายชื่อหุ้นยาวขึ้น"""
+    import string
+    import stock_service
+
+    rng = random.Random(seed)
+    base = sorted(stock_service.THAI_STOCK_HINTS)
+    print(f"Message scanner benchmark: messages={len(SCANNER_MESSAGES)} rounds={rounds}")
+    for size in sizes:
+        hints = set(base[:size])
+        while len(hints) < size:
+            hints.add("".join(rng.choices(string.ascii_uppercase, k=rng.randint(2, 6))))
+
+        start = time.perf_counter()
+        scanner = stock_service.StockScanner(stock_service.STOCK_KEYWORDS, hints, stock_service.COMMON_WORDS)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        mismatches = scanner_mismatches(
+            scanner, hints, stock_service.STOCK_KEYWORDS, stock_service.COMMON_WORDS, SCANNER_MESSAGES,
+        )
+        assert not mismatches, f"scanner output differs from legacy (symbols={size}): {mismatches}"
+
+        timings = {}
+        for label, fn in (
+            ("legacy", lambda m: _legacy_scan(m, hints, stock_service.STOCK_KEYWORDS, stock_service.COMMON_WORDS)),
+            ("scanner", scanner.scan),
+        ):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for message in SCANNER_MESSAGES:
+                    fn(message)
+            timings[label] = (time.perf_counter() - start) / (rounds * len(SCANNER_MESSAGES)) * 1e6
+
+        print(
+            f"  symbols={size:<6} legacy={timings['legacy']:8.1f}µs/msg  "
+            f"scanner={timings['scanner']:6.1f}µs/msg  (build {build_ms:.1f}ms once)  "
+            f"speedup={timings['legacy'] / timings['scanner']:6.1f}x"
+        )
+
+
+# ==================== Conversation Summaries ====================
+
+SUMMARY_USER_MESSAGES = (
+    "วันนี้ประชุมทั้งวันเลย หัวหน้าให้แก้สไลด์ใหม่หมดตอนห้าโมงเย็น เหนื่อยมาก",
+    "แมวที่บ้านไม่ยอมกินข้าวมาสองวันแล้ว กังวลอยู่ว่าจะพาไปหาหมอดีไหม",
+    "เดือนหน้าจะไปเที่ยวเชียงใหม่กับแฟน ยังไม่ได้จองที่พักเลย มีที่ไหนแนะนำไหม",
+    "ช่วงนี้นอนไม่ค่อยหลับ ตื่นตีสามทุกคืน ไม่รู้เป็นเพราะเครียดงานหรือเปล่า",
+    "เพิ่งซื้อ PTT ไปเมื่อวาน ราคาลงเลย คิดว่าควรถือต่อหรือขายดี",
+    "สัปดาห์นี้ตั้งใจจะวิ่งให้ได้สามวัน วันนี้วิ่งไปห้ากิโลแล้ว",
+    "แม่โทรมาบอกว่าจะมาเยี่ยมวันเสาร์ ต้องทำความสะอาดห้องก่อน",
+    "อยากเปลี่ยนงานไปสาย data แต่ยังไม่แน่ใจว่าต้องเรียนอะไรเพิ่มบ้าง",
+)
+
+SUMMARY_REPLIES = (
+    "โอ้โห เหนื่อยแย่เลยนะ พักหายใจลึก ๆ ก่อน แล้วค่อยทำทีละส่วน ฟ้าเป็นกำลังใจให้นะ~",
+    "เข้าใจเลยว่ากังวล ถ้าน้องไม่กินเกินสองวัน พาไปหาหมอดีกว่านะ จะได้สบายใจ",
+    "เชียงใหม่ช่วงนั้นอากาศดีเลย ลองดูที่พักแถวนิมมานหรือแม่ริมก็ได้นะ บรรยากาศดีมาก",
+    "นอนไม่หลับนี่ทรมานจริง ลองวางมือถือก่อนนอนสักชั่วโมง แล้วจดเรื่องที่ค้างในใจไว้ก่อนนอนดูนะ",
+    "ฟ้าแนะนำให้ดูแผนที่ตั้งไว้ก่อนซื้อนะ ถ้าซื้อเพื่อปันผลระยะยาว ราคาลงวันสองวันไม่ต้องตกใจ",
+    "เก่งมาก! ห้ากิโลไม่ใช่เล่น ๆ เลย อีกสองวันสู้ ๆ นะ",
+)
+
+
+class _FakeSummaryLLM:
+    """LLM ปลอมแทน ai_brain.post_messages — summary = ข้อความผู้ใช้ใหม่ (ตัดสั้น) + ข้อเดิม ไม่เกิน SUMMARY_MAX_POINTS ข้อ"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self, payload: dict):
+        from types import SimpleNamespace
+        import conversation_summary as cs
+        import token_budget
+
+        self.calls += 1
+        content = payload["messages"][0]["content"]
+        previous, _, transcript = content.partition("\n\nบทสนทนาใหม่:\n")
+        old_points = [line for line in previous.split("\n") if line.startswith("- ")]
+        new_points = [
+            f"- {line.split(': ', 1)[1][:40]}"
+            for line in transcript.split("\n") if not line.startswith("ฟ้า: ")
+        ]
+        summary = "\n".join(list(dict.fromkeys(new_points + old_points))[:cs.SUMMARY_MAX_POINTS])
+        body = {
+            "content": [{"type": "text", "text": summary}],
+            "usage": {
+                "input_tokens": token_budget.estimate_tokens(payload["system"] + content),
+                "output_tokens": token_budget.estimate_tokens(summary),
+            },
+        }
+        return SimpleNamespace(status_code=200, text="", json=lambda: body)
+
+
+async def run_summaries(turns: int, window: int, seed: int):
+    """
+    จำลองบทสนทนา turns รอบ → prompt token ของ baseline (ประวัติดิบ window ข้อความ — เดิม /chat ใช้ 6)
+    vs summary แทนประวัติดิบ (summary + SUMMARY_KEEP_RECENT ข้อความล่าสุด) + ค่า LLM ที่ใช้สรุป
+    """
+    import database as db
+    import ai_brain
+    import conversation_summary as cs
+    from pathlib import Path
+
+    rng = random.Random(seed)
+    user_id, name = "bench-user", "ต้น"
+    memory = {"facts": ["เป็นโปรแกรมเมอร์", "มีแมวชื่อส้ม"]}
+    llm = _FakeSummaryLLM()
+    unbounded = 10 ** 9  # วัดขนาดเต็ม ไม่ให้ token_budget ตัด
+
+    def history_tokens(report: dict) -> int:
+        return report["sections"]["history"] + report["sections"]["summary"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = Path(os.path.join(tmp, "bench.db"))
+        db.init_db()
+        db.create_user(user_id, name)
+        today = time.strftime("%Y-%m-%d")
+        raw, summarized, raw_prompt, summarized_prompt = [], [], [], []
+
+        for _ in range(turns):
+            message = rng.choice(SUMMARY_USER_MESSAGES)
+            ctx = db.load_chat_context(user_id, today, **cs.history_limits())
+            *_, report = ai_brain.build_prompt(
+                message, name, "friendly", memory, ctx.recent_messages,
+                conversation_summary=ctx.conversation_summary, budget=unbounded,
+            )
+            summarized.append(history_tokens(report))
+            summarized_prompt.append(report["used"])
+
+            *_, report = ai_brain.build_prompt(
+                message, name, "friendly", memory, db.get_recent_messages(user_id, window), budget=unbounded,
+            )
+            raw.append(history_tokens(report))
+            raw_prompt.append(report["used"])
+
+            db.save_message(user_id, "user", message)
+            db.save_message(user_id, "assistant", rng.choice(SUMMARY_REPLIES))
+            # server รันใน background — ที่นี่ await ตรง ๆ ให้ผลซ้ำได้
+            if cs.should_fold(ctx.unsummarized_count + 2):
+                await cs.fold_history(user_id, name, post=llm)
+
+        state = db.get_conversation_summary(user_id)
+        db.close_db_pool()
+
+    def change(base: list[float], new: list[float]) -> float:
+        """% ที่เปลี่ยนจาก baseline (บวก = ใช้ token มากขึ้น)"""
+        return (statistics.fmean(new) / statistics.fmean(base) - 1) * 100 if statistics.fmean(base) else 0.0
+
+    stats = cs.get_summary_stats()
+    summarizer_per_turn = (stats["tokens"]["input"] + stats["tokens"]["output"]) / turns
+    print(
+        f"Conversation summary benchmark: turns={turns} window={window} "
+        f"trigger={cs.SUMMARY_TRIGGER_MESSAGES} keep={cs.SUMMARY_KEEP_RECENT} (mock LLM, est. tokens)"
+    )
+    print(
+        f"  history/turn:  raw {window:<3} msgs avg={statistics.fmean(raw):7.1f}  "
+        f"summary+recent avg={statistics.fmean(summarized):7.1f}  change={change(raw, summarized):+6.1f}%"
+    )
+    print(
+        f"  prompt/turn:   raw avg={statistics.fmean(raw_prompt):7.1f}  "
+        f"summary+recent avg={statistics.fmean(summarized_prompt):7.1f}  "
+        f"change={change(raw_prompt, summarized_prompt):+6.1f}%"
+    )
+    print(
+        f"  summarizer:    runs={stats['runs']} llm_calls={llm.calls} folded={stats['folded_messages']} msgs  "
+        f"summary={len(state['summary'])} chars  cost/turn≈{summarizer_per_turn:.0f} tokens  "
+        f"net change={change(raw_prompt, [p + summarizer_per_turn for p in summarized_prompt]):+6.1f}%"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI Friend backend benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    load = sub.add_parser("load", help="HTTP load test: p99 ของ /health และ /chat")
+    load.add_argument("--url", default="http://localhost:8000")
+    load.add_argument("--user-id", default=None, help="user_id ที่ลงทะเบียนแล้ว (ถ้าไม่ใส่จะยิงแค่ /health)")
+    load.add_argument("-c", "--concurrency", type=int, default=50)
+    load.add_argument("-n", "--requests", type=int, default=2000)
+
+    ind = sub.add_parser("indicators", help="Indicator engine: pandas ทีละ symbol vs NumPy ทั้งชุด")
+    ind.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 5000])
+    ind.add_argument("--bars", type=int, default=126, help="จำนวนแท่งต่อ symbol (126 ≈ 6 เดือน)")
+    ind.add_argument("--seed", type=int, default=42)
+
+    alerts = sub.add_parser("alerts", help="Stock alerts: วนทุกแถว vs threshold index + batch write")
+    alerts.add_argument("--alerts", type=int, default=100_000)
+    alerts.add_argument("--symbols", type=int, default=500)
+    alerts.add_argument("--seed", type=int, default=42)
+
+    push = sub.add_parser("push", help="Push fan-out: throughput ของ send_push_batch ผ่าน FCM ปลอม")
+    push.add_argument("--notifications", type=int, default=20_000)
+    push.add_argument("--latency-ms", type=float, default=80.0, help="latency ต่อ HTTP call ไป FCM")
+    push.add_argument("--dead-pct", type=float, default=0.02, help="สัดส่วน token ที่ unregistered แล้ว")
+    push.add_argument("--seed", type=int, default=42)
+
+    scan = sub.add_parser("scanner", help="Message scanner: วนทุก symbol vs regex ที่ compile ไว้")
+    scan.add_argument("--symbols", type=int, nargs="+", default=[80, 1000, 5000])
+    scan.add_argument("--rounds", type=int, default=200)
+    scan.add_argument("--seed", type=int, default=42)
+
+    summ = sub.add_parser("summaries", help="Conversation summaries: ประวัติดิบ vs summary + ข้อความล่าสุด (LLM ปลอม)")
+    summ.add_argument("--turns", type=int, default=60, help="จำนวนรอบ (ผู้ใช้ + ฟ้า = 2 ข้อความ/รอบ)")
+    summ.add_argument("--window", type=int, default=6, help="ประวัติดิบของ baseline (เดิม /chat ส่ง 6 ข้อความล่าสุด)")
+    summ.add_argument("--seed", type=int, default=42)
+
+    args = parser.parse_args()
+    if args.command == "load":
+        asyncio.run(run_load(args.url, args.user_id, args.concurrency, args.requests))
+    elif args.command == "indicators":
+        run_indicators(args.sizes, args.bars, args.seed)
+    elif args.command == "alerts":
+        run_alerts(args.alerts, args.symbols, args.seed)
+    elif args.command == "push":
+        run_push(args.notifications, args.latency_ms, args.dead_pct, args.seed)
+    elif args.command == "scanner":
+        run_scanner(args.symbols, args.rounds, args.seed)
+    elif args.command == "summaries":
+        asyncio.run(run_summaries(args.turns, args.window, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+conversation_summary.py — สรุปบทสนทนาแบบ rolling ต่อผู้ใช้ (conversation_summaries)
+ยังไม่มี summary → Claude เห็น 6 ข้อความล่าสุดเท่าเดิม (HISTORY_LIMIT)
+มี summary แล้ว → summary แทนประวัติดิบ: summary + SUMMARY_KEEP_RECENT ข้อความล่าสุดเท่านั้น
+(ข้อความที่ยังไม่ถูกพับแต่เก่ากว่านั้นหายจาก prompt จนกว่าจะพับรอบถัดไป — แลกกับการพับเป็นชุดใหญ่)
+
+ข้อความที่ยังไม่ถูกสรุปถึง SUMMARY_TRIGGER_MESSAGES → background task พับข้อความเก่า
+(เหลือ SUMMARY_KEEP_RECENT ข้อความล่าสุดไว้เป็นประวัติดิบ) รวมกับ summary เดิมเป็น summary ใหม่
+ไม่ block /chat — ระหว่างสรุป chat ใช้ summary เดิม + ข้อความดิบตามปกติ
+
+ทดสอบด้วย LLM ปลอม: python benchmark.py summaries
+"""
+
+import asyncio
+import logging
+import os
+from collections import Counter
+
+import async_db as adb
+import ai_brain
+
+logger = logging.getLogger(__name__)
+
+# ประวัติดิบที่ /chat ส่งให้ Claude ก่อนมี summary (เท่าเดิม 6 ข้อความ)
+HISTORY_LIMIT = 6
+# พับทีละชุดใหญ่ (16 ข้อความ ≈ 8 รอบ → LLM call ละ 7 รอบแชท) และเหลือ 1 รอบล่าสุดไว้เป็นประวัติดิบ
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "16"))
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "2"))
+SUMMARY_MAX_FOLD = int(os.getenv("SUMMARY_MAX_FOLD", "40"))      # ข้อความสูงสุดที่พับได้ต่อรอบ (ผู้ใช้เก่าที่มี backlog)
+SUMMARY_MAX_POINTS = int(os.getenv("SUMMARY_MAX_POINTS", "5"))   # summary ต้องสั้นกว่าประวัติดิบที่มันแทน
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "500"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+
+SUMMARY_SYSTEM_PROMPT = f"""คุณสรุปบทสนทนาระหว่างผู้ใช้กับ "ฟ้า" (AI เพื่อน) ให้ฟ้าใช้จำเรื่องที่คุยกันไปแล้ว
+รวมสรุปเดิมกับบทสนทนาใหม่เป็นสรุปเดียว:
+- เขียนเป็นข้อ ๆ ขึ้นต้นด้วย "- " ข้อละบรรทัด เรียงจากสำคัญมากไปน้อย
+- เก็บ: เรื่องที่ผู้ใช้เล่า ปัญหาที่ยังค้าง แผน/นัดหมาย หุ้นที่สนใจ สิ่งที่ฟ้าสัญญาหรือแนะนำไป
+- ตัด: คำทักทาย ข้อความที่ไม่มีเนื้อหา ราคาหุ้น ณ ตอนนั้น (ข้อมูลเก่า)
+- ไม่เกิน {SUMMARY_MAX_POINTS} ข้อ ภาษาไทยกระชับ ตอบเฉพาะสรุป ไม่ต้องมีคำนำ"""
+
+_stats = Counter()
+_in_flight: set[str] = set()
+_tasks: set[asyncio.Task] = set()  # อ้างอิง task ไว้ไม่ให้ถูก garbage collect ระหว่างรัน
+
+
+def should_fold(unsummarized_count: int) -> bool:
+    return unsummarized_count >= SUMMARY_TRIGGER_MESSAGES
+
+
+def history_limits() -> dict:
+    """message_limit ของ load_chat_context — ก่อน/หลังมี summary"""
+    return {"message_limit": HISTORY_LIMIT, "summary_message_limit": SUMMARY_KEEP_RECENT}
+
+
+def build_summary_payload(previous: str, messages: list[dict], user_name: str) -> dict:
+    """request body ของ Messages API สำหรับพับ messages เข้า summary เดิม"""
+    transcript = "\n".join(
+        f"{user_name if m['role'] == 'user' else 'ฟ้า'}: {m['content']}" for m in messages
+    )
+    return {
+        "model": ai_brain.MODEL,
+        "max_tokens": SUMMARY_MAX_TOKENS,
+        "system": SUMMARY_SYSTEM_PROMPT,
+        "messages": [{
+            "role": "user",
+            "content": f"สรุปเดิม:\n{previous or '(ยังไม่มี)'}\n\nบทสนทนาใหม่:\n{transcript}",
+        }],
+    }
+
+
+async def summarize(previous: str, messages: list[dict], user_name: str, post=None) -> str | None:
+    """
+    เรียก LLM ให้รวม summary เดิม + messages → summary ใหม่ (None ถ้า API error)
+    post: ฟังก์ชันส่ง payload (ค่าเริ่มต้น ai_brain.post_messages — benchmark ส่ง LLM ปลอมเข้ามา)
+    """
+    response = await (post or ai_brain.post_messages)(build_summary_payload(previous, messages, user_name))
+    if response.status_code != 200:
+        logger.error(f"[Summary] Claude API error {response.status_code}: {response.text[:300]}")
+        return None
+    data = response.json()
+    usage = ai_brain.record_usage(data.get("usage"))
+    _stats["input_tokens"] += usage.get("input_tokens", 0)
+    _stats["output_tokens"] += usage.get("output_tokens", 0)
+    summary = data["content"][0]["text"].strip()
+    return summary[:SUMMARY_MAX_CHARS] if summary else None
+
+
+async def fold_history(user_id: str, user_name: str, post=None) -> int:
+    """
+    พับข้อความที่ยังไม่ถูกสรุป (ยกเว้น SUMMARY_KEEP_RECENT ข้อความล่าสุด) เข้า summary
+    อ่านจากข้อความเก่าสุดที่ยังไม่สรุป ทีละไม่เกิน SUMMARY_MAX_FOLD — backlog ยาวถูกพับต่อในรอบถัดไป
+    (ข้อความครบชุดแรกยาว MAX_FOLD + KEEP_RECENT → เหลืออย่างน้อย KEEP_RECENT ข้อความล่าสุดเสมอ)
+    Returns: จำนวนข้อความที่ถูกพับ (0 = ยังไม่ถึงเกณฑ์ / สรุปไม่สำเร็จ)
+    """
+    state = await adb.get_conversation_summary(user_id)
+    messages = await adb.get_unsummarized_messages(
+        user_id, state["last_message_id"], SUMMARY_MAX_FOLD + SUMMARY_KEEP_RECENT,
+    )
+    if not should_fold(len(messages)):
+        return 0
+
+    fold = messages[:len(messages) - SUMMARY_KEEP_RECENT] if SUMMARY_KEEP_RECENT > 0 else messages
+    summary = await summarize(state["summary"], fold, user_name, post)
+    if not summary:
+        _stats["failed"] += 1
+        return 0
+
+    if not await adb.save_conversation_summary(user_id, summary, fold[-1]["id"], len(fold)):
+        _stats["stale"] += 1  # มีรอบอื่นสรุปข้อความที่ใหม่กว่าไปแล้ว
+        return 0
+    _stats["runs"] += 1
+    _stats["folded_messages"] += len(fold)
+    logger.info(f"[Summary] {user_id}: folded {len(fold)} messages → {len(summary)} chars")
+    return len(fold)
+
+
+async def _fold_in_background(user_id: str, user_name: str):
+    try:
+        await fold_history(user_id, user_name)
+    except Exception as e:
+        _stats["failed"] += 1
+        logger.error(f"[Summary] fold failed for {user_id}: {e}", exc_info=True)
+    finally:
+        _in_flight.discard(user_id)
+
+
+def schedule_fold(user_id: str, user_name: str) -> bool:
+    """เริ่มสรุปใน background (ผู้ใช้ละไม่เกิน 1 task) — Returns: True ถ้าเริ่ม task ใหม่"""
+    if user_id in _in_flight:
+        _stats["skipped_in_flight"] += 1
+        return False
+    _in_flight.add(user_id)
+    task = asyncio.create_task(_fold_in_background(user_id, user_name))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return True
+
+
+def get_summary_stats() -> dict:
+    return {
+        "trigger_messages": SUMMARY_TRIGGER_MESSAGES,
+        "keep_recent": SUMMARY_KEEP_RECENT,
+        "history_limit": HISTORY_LIMIT,
+        "in_flight": len(_in_flight),
+        "runs": _stats["runs"],
+        "folded_messages": _stats["folded_messages"],
+        "failed": _stats["failed"],
+        "stale": _stats["stale"],
+        "skipped_in_flight": _stats["skipped_in_flight"],
+        "tokens": {"input": _stats["input_tokens"], "output": _stats["output_tokens"]},
+    }
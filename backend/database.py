@@ -5,6 +5,10 @@ database.py — SQLite Database Manager
 
 import sqlite3
 import json
+import threading
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, date, timedelta
 from pathlib import Path
 from zoneinfo import ZoneInfo
@@ -14,201 +18,371 @@ BKK = ZoneInfo("Asia/Bangkok")
 DB_PATH = Path("ai_friend.db")
 
 
-def get_db():
-    """สร้าง connection ไปยัง SQLite"""
-    conn = sqlite3.connect(str(DB_PATH))
+# ==================== Connection Pool ====================
+# เปิด connection ครั้งเดียวต่อ thread แล้วใช้ซ้ำ — ไม่ต้อง connect + ตั้ง PRAGMA ใหม่ทุก query
+# (sqlite3 connection ใช้ข้าม thread ไม่ได้ จึงแยก 1 connection ต่อ thread)
+# thread จบ → ปิด connection ของมัน (finalizer บน Thread object + กวาด ident ที่ตายแล้วตอนเปิด connection ใหม่)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # อ่าน/เขียนพร้อมกันได้
+    "PRAGMA synchronous=NORMAL",     # ปลอดภัยพอสำหรับ WAL และเร็วกว่า FULL มาก
+    "PRAGMA cache_size=-16000",      # page cache ~16MB ต่อ connection
+    "PRAGMA mmap_size=134217728",    # memory-map ไฟล์ DB 128MB
+    "PRAGMA busy_timeout=5000",      # รอ lock สูงสุด 5 วินาทีแทน error ทันที
+)
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool_conns: dict[int, sqlite3.Connection] = {}  # thread id -> connection (ไว้ปิดตอน thread จบ / shutdown)
+_pool_stats = {"opened": 0, "closed": 0, "checkouts": 0}
+
+
+def _open_connection() -> sqlite3.Connection:
+    """เปิด connection ใหม่ + ตั้ง PRAGMA ครั้งเดียว"""
+    conn = sqlite3.connect(str(DB_PATH), check_same_thread=False)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")  # performance ดีขึ้น
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _release(ident: int, conn: sqlite3.Connection):
+    """ปิด connection ของ thread ที่จบแล้ว — ข้ามถ้า ident ถูก thread ใหม่ใช้ต่อ หรือ pool ปิดไปแล้ว"""
+    with _pool_lock:
+        if _pool_conns.get(ident) is not conn:
+            return
+        del _pool_conns[ident]
+    try:
+        conn.close()
+    except Exception:
+        return
+    with _pool_lock:
+        _pool_stats["closed"] += 1
+
+
+def _prune_dead_threads():
+    """ปิด connection ของ thread ที่จบไปแล้วแต่ finalizer ยังไม่ทำงาน (Thread object ยังถูกอ้างอิงอยู่)"""
+    alive = {t.ident for t in threading.enumerate()}
+    with _pool_lock:
+        dead = [(ident, conn) for ident, conn in _pool_conns.items() if ident not in alive]
+    for ident, conn in dead:
+        _release(ident, conn)
+
+
+def _thread_connection() -> sqlite3.Connection:
+    """ดึง connection ของ thread ปัจจุบัน — เปิดใหม่ถ้ายังไม่มีหรือถูกปิดไปแล้ว"""
+    ident = threading.get_ident()
+    conn = getattr(_local, "conn", None)
+    path = getattr(_local, "path", None)
+
+    with _pool_lock:
+        _pool_stats["checkouts"] += 1
+        if conn is not None and path == str(DB_PATH) and _pool_conns.get(ident) is conn:
+            return conn
+
+    _prune_dead_threads()
+    conn = _open_connection()
+    with _pool_lock:
+        stale = _pool_conns.pop(ident, None)
+        _pool_conns[ident] = conn
+        _pool_stats["opened"] += 1
+    weakref.finalize(threading.current_thread(), _release, ident, conn)
+    if stale is not None:
+        try:
+            stale.close()
+            with _pool_lock:
+                _pool_stats["closed"] += 1
+        except Exception:
+            pass
+
+    _local.conn = conn
+    _local.path = str(DB_PATH)
     return conn
 
 
+@contextmanager
+def get_db():
+    """
+    ยืม connection ของ thread นี้จาก pool
+    ใช้แบบ `with get_db() as conn:` — commit อัตโนมัติเมื่อจบ block, rollback ถ้า error
+    ซ้อนกันได้ (block ด้านในจะไม่ commit เอง ให้ block นอกสุดเป็นคน commit)
+    """
+    conn = _thread_connection()
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    try:
+        yield conn
+        if depth == 0:
+            conn.commit()
+    except BaseException:
+        if depth == 0:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth = depth
+
+
+def close_db_pool():
+    """ปิด connection ทั้งหมดใน pool — เรียกตอน server shutdown"""
+    with _pool_lock:
+        conns = list(_pool_conns.values())
+        _pool_conns.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            continue
+        with _pool_lock:
+            _pool_stats["closed"] += 1
+
+
+def get_pool_stats() -> dict:
+    """สถิติ pool — จำนวน connection ที่เปิด และสัดส่วนการใช้ซ้ำ"""
+    _prune_dead_threads()
+    with _pool_lock:
+        opened = _pool_stats["opened"]
+        checkouts = _pool_stats["checkouts"]
+        return {
+            "connections_open": len(_pool_conns),
+            "connections_opened": opened,
+            "connections_closed": _pool_stats["closed"],
+            "checkouts": checkouts,
+            "reuse_ratio": round(1 - opened / checkouts, 4) if checkouts else 0.0,
+        }
+
+
 def init_db():
     """สร้างตารางทั้งหมด — เรียกตอน server เริ่ม"""
-    conn = get_db()
-    conn.executescript("""
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            name TEXT DEFAULT '',
-            personality TEXT DEFAULT 'friendly',
-            memory TEXT DEFAULT '{}',
-            wake_time TEXT DEFAULT '07:00',
-            sleep_time TEXT DEFAULT '23:00',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        CREATE TABLE IF NOT EXISTS reminders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            message TEXT NOT NULL,
-            remind_at TIMESTAMP NOT NULL,
-            done BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id, created_at DESC);
-        CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders(user_id, remind_at);
-
-        CREATE TABLE IF NOT EXISTS moods (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            score INTEGER NOT NULL,
-            note TEXT DEFAULT '',
-            created_at DATE,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        CREATE TABLE IF NOT EXISTS routines (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            title TEXT NOT NULL,
-            time TEXT DEFAULT '',
-            points INTEGER DEFAULT 5,
-            active BOOLEAN DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        CREATE TABLE IF NOT EXISTS routine_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            routine_id INTEGER NOT NULL,
-            completed_date DATE NOT NULL,
-            points_earned INTEGER DEFAULT 0,
-            FOREIGN KEY (routine_id) REFERENCES routines(id),
-            UNIQUE(routine_id, completed_date)
-        );
-
-        CREATE TABLE IF NOT EXISTS alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            alert_type TEXT NOT NULL,
-            severity TEXT NOT NULL,
-            title TEXT NOT NULL,
-            description TEXT NOT NULL,
-            source TEXT DEFAULT '',
-            external_id TEXT DEFAULT '',
-            magnitude REAL DEFAULT 0.0,
-            location TEXT DEFAULT '',
-            url TEXT DEFAULT '',
-            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expires_at TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1,
-            UNIQUE(external_id)
-        );
-
-        CREATE INDEX IF NOT EXISTS idx_moods_user ON moods(user_id, created_at DESC);
-        CREATE INDEX IF NOT EXISTS idx_routines_user ON routines(user_id);
-        CREATE INDEX IF NOT EXISTS idx_routine_logs ON routine_logs(routine_id, completed_date);
-        CREATE INDEX IF NOT EXISTS idx_alerts_active ON alerts(is_active, fetched_at DESC);
-        CREATE INDEX IF NOT EXISTS idx_alerts_severity ON alerts(severity, is_active, fetched_at DESC);
-
-        CREATE TABLE IF NOT EXISTS device_tokens (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            fcm_token TEXT NOT NULL UNIQUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        CREATE INDEX IF NOT EXISTS idx_device_tokens_user ON device_tokens(user_id);
-
-        CREATE TABLE IF NOT EXISTS stock_watchlist (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            symbol TEXT NOT NULL,
-            display_name TEXT NOT NULL,
-            alert_type TEXT NOT NULL,
-            target_value REAL,
-            last_price REAL,
-            last_notified_at TIMESTAMP,
-            active BOOLEAN DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        );
-
-        CREATE INDEX IF NOT EXISTS idx_stock_watchlist_user ON stock_watchlist(user_id, active);
-
-        CREATE TABLE IF NOT EXISTS stock_cache (
-            symbol TEXT PRIMARY KEY,
-            name TEXT,
-            price REAL,
-            previous_close REAL,
-            change_pct REAL,
-            currency TEXT,
-            sma_20 REAL,
-            sma_50 REAL,
-            rsi_14 REAL,
-            support_30d REAL,
-            resistance_30d REAL,
-            trend TEXT,
-            pe_ratio REAL,
-            div_yield REAL,
-            sector TEXT,
-            signals_json TEXT,
-            perf_1w REAL,
-            perf_1m REAL,
-            perf_3m REAL,
-            volume_ratio REAL,
-            market_cap REAL,
-            high_52w REAL,
-            low_52w REAL,
-            volume INTEGER,
-            avg_volume_20d INTEGER,
-            industry TEXT,
-            market_state TEXT,
-            sma_200 REAL,
-            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-
-        CREATE TABLE IF NOT EXISTS market_cache (
-            index_name TEXT PRIMARY KEY,
-            symbol TEXT NOT NULL,
-            price REAL,
-            change_pct REAL,
-            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                name TEXT DEFAULT '',
+                personality TEXT DEFAULT 'friendly',
+                memory TEXT DEFAULT '{}',
+                wake_time TEXT DEFAULT '07:00',
+                sleep_time TEXT DEFAULT '23:00',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            CREATE TABLE IF NOT EXISTS reminders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                remind_at TIMESTAMP NOT NULL,
+                done BOOLEAN DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id, created_at DESC);
+            CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders(user_id, remind_at);
+
+            CREATE TABLE IF NOT EXISTS moods (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                note TEXT DEFAULT '',
+                created_at DATE,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            CREATE TABLE IF NOT EXISTS routines (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                time TEXT DEFAULT '',
+                points INTEGER DEFAULT 5,
+                active BOOLEAN DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            CREATE TABLE IF NOT EXISTS routine_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                routine_id INTEGER NOT NULL,
+                completed_date DATE NOT NULL,
+                points_earned INTEGER DEFAULT 0,
+                FOREIGN KEY (routine_id) REFERENCES routines(id),
+                UNIQUE(routine_id, completed_date)
+            );
+
+            CREATE TABLE IF NOT EXISTS alerts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                alert_type TEXT NOT NULL,
+                severity TEXT NOT NULL,
+                title TEXT NOT NULL,
+                description TEXT NOT NULL,
+                source TEXT DEFAULT '',
+                external_id TEXT DEFAULT '',
+                magnitude REAL DEFAULT 0.0,
+                location TEXT DEFAULT '',
+                url TEXT DEFAULT '',
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP,
+                is_active BOOLEAN DEFAULT 1,
+                UNIQUE(external_id)
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_moods_user ON moods(user_id, created_at DESC);
+            CREATE INDEX IF NOT EXISTS idx_routines_user ON routines(user_id);
+            CREATE INDEX IF NOT EXISTS idx_routine_logs ON routine_logs(routine_id, completed_date);
+            CREATE INDEX IF NOT EXISTS idx_alerts_active ON alerts(is_active, fetched_at DESC);
+            CREATE INDEX IF NOT EXISTS idx_alerts_severity ON alerts(severity, is_active, fetched_at DESC);
+
+            CREATE TABLE IF NOT EXISTS device_tokens (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                fcm_token TEXT NOT NULL UNIQUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_device_tokens_user ON device_tokens(user_id);
+
+            CREATE TABLE IF NOT EXISTS stock_watchlist (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                symbol TEXT NOT NULL,
+                display_name TEXT NOT NULL,
+                alert_type TEXT NOT NULL,
+                target_value REAL,
+                last_price REAL,
+                last_notified_at TIMESTAMP,
+                active BOOLEAN DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_stock_watchlist_user ON stock_watchlist(user_id, active);
+            CREATE INDEX IF NOT EXISTS idx_stock_watchlist_symbol ON stock_watchlist(symbol, active);
+
+            CREATE TABLE IF NOT EXISTS stock_cache (
+                symbol TEXT PRIMARY KEY,
+                name TEXT,
+                price REAL,
+                previous_close REAL,
+                change_pct REAL,
+                currency TEXT,
+                sma_20 REAL,
+                sma_50 REAL,
+                rsi_14 REAL,
+                support_30d REAL,
+                resistance_30d REAL,
+                trend TEXT,
+                pe_ratio REAL,
+                div_yield REAL,
+                sector TEXT,
+                signals_json TEXT,
+                perf_1w REAL,
+                perf_1m REAL,
+                perf_3m REAL,
+                volume_ratio REAL,
+                market_cap REAL,
+                high_52w REAL,
+                low_52w REAL,
+                volume INTEGER,
+                avg_volume_20d INTEGER,
+                industry TEXT,
+                market_state TEXT,
+                sma_200 REAL,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE TABLE IF NOT EXISTS market_cache (
+                index_name TEXT PRIMARY KEY,
+                symbol TEXT NOT NULL,
+                price REAL,
+                change_pct REAL,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+
+            CREATE TABLE IF NOT EXISTS user_streaks (
+                user_id TEXT PRIMARY KEY,
+                current_streak INTEGER DEFAULT 0,
+                last_active_date DATE,
+                total_points INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            -- สรุปบทสนทนาแบบ rolling — ข้อความที่ id <= last_message_id ถูกพับเข้า summary แล้ว
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                last_message_id INTEGER NOT NULL DEFAULT 0,
+                folded_messages INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            );
+
+            -- แท่งราคารายวัน (OHLCV) — เก็บย้อนหลังไว้ แล้ว fetch แค่ส่วนท้ายที่ขาด
+            CREATE TABLE IF NOT EXISTS price_bars (
+                symbol TEXT NOT NULL,
+                date TEXT NOT NULL,
+                open REAL,
+                high REAL,
+                low REAL,
+                close REAL NOT NULL,
+                volume INTEGER,
+                PRIMARY KEY (symbol, date)
+            ) WITHOUT ROWID;
+        """)
+
+        # reminder ซ้ำ (user + ข้อความ + เวลา) ไม่ได้ — retry ของ side effect ต้องไม่เพิ่มแถว/push ซ้ำ
+        # DB เก่าอาจมีแถวซ้ำอยู่แล้ว → เก็บแถวแรกไว้ก่อนสร้าง unique index ครั้งแรก
+        if not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_reminders_unique'"
+        ).fetchone():
+            conn.execute(
+                """DELETE FROM reminders WHERE id NOT IN (
+                       SELECT MIN(id) FROM reminders GROUP BY user_id, message, remind_at)"""
+            )
+            conn.execute("CREATE UNIQUE INDEX idx_reminders_unique ON reminders(user_id, message, remind_at)")
+
+        # ตาราง user_streaks เพิ่งสร้าง แต่มี log เก่าอยู่แล้ว → backfill ครั้งแรก
+        has_streaks = conn.execute("SELECT 1 FROM user_streaks LIMIT 1").fetchone()
+        has_logs = conn.execute("SELECT 1 FROM routine_logs LIMIT 1").fetchone()
+    if has_logs and not has_streaks:
+        rebuilt = rebuild_user_streaks()
+        print(f"[OK] Backfilled user_streaks for {rebuilt} users")
 
 
 # ==================== User ====================
 
 def create_user(user_id: str, name: str, personality: str = "friendly") -> dict:
     """สร้างผู้ใช้ใหม่"""
-    conn = get_db()
-    memory = json.dumps({
-        "name": name,
-        "interests": [],
-        "goals": [],
-        "important_events": [],
-        "facts": []
-    }, ensure_ascii=False)
+    with get_db() as conn:
+        memory = json.dumps({
+            "name": name,
+            "interests": [],
+            "goals": [],
+            "important_events": [],
+            "facts": []
+        }, ensure_ascii=False)
 
-    conn.execute(
-        "INSERT OR IGNORE INTO users (id, name, personality, memory) VALUES (?, ?, ?, ?)",
-        (user_id, name, personality, memory)
-    )
-    conn.commit()
-    conn.close()
+        conn.execute(
+            "INSERT OR IGNORE INTO users (id, name, personality, memory) VALUES (?, ?, ?, ?)",
+            (user_id, name, personality, memory)
+        )
     return {"user_id": user_id, "name": name, "personality": personality}
 
 
 def get_user(user_id: str) -> dict | None:
     """ดึงข้อมูลผู้ใช้"""
-    conn = get_db()
-    row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
     if row:
         return dict(row)
     return None
@@ -216,13 +390,11 @@ def get_user(user_id: str) -> dict | None:
 
 def update_user_memory(user_id: str, memory: dict):
     """อัพเดท memory ของผู้ใช้"""
-    conn = get_db()
-    conn.execute(
-        "UPDATE users SET memory = ?, last_active = ? WHERE id = ?",
-        (json.dumps(memory, ensure_ascii=False), datetime.now(BKK).isoformat(), user_id)
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE users SET memory = ?, last_active = ? WHERE id = ?",
+            (json.dumps(memory, ensure_ascii=False), datetime.now(BKK).isoformat(), user_id)
+        )
 
 
 def update_user_field(user_id: str, field: str, value: str):
@@ -230,103 +402,135 @@ def update_user_field(user_id: str, field: str, value: str):
     allowed_fields = {"name", "personality", "wake_time", "sleep_time"}
     if field not in allowed_fields:
         return
-    conn = get_db()
-    conn.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
 
 
 # ==================== Messages ====================
 
 def save_message(user_id: str, role: str, content: str):
     """บันทึกข้อความ"""
-    conn = get_db()
-    conn.execute(
-        "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
-        (user_id, role, content)
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+            (user_id, role, content)
+        )
 
 
 def get_recent_messages(user_id: str, limit: int = 6) -> list[dict]:
     """ดึงแชทล่าสุด (ส่งให้ AI เป็น context)"""
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT role, content, created_at FROM messages WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-        (user_id, limit)
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT role, content, created_at FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
     # reverse เพื่อให้เรียงจากเก่า → ใหม่
     return [dict(r) for r in reversed(rows)]
 
 
+# ==================== Conversation Summaries ====================
+
+def get_conversation_summary(user_id: str) -> dict:
+    """สรุปบทสนทนาล่าสุด — ยังไม่เคยสรุป = summary ว่าง, last_message_id 0"""
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT summary, last_message_id, folded_messages, updated_at FROM conversation_summaries WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+    if row:
+        return dict(row)
+    return {"summary": "", "last_message_id": 0, "folded_messages": 0, "updated_at": None}
+
+
+def get_unsummarized_messages(user_id: str, after_id: int, limit: int = 50) -> list[dict]:
+    """ข้อความที่ยังไม่ถูกพับเข้า summary — limit ข้อความแรกต่อจาก after_id (เรียงเก่า → ใหม่)"""
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT id, role, content FROM messages WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (user_id, after_id, limit)
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def save_conversation_summary(user_id: str, summary: str, last_message_id: int, folded: int) -> bool:
+    """
+    บันทึก summary ใหม่ — ไม่ทับ summary ที่ครอบคลุมข้อความใหม่กว่าแล้ว
+    Returns: True ถ้าบันทึก
+    """
+    with get_db() as conn:
+        cur = conn.execute(
+            """INSERT INTO conversation_summaries (user_id, summary, last_message_id, folded_messages, updated_at)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(user_id) DO UPDATE SET
+                   summary = excluded.summary,
+                   last_message_id = excluded.last_message_id,
+                   folded_messages = conversation_summaries.folded_messages + excluded.folded_messages,
+                   updated_at = excluded.updated_at
+               WHERE excluded.last_message_id > conversation_summaries.last_message_id""",
+            (user_id, summary, last_message_id, folded, datetime.now(BKK).isoformat())
+        )
+    return cur.rowcount > 0
+
+
 # ==================== Reminders ====================
 
-def add_reminder(user_id: str, message: str, remind_at: str):
-    """เพิ่ม reminder"""
-    conn = get_db()
-    conn.execute(
-        "INSERT INTO reminders (user_id, message, remind_at) VALUES (?, ?, ?)",
-        (user_id, message, remind_at)
-    )
-    conn.commit()
-    conn.close()
+def add_reminder(user_id: str, message: str, remind_at: str) -> bool:
+    """เพิ่ม reminder — return False ถ้ามี reminder เดียวกัน (ข้อความ + เวลา) อยู่แล้ว"""
+    with get_db() as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO reminders (user_id, message, remind_at) VALUES (?, ?, ?)",
+            (user_id, message, remind_at)
+        )
+    return cursor.rowcount > 0
 
 
 def get_pending_reminders(user_id: str) -> list[dict]:
     """ดึง reminder ที่ยังไม่เสร็จ"""
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM reminders WHERE user_id = ? AND done = 0 ORDER BY remind_at",
-        (user_id,)
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT * FROM reminders WHERE user_id = ? AND done = 0 ORDER BY remind_at",
+            (user_id,)
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def mark_reminder_done(reminder_id: int):
     """ทำเครื่องหมายว่า reminder เสร็จแล้ว"""
-    conn = get_db()
-    conn.execute("UPDATE reminders SET done = 1 WHERE id = ?", (reminder_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("UPDATE reminders SET done = 1 WHERE id = ?", (reminder_id,))
 
 
 # ==================== Moods ====================
 
 def save_mood(user_id: str, score: int, note: str = ""):
     """บันทึกอารมณ์ (แทนที่ค่าเดิมถ้าบันทึกวันเดียวกัน)"""
-    conn = get_db()
-    today = datetime.now(BKK).date().isoformat()
-    existing = conn.execute(
-        "SELECT id FROM moods WHERE user_id = ? AND created_at = ?",
-        (user_id, today)
-    ).fetchone()
+    with get_db() as conn:
+        today = datetime.now(BKK).date().isoformat()
+        existing = conn.execute(
+            "SELECT id FROM moods WHERE user_id = ? AND created_at = ?",
+            (user_id, today)
+        ).fetchone()
 
-    if existing:
-        conn.execute(
-            "UPDATE moods SET score = ?, note = ? WHERE id = ?",
-            (score, note, existing["id"])
-        )
-    else:
-        conn.execute(
-            "INSERT INTO moods (user_id, score, note, created_at) VALUES (?, ?, ?, ?)",
-            (user_id, score, note, today)
-        )
-    conn.commit()
-    conn.close()
+        if existing:
+            conn.execute(
+                "UPDATE moods SET score = ?, note = ? WHERE id = ?",
+                (score, note, existing["id"])
+            )
+        else:
+            conn.execute(
+                "INSERT INTO moods (user_id, score, note, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, score, note, today)
+            )
 
 
 def get_mood_history(user_id: str, days: int = 7) -> list[dict]:
     """ดึงประวัติอารมณ์ย้อนหลัง"""
-    conn = get_db()
-    since = (datetime.now(BKK).date() - timedelta(days=days)).isoformat()
-    rows = conn.execute(
-        "SELECT score, note, created_at FROM moods WHERE user_id = ? AND created_at >= ? ORDER BY created_at",
-        (user_id, since)
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        since = (datetime.now(BKK).date() - timedelta(days=days)).isoformat()
+        rows = conn.execute(
+            "SELECT score, note, created_at FROM moods WHERE user_id = ? AND created_at >= ? ORDER BY created_at",
+            (user_id, since)
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
@@ -334,101 +538,279 @@ def get_mood_history(user_id: str, days: int = 7) -> list[dict]:
 
 def create_routine(user_id: str, title: str, time: str = "", points: int = 5) -> int:
     """สร้างกิจวัตรใหม่"""
-    conn = get_db()
-    cursor = conn.execute(
-        "INSERT INTO routines (user_id, title, time, points) VALUES (?, ?, ?, ?)",
-        (user_id, title, time, points)
-    )
-    routine_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.execute(
+            "INSERT INTO routines (user_id, title, time, points) VALUES (?, ?, ?, ?)",
+            (user_id, title, time, points)
+        )
+        routine_id = cursor.lastrowid
     return routine_id
 
 
 def get_routines(user_id: str) -> list[dict]:
     """ดึงกิจวัตรที่ active"""
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM routines WHERE user_id = ? AND active = 1 ORDER BY time, id",
-        (user_id,)
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT * FROM routines WHERE user_id = ? AND active = 1 ORDER BY time, id",
+            (user_id,)
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def is_routine_done_today(routine_id: int, today: str) -> bool:
     """เช็คว่ากิจวัตรนี้ทำแล้ววันนี้หรือยัง"""
-    conn = get_db()
-    row = conn.execute(
-        "SELECT id FROM routine_logs WHERE routine_id = ? AND completed_date = ?",
-        (routine_id, today)
-    ).fetchone()
-    conn.close()
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT id FROM routine_logs WHERE routine_id = ? AND completed_date = ?",
+            (routine_id, today)
+        ).fetchone()
     return row is not None
 
 
 def complete_routine(routine_id: int, today: str) -> int:
     """เช็คกิจวัตรว่าทำแล้ว → return points earned"""
-    conn = get_db()
-    routine = conn.execute("SELECT points FROM routines WHERE id = ?", (routine_id,)).fetchone()
-    if not routine:
-        conn.close()
-        return 0
+    with get_db() as conn:
+        routine = conn.execute("SELECT user_id, points FROM routines WHERE id = ?", (routine_id,)).fetchone()
+        if not routine:
+            return 0
 
-    points = routine["points"]
-    try:
-        conn.execute(
-            "INSERT INTO routine_logs (routine_id, completed_date, points_earned) VALUES (?, ?, ?)",
-            (routine_id, today, points)
-        )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass  # already done today
-    conn.close()
+        points = routine["points"]
+        try:
+            conn.execute(
+                "INSERT INTO routine_logs (routine_id, completed_date, points_earned) VALUES (?, ?, ?)",
+                (routine_id, today, points)
+            )
+        except sqlite3.IntegrityError:
+            return points  # already done today
+
+        # อัพเดท streak ใน transaction เดียวกับ log
+        _bump_user_streak(conn, routine["user_id"], today, points)
     return points
 
 
 def delete_routine(routine_id: int):
     """ลบกิจวัตร (soft delete)"""
-    conn = get_db()
-    conn.execute("UPDATE routines SET active = 0 WHERE id = ?", (routine_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("UPDATE routines SET active = 0 WHERE id = ?", (routine_id,))
 
 
 # ==================== Stats ====================
 
-def get_user_stats(user_id: str) -> dict:
-    """คำนวณ streak และ total points"""
-    conn = get_db()
+def _query_user_stats(conn: sqlite3.Connection, user_id: str, today: str) -> dict:
+    """อ่าน streak + total points จาก user_streaks (แถวเดียว)"""
+    row = conn.execute(
+        "SELECT current_streak, last_active_date, total_points FROM user_streaks WHERE user_id = ?",
+        (user_id,)
+    ).fetchone()
+    if not row:
+        return {"streak": 0, "total_points": 0}
+
+    # Streak นับจากวันนี้ย้อนหลัง — ถ้าวันนี้ (เวลาไทย) ยังไม่ได้ทำกิจวัตร streak = 0
+    streak = row["current_streak"] if row["last_active_date"] == today else 0
+    return {"streak": streak, "total_points": row["total_points"] or 0}
 
-    # Total points
+
+def _bump_user_streak(conn: sqlite3.Connection, user_id: str, day: str, points: int):
+    """อัพเดท user_streaks หลังทำกิจวัตรสำเร็จ 1 รายการ (เรียกใน transaction เดียวกับ routine_logs)"""
     row = conn.execute(
-        "SELECT COALESCE(SUM(rl.points_earned), 0) as total FROM routine_logs rl "
-        "JOIN routines r ON rl.routine_id = r.id WHERE r.user_id = ?",
+        "SELECT current_streak, last_active_date FROM user_streaks WHERE user_id = ?",
         (user_id,)
     ).fetchone()
-    total_points = row["total"] if row else 0
 
-    # Streak: นับวันต่อเนื่องที่ทำกิจวัตรอย่างน้อย 1 อย่าง
-    streak = 0
-    check_date = datetime.now(BKK).date()
-    while True:
-        date_str = check_date.isoformat()
-        row = conn.execute(
-            "SELECT COUNT(*) as cnt FROM routine_logs rl "
-            "JOIN routines r ON rl.routine_id = r.id "
-            "WHERE r.user_id = ? AND rl.completed_date = ?",
-            (user_id, date_str)
+    streak, last_active = 1, day
+    if row and row["last_active_date"]:
+        last = row["last_active_date"]
+        prev_day = (date.fromisoformat(day) - timedelta(days=1)).isoformat()
+        if last == day or last > day:
+            # วันเดียวกัน (หรือ log ย้อนหลัง) → streak เท่าเดิม
+            streak, last_active = row["current_streak"], last
+        elif last == prev_day:
+            streak = row["current_streak"] + 1
+
+    conn.execute(
+        """INSERT INTO user_streaks (user_id, current_streak, last_active_date, total_points, updated_at)
+           VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(user_id) DO UPDATE SET
+               current_streak = excluded.current_streak,
+               last_active_date = excluded.last_active_date,
+               total_points = user_streaks.total_points + excluded.total_points,
+               updated_at = excluded.updated_at""",
+        (user_id, streak, last_active, points, datetime.now(BKK).isoformat()),
+    )
+
+
+def rebuild_user_streaks() -> int:
+    """
+    สร้างตาราง user_streaks ใหม่ทั้งหมดจาก routine_logs (one-shot backfill)
+    streak = จำนวนวันต่อเนื่องที่จบที่วันล่าสุดที่ทำกิจวัตร — return จำนวนผู้ใช้
+    """
+    with get_db() as conn:
+        conn.execute("DELETE FROM user_streaks")
+        conn.execute(
+            """WITH days AS (
+                   SELECT DISTINCT r.user_id, rl.completed_date AS d FROM routine_logs rl
+                   JOIN routines r ON rl.routine_id = r.id
+               ),
+               ranked AS (
+                   SELECT user_id, d,
+                          ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY d DESC) AS rn,
+                          MAX(d) OVER (PARTITION BY user_id) AS last_d
+                   FROM days
+               ),
+               streaks AS (
+                   SELECT user_id, last_d, COUNT(*) AS streak FROM ranked
+                   WHERE julianday(last_d) - julianday(d) = rn - 1
+                   GROUP BY user_id, last_d
+               ),
+               points AS (
+                   SELECT r.user_id, COALESCE(SUM(rl.points_earned), 0) AS total FROM routine_logs rl
+                   JOIN routines r ON rl.routine_id = r.id
+                   GROUP BY r.user_id
+               )
+               INSERT INTO user_streaks (user_id, current_streak, last_active_date, total_points, updated_at)
+               SELECT s.user_id, s.streak, s.last_d, p.total, ?
+               FROM streaks s JOIN points p ON p.user_id = s.user_id""",
+            (datetime.now(BKK).isoformat(),),
+        )
+        count = conn.execute("SELECT COUNT(*) AS cnt FROM user_streaks").fetchone()["cnt"]
+    return count
+
+
+def get_user_stats(user_id: str) -> dict:
+    """คำนวณ streak และ total points"""
+    today = datetime.now(BKK).date().isoformat()
+    with get_db() as conn:
+        return _query_user_stats(conn, user_id, today)
+
+
+# ==================== Chat Context (โหลดรวดเดียว) ====================
+
+@dataclass
+class ChatContext:
+    """ข้อมูลทั้งหมดของผู้ใช้ที่ /chat และ brief ต้องใช้ — โหลดจาก connection เดียว"""
+    user: dict
+    mood_history: list[dict] = field(default_factory=list)
+    routines: list[dict] = field(default_factory=list)  # มี key done_today เพิ่ม
+    pending_reminders: list[dict] = field(default_factory=list)
+    streak: int = 0
+    total_points: int = 0
+    recent_messages: list[dict] = field(default_factory=list)  # เฉพาะที่ยังไม่ถูกพับเข้า summary
+    critical_alerts: list[dict] = field(default_factory=list)
+    conversation_summary: str = ""
+    unsummarized_count: int = 0
+
+    def to_user_context(self) -> dict:
+        """แปลงเป็น user_context dict ที่ ai_brain ใช้"""
+        return {
+            "wake_time": self.user.get("wake_time", "07:00"),
+            "sleep_time": self.user.get("sleep_time", "23:00"),
+            "mood_history": self.mood_history,
+            "routine_status": [
+                {
+                    "title": r["title"],
+                    "time": r.get("time", ""),
+                    "done": r["done_today"],
+                    "points": r["points"],
+                }
+                for r in self.routines
+            ],
+            "pending_reminders": self.pending_reminders,
+            "streak": self.streak,
+            "total_points": self.total_points,
+            "critical_alerts": self.critical_alerts,
+        }
+
+
+def load_chat_context(
+    user_id: str,
+    today: str,
+    mood_days: int = 7,
+    message_limit: int = 6,
+    alert_hours: int = 6,
+    summary_message_limit: int | None = None,
+) -> ChatContext | None:
+    """
+    โหลด context ทั้งหมดของผู้ใช้ใน connection เดียว ด้วย query จำนวนคงที่
+    (ไม่ขึ้นกับจำนวนกิจวัตร) — return None ถ้าไม่พบผู้ใช้
+    today: วันที่ตามเวลาไทย รูปแบบ YYYY-MM-DD
+    summary_message_limit: จำนวนข้อความดิบเมื่อมี summary แล้ว (None = message_limit)
+    """
+    since_mood = (date.fromisoformat(today) - timedelta(days=mood_days)).isoformat()
+    now = datetime.now(BKK)
+    since_alert = (now - timedelta(hours=alert_hours)).isoformat()
+
+    with get_db() as conn:
+        user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        if not user:
+            return None
+
+        moods = conn.execute(
+            "SELECT score, note, created_at FROM moods WHERE user_id = ? AND created_at >= ? ORDER BY created_at",
+            (user_id, since_mood)
+        ).fetchall()
+
+        # กิจวัตร + สถานะวันนี้ใน query เดียว (แทน is_routine_done_today ทีละตัว)
+        routines = conn.execute(
+            """SELECT r.*, (rl.id IS NOT NULL) AS done_today FROM routines r
+               LEFT JOIN routine_logs rl
+                 ON rl.routine_id = r.id AND rl.completed_date = ?
+               WHERE r.user_id = ? AND r.active = 1
+               ORDER BY r.time, r.id""",
+            (today, user_id)
+        ).fetchall()
+
+        reminders = conn.execute(
+            "SELECT * FROM reminders WHERE user_id = ? AND done = 0 ORDER BY remind_at",
+            (user_id,)
+        ).fetchall()
+
+        stats = _query_user_stats(conn, user_id, today)
+
+        # ประวัติแชท = summary + ข้อความหลังจากที่ summary ครอบคลุม
+        summary = conn.execute(
+            "SELECT summary, last_message_id FROM conversation_summaries WHERE user_id = ?",
+            (user_id,)
         ).fetchone()
-        if row and row["cnt"] > 0:
-            streak += 1
-            check_date -= timedelta(days=1)
-        else:
-            break
+        after_id = summary["last_message_id"] if summary else 0
+        if summary and summary_message_limit is not None:
+            message_limit = summary_message_limit
+        messages = conn.execute(
+            "SELECT role, content, created_at FROM messages WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
+            (user_id, after_id, message_limit)
+        ).fetchall()
+        unsummarized = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE user_id = ? AND id > ?",
+            (user_id, after_id)
+        ).fetchone()[0]
+
+        alerts = conn.execute(
+            """SELECT * FROM alerts
+               WHERE severity = 'critical'
+                 AND is_active = 1
+                 AND fetched_at >= ?
+                 AND (expires_at IS NULL OR expires_at > ?)
+               ORDER BY fetched_at DESC LIMIT 3""",
+            (since_alert, now.isoformat()),
+        ).fetchall()
 
-    conn.close()
-    return {"streak": streak, "total_points": total_points}
+    routine_rows = []
+    for r in routines:
+        d = dict(r)
+        d["done_today"] = bool(d["done_today"])
+        routine_rows.append(d)
+
+    return ChatContext(
+        user=dict(user),
+        mood_history=[dict(r) for r in moods],
+        routines=routine_rows,
+        pending_reminders=[dict(r) for r in reminders],
+        streak=stats["streak"],
+        total_points=stats["total_points"],
+        recent_messages=[dict(r) for r in reversed(messages)],
+        critical_alerts=[dict(r) for r in alerts],
+        conversation_summary=summary["summary"] if summary else "",
+        unsummarized_count=unsummarized,
+    )
 
 
 # ==================== Alerts ====================
@@ -446,9 +828,8 @@ def save_alert(
     expires_hours: int = 24,
 ) -> bool:
     """บันทึก alert ใหม่ — return True ถ้า insert สำเร็จ, False ถ้าซ้ำ"""
-    conn = get_db()
     expires_at = (datetime.now(BKK) + timedelta(hours=expires_hours)).isoformat()
-    try:
+    with get_db() as conn:
         cursor = conn.execute(
             """INSERT OR IGNORE INTO alerts
                (alert_type, severity, title, description, source,
@@ -457,102 +838,115 @@ def save_alert(
             (alert_type, severity, title, description, source,
              external_id, magnitude, location, url, expires_at),
         )
-        conn.commit()
         return cursor.rowcount > 0
-    finally:
-        conn.close()
 
 
 def get_active_alerts(severity: str | None = None, limit: int = 20) -> list[dict]:
     """ดึง alerts ที่ยังไม่หมดอายุ เรียงจากใหม่สุด"""
-    conn = get_db()
-    now = datetime.now(BKK).isoformat()
-    if severity:
-        rows = conn.execute(
-            """SELECT * FROM alerts
-               WHERE is_active = 1
-                 AND (expires_at IS NULL OR expires_at > ?)
-                 AND severity = ?
-               ORDER BY fetched_at DESC LIMIT ?""",
-            (now, severity, limit),
-        ).fetchall()
-    else:
-        rows = conn.execute(
-            """SELECT * FROM alerts
-               WHERE is_active = 1
-                 AND (expires_at IS NULL OR expires_at > ?)
-               ORDER BY fetched_at DESC LIMIT ?""",
-            (now, limit),
-        ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        now = datetime.now(BKK).isoformat()
+        if severity:
+            rows = conn.execute(
+                """SELECT * FROM alerts
+                   WHERE is_active = 1
+                     AND (expires_at IS NULL OR expires_at > ?)
+                     AND severity = ?
+                   ORDER BY fetched_at DESC LIMIT ?""",
+                (now, severity, limit),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """SELECT * FROM alerts
+                   WHERE is_active = 1
+                     AND (expires_at IS NULL OR expires_at > ?)
+                   ORDER BY fetched_at DESC LIMIT ?""",
+                (now, limit),
+            ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_latest_critical_alerts(hours_back: int = 6) -> list[dict]:
     """ดึงเฉพาะ critical alerts ใน X ชั่วโมงที่ผ่านมา — ใช้ใน chat context"""
-    conn = get_db()
-    since = (datetime.now(BKK) - timedelta(hours=hours_back)).isoformat()
-    now = datetime.now(BKK).isoformat()
-    rows = conn.execute(
-        """SELECT * FROM alerts
-           WHERE severity = 'critical'
-             AND is_active = 1
-             AND fetched_at >= ?
-             AND (expires_at IS NULL OR expires_at > ?)
-           ORDER BY fetched_at DESC LIMIT 3""",
-        (since, now),
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        since = (datetime.now(BKK) - timedelta(hours=hours_back)).isoformat()
+        now = datetime.now(BKK).isoformat()
+        rows = conn.execute(
+            """SELECT * FROM alerts
+               WHERE severity = 'critical'
+                 AND is_active = 1
+                 AND fetched_at >= ?
+                 AND (expires_at IS NULL OR expires_at > ?)
+               ORDER BY fetched_at DESC LIMIT 3""",
+            (since, now),
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def expire_old_alerts():
     """Mark expired alerts เป็น is_active=0"""
-    conn = get_db()
-    now = datetime.now(BKK).isoformat()
-    conn.execute(
-        "UPDATE alerts SET is_active = 0 WHERE expires_at < ? AND is_active = 1",
-        (now,),
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        now = datetime.now(BKK).isoformat()
+        conn.execute(
+            "UPDATE alerts SET is_active = 0 WHERE expires_at < ? AND is_active = 1",
+            (now,),
+        )
 
 
 # ==================== Device Tokens (FCM) ====================
 
 def save_device_token(user_id: str, fcm_token: str):
     """บันทึก FCM token — ถ้ามีอยู่แล้วจะอัพเดท user_id"""
-    conn = get_db()
-    now = datetime.now(BKK).isoformat()
-    conn.execute(
-        """INSERT INTO device_tokens (user_id, fcm_token, updated_at)
-           VALUES (?, ?, ?)
-           ON CONFLICT(fcm_token) DO UPDATE SET
-               user_id = excluded.user_id,
-               updated_at = excluded.updated_at""",
-        (user_id, fcm_token, now),
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        now = datetime.now(BKK).isoformat()
+        conn.execute(
+            """INSERT INTO device_tokens (user_id, fcm_token, updated_at)
+               VALUES (?, ?, ?)
+               ON CONFLICT(fcm_token) DO UPDATE SET
+                   user_id = excluded.user_id,
+                   updated_at = excluded.updated_at""",
+            (user_id, fcm_token, now),
+        )
 
 
 def get_user_fcm_tokens(user_id: str) -> list[str]:
     """ดึง FCM tokens ทั้งหมดของผู้ใช้"""
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT fcm_token FROM device_tokens WHERE user_id = ?",
-        (user_id,),
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT fcm_token FROM device_tokens WHERE user_id = ?",
+            (user_id,),
+        ).fetchall()
     return [r["fcm_token"] for r in rows]
 
 
 def delete_fcm_token(fcm_token: str):
     """ลบ token ที่ใช้ไม่ได้แล้ว (expired/unregistered)"""
-    conn = get_db()
-    conn.execute("DELETE FROM device_tokens WHERE fcm_token = ?", (fcm_token,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("DELETE FROM device_tokens WHERE fcm_token = ?", (fcm_token,))
+
+
+def get_fcm_tokens_for_users(user_ids: list[str]) -> dict[str, list[str]]:
+    """ดึง FCM tokens ของหลาย user ใน query เดียว → {user_id: [token, ...]} (user ที่ไม่มี token จะไม่อยู่ใน dict)"""
+    result: dict[str, list[str]] = {}
+    unique_ids = list(dict.fromkeys(user_ids))
+    with get_db() as conn:
+        for chunk in _chunks(unique_ids):
+            rows = conn.execute(
+                f"SELECT user_id, fcm_token FROM device_tokens WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            for r in rows:
+                result.setdefault(r["user_id"], []).append(r["fcm_token"])
+    return result
+
+
+def delete_fcm_tokens(fcm_tokens: list[str]) -> int:
+    """ลบ token ที่ใช้ไม่ได้แล้วหลายตัวใน transaction เดียว — return จำนวนที่ลบ"""
+    if not fcm_tokens:
+        return 0
+    with get_db() as conn:
+        return conn.executemany(
+            "DELETE FROM device_tokens WHERE fcm_token = ?", [(t,) for t in fcm_tokens]
+        ).rowcount
 
 
 # ==================== Stock Watchlist ====================
@@ -560,111 +954,134 @@ def delete_fcm_token(fcm_token: str):
 def add_stock_alert(user_id: str, symbol: str, display_name: str,
                     alert_type: str, target_value: float) -> int:
     """เพิ่มหุ้นเข้า watchlist — return id"""
-    conn = get_db()
-    cursor = conn.execute(
-        """INSERT INTO stock_watchlist
-           (user_id, symbol, display_name, alert_type, target_value)
-           VALUES (?, ?, ?, ?, ?)""",
-        (user_id, symbol, display_name, alert_type, target_value),
-    )
-    alert_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cursor = conn.execute(
+            """INSERT INTO stock_watchlist
+               (user_id, symbol, display_name, alert_type, target_value)
+               VALUES (?, ?, ?, ?, ?)""",
+            (user_id, symbol, display_name, alert_type, target_value),
+        )
+        alert_id = cursor.lastrowid
     return alert_id
 
 
 def get_user_stock_alerts(user_id: str) -> list[dict]:
     """ดึง watchlist ของ user"""
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM stock_watchlist WHERE user_id = ? AND active = 1 ORDER BY created_at DESC",
-        (user_id,),
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT * FROM stock_watchlist WHERE user_id = ? AND active = 1 ORDER BY created_at DESC",
+            (user_id,),
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def get_all_active_stock_alerts() -> list[dict]:
     """ดึง stock alerts ทั้งหมดที่ active — สำหรับ scheduler"""
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM stock_watchlist WHERE active = 1"
-    ).fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT * FROM stock_watchlist WHERE active = 1"
+        ).fetchall()
     return [dict(r) for r in rows]
 
 
 def update_stock_price(alert_id: int, price: float):
     """อัพเดทราคาล่าสุด"""
-    conn = get_db()
-    conn.execute(
-        "UPDATE stock_watchlist SET last_price = ? WHERE id = ?",
-        (price, alert_id),
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE stock_watchlist SET last_price = ? WHERE id = ?",
+            (price, alert_id),
+        )
 
 
 def mark_stock_notified(alert_id: int):
     """บันทึกว่าแจ้งเตือนแล้ว"""
-    conn = get_db()
+    with get_db() as conn:
+        now = datetime.now(BKK).isoformat()
+        conn.execute(
+            "UPDATE stock_watchlist SET last_notified_at = ? WHERE id = ?",
+            (now, alert_id),
+        )
+
+
+def get_stock_watchlist_fingerprint() -> tuple[int, int]:
+    """(จำนวน alert ที่ active, id ล่าสุด) — เปลี่ยนทุกครั้งที่เพิ่ม/ลบ alert (ใช้เช็คว่าต้องโหลด watchlist ใหม่ไหม)"""
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*), COALESCE(MAX(id), 0) FROM stock_watchlist WHERE active = 1"
+        ).fetchone()
+    return row[0], row[1]
+
+
+def update_stock_alert_state(prices: list[tuple[str, float]], notified_ids: list[int]) -> tuple[int, int]:
+    """
+    บันทึกผลรอบเช็ค stock alerts ใน transaction เดียว
+    prices: [(symbol, price), ...] — อัพเดท last_price ทุก alert ของ symbol นั้น (เฉพาะแถวที่ราคาเปลี่ยน)
+    notified_ids: alert id ที่เพิ่งแจ้งเตือน → last_notified_at = ตอนนี้
+    Returns: (แถวที่อัพเดทราคา, แถวที่ mark notified)
+    """
+    if not prices and not notified_ids:
+        return 0, 0
     now = datetime.now(BKK).isoformat()
-    conn.execute(
-        "UPDATE stock_watchlist SET last_notified_at = ? WHERE id = ?",
-        (now, alert_id),
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        price_rows = conn.executemany(
+            """UPDATE stock_watchlist SET last_price = ?
+               WHERE symbol = ? AND active = 1 AND (last_price IS NULL OR last_price != ?)""",
+            [(price, symbol, price) for symbol, price in prices],
+        ).rowcount if prices else 0
+        notified_rows = conn.executemany(
+            "UPDATE stock_watchlist SET last_notified_at = ? WHERE id = ?",
+            [(now, alert_id) for alert_id in notified_ids],
+        ).rowcount if notified_ids else 0
+    return price_rows, notified_rows
 
 
 def delete_stock_alert(alert_id: int):
     """ลบหุ้นออกจาก watchlist (soft delete)"""
-    conn = get_db()
-    conn.execute("UPDATE stock_watchlist SET active = 0 WHERE id = ?", (alert_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("UPDATE stock_watchlist SET active = 0 WHERE id = ?", (alert_id,))
 
 
 # ==================== Stock Cache (Pre-fetched Data) ====================
 
-def upsert_stock_cache(data: dict):
-    """บันทึก/อัพเดท stock cache — upsert by symbol"""
-    conn = get_db()
-    conn.execute("""
-        INSERT INTO stock_cache (
-            symbol, name, price, previous_close, change_pct, currency,
-            sma_20, sma_50, sma_200, rsi_14,
-            support_30d, resistance_30d, trend,
-            pe_ratio, div_yield, sector, industry,
-            signals_json, perf_1w, perf_1m, perf_3m,
-            volume_ratio, market_cap, high_52w, low_52w,
-            volume, avg_volume_20d, market_state, fetched_at
-        ) VALUES (
-            ?, ?, ?, ?, ?, ?,
-            ?, ?, ?, ?,
-            ?, ?, ?,
-            ?, ?, ?, ?,
-            ?, ?, ?, ?,
-            ?, ?, ?, ?,
-            ?, ?, ?, ?
-        )
-        ON CONFLICT(symbol) DO UPDATE SET
-            name=excluded.name, price=excluded.price,
-            previous_close=excluded.previous_close,
-            change_pct=excluded.change_pct, currency=excluded.currency,
-            sma_20=excluded.sma_20, sma_50=excluded.sma_50,
-            sma_200=excluded.sma_200, rsi_14=excluded.rsi_14,
-            support_30d=excluded.support_30d, resistance_30d=excluded.resistance_30d,
-            trend=excluded.trend, pe_ratio=excluded.pe_ratio,
-            div_yield=excluded.div_yield, sector=excluded.sector,
-            industry=excluded.industry, signals_json=excluded.signals_json,
-            perf_1w=excluded.perf_1w, perf_1m=excluded.perf_1m,
-            perf_3m=excluded.perf_3m, volume_ratio=excluded.volume_ratio,
-            market_cap=excluded.market_cap, high_52w=excluded.high_52w,
-            low_52w=excluded.low_52w, volume=excluded.volume,
-            avg_volume_20d=excluded.avg_volume_20d,
-            market_state=excluded.market_state, fetched_at=excluded.fetched_at
-    """, (
+_STOCK_CACHE_UPSERT_SQL = """
+    INSERT INTO stock_cache (
+        symbol, name, price, previous_close, change_pct, currency,
+        sma_20, sma_50, sma_200, rsi_14,
+        support_30d, resistance_30d, trend,
+        pe_ratio, div_yield, sector, industry,
+        signals_json, perf_1w, perf_1m, perf_3m,
+        volume_ratio, market_cap, high_52w, low_52w,
+        volume, avg_volume_20d, market_state, fetched_at
+    ) VALUES (
+        ?, ?, ?, ?, ?, ?,
+        ?, ?, ?, ?,
+        ?, ?, ?,
+        ?, ?, ?, ?,
+        ?, ?, ?, ?,
+        ?, ?, ?, ?,
+        ?, ?, ?, ?
+    )
+    ON CONFLICT(symbol) DO UPDATE SET
+        name=excluded.name, price=excluded.price,
+        previous_close=excluded.previous_close,
+        change_pct=excluded.change_pct, currency=excluded.currency,
+        sma_20=excluded.sma_20, sma_50=excluded.sma_50,
+        sma_200=excluded.sma_200, rsi_14=excluded.rsi_14,
+        support_30d=excluded.support_30d, resistance_30d=excluded.resistance_30d,
+        trend=excluded.trend, pe_ratio=excluded.pe_ratio,
+        div_yield=excluded.div_yield, sector=excluded.sector,
+        industry=excluded.industry, signals_json=excluded.signals_json,
+        perf_1w=excluded.perf_1w, perf_1m=excluded.perf_1m,
+        perf_3m=excluded.perf_3m, volume_ratio=excluded.volume_ratio,
+        market_cap=excluded.market_cap, high_52w=excluded.high_52w,
+        low_52w=excluded.low_52w, volume=excluded.volume,
+        avg_volume_20d=excluded.avg_volume_20d,
+        market_state=excluded.market_state, fetched_at=excluded.fetched_at
+"""
+
+
+def _stock_cache_params(data: dict, fetched_at: str) -> tuple:
+    return (
         data.get("symbol"), data.get("name"), data.get("price"),
         data.get("previous_close") or data.get("prev_close"),
         data.get("change_pct"), data.get("currency"),
@@ -678,19 +1095,32 @@ def upsert_stock_cache(data: dict):
         data.get("high_52w"), data.get("low_52w"),
         data.get("volume"), data.get("avg_volume_20d"),
         data.get("market_state"),
-        datetime.now(BKK).isoformat(),
-    ))
-    conn.commit()
-    conn.close()
+        fetched_at,
+    )
+
+
+def upsert_stock_cache(data: dict):
+    """บันทึก/อัพเดท stock cache — upsert by symbol"""
+    with get_db() as conn:
+        conn.execute(_STOCK_CACHE_UPSERT_SQL, _stock_cache_params(data, datetime.now(BKK).isoformat()))
+
+
+def upsert_stock_cache_many(rows: list[dict]) -> int:
+    """upsert หลาย symbol ใน transaction เดียว (ใช้ตอน refresh ทั้ง watchlist)"""
+    if not rows:
+        return 0
+    fetched_at = datetime.now(BKK).isoformat()
+    with get_db() as conn:
+        conn.executemany(_STOCK_CACHE_UPSERT_SQL, [_stock_cache_params(d, fetched_at) for d in rows])
+    return len(rows)
 
 
 def get_stock_cache(symbol: str, max_age_minutes: int = 10) -> dict | None:
     """อ่าน stock cache — return None ถ้าหมดอายุหรือไม่มี"""
-    conn = get_db()
-    row = conn.execute(
-        "SELECT * FROM stock_cache WHERE symbol = ?", (symbol,)
-    ).fetchone()
-    conn.close()
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT * FROM stock_cache WHERE symbol = ?", (symbol,)
+        ).fetchone()
     if not row:
         return None
     data = dict(row)
@@ -714,9 +1144,8 @@ def get_stock_cache(symbol: str, max_age_minutes: int = 10) -> dict | None:
 
 def get_all_stock_cache() -> list[dict]:
     """ดึง stock cache ทั้งหมด (ไม่เช็คอายุ — ใช้แสดง watchlist)"""
-    conn = get_db()
-    rows = conn.execute("SELECT * FROM stock_cache").fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute("SELECT * FROM stock_cache").fetchall()
     results = []
     for r in rows:
         d = dict(r)
@@ -728,25 +1157,38 @@ def get_all_stock_cache() -> list[dict]:
     return results
 
 
+_MARKET_CACHE_UPSERT_SQL = """
+    INSERT INTO market_cache (index_name, symbol, price, change_pct, fetched_at)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(index_name) DO UPDATE SET
+        symbol=excluded.symbol, price=excluded.price,
+        change_pct=excluded.change_pct, fetched_at=excluded.fetched_at
+"""
+
+
 def upsert_market_cache(index_name: str, symbol: str, price: float, change_pct: float):
     """บันทึก/อัพเดท market index cache"""
-    conn = get_db()
-    conn.execute("""
-        INSERT INTO market_cache (index_name, symbol, price, change_pct, fetched_at)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(index_name) DO UPDATE SET
-            symbol=excluded.symbol, price=excluded.price,
-            change_pct=excluded.change_pct, fetched_at=excluded.fetched_at
-    """, (index_name, symbol, price, change_pct, datetime.now(BKK).isoformat()))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            _MARKET_CACHE_UPSERT_SQL,
+            (index_name, symbol, price, change_pct, datetime.now(BKK).isoformat()),
+        )
+
+
+def upsert_market_cache_many(rows: list[tuple[str, str, float, float]]) -> int:
+    """upsert หลาย index ใน transaction เดียว — rows: [(index_name, symbol, price, change_pct), ...]"""
+    if not rows:
+        return 0
+    fetched_at = datetime.now(BKK).isoformat()
+    with get_db() as conn:
+        conn.executemany(_MARKET_CACHE_UPSERT_SQL, [(*r, fetched_at) for r in rows])
+    return len(rows)
 
 
 def get_market_cache(max_age_minutes: int = 10) -> dict | None:
     """อ่าน market overview จาก cache — return None ถ้าหมดอายุ"""
-    conn = get_db()
-    rows = conn.execute("SELECT * FROM market_cache").fetchall()
-    conn.close()
+    with get_db() as conn:
+        rows = conn.execute("SELECT * FROM market_cache").fetchall()
     if not rows:
         return None
     results = {}
@@ -766,3 +1208,95 @@ def get_market_cache(max_age_minutes: int = 10) -> dict | None:
             "change_pct": d["change_pct"],
         }
     return results if results else None
+
+
+def get_market_cache_rows() -> list[dict]:
+    """แถวทั้งหมดของ market_cache (ไม่กรองอายุ) — ผู้เรียกเช็คอายุราย index เอง"""
+    with get_db() as conn:
+        rows = conn.execute("SELECT * FROM market_cache").fetchall()
+    return [dict(r) for r in rows]
+
+
+# ==================== Price Bars (OHLCV History) ====================
+
+_IN_CHUNK = 500  # จำนวน parameter ต่อ IN (...) — กันชน SQLITE_MAX_VARIABLE_NUMBER ของ SQLite รุ่นเก่า
+
+
+def _chunks(items: list, size: int = _IN_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def upsert_price_bars_many(rows: list[tuple]) -> int:
+    """
+    upsert แท่งราคา — rows: [(symbol, date, open, high, low, close, volume), ...]
+    แท่งของวันนี้ (ยังไม่ปิดตลาด) จะถูกเขียนทับทุกรอบ
+    """
+    if not rows:
+        return 0
+    with get_db() as conn:
+        conn.executemany("""
+            INSERT INTO price_bars (symbol, date, open, high, low, close, volume)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(symbol, date) DO UPDATE SET
+                open=excluded.open, high=excluded.high, low=excluded.low,
+                close=excluded.close, volume=excluded.volume
+        """, rows)
+    return len(rows)
+
+
+def get_price_bars(symbols: list[str], limit: int = 252) -> dict[str, list[tuple]]:
+    """
+    ดึงแท่งราคาล่าสุด `limit` แท่งของแต่ละ symbol (เรียงเก่า → ใหม่)
+    Returns: {symbol: [(date, open, high, low, close, volume), ...]}
+    """
+    result: dict[str, list[tuple]] = {}
+    with get_db() as conn:
+        for chunk in _chunks(list(symbols)):
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"""
+                SELECT symbol, date, open, high, low, close, volume FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY symbol ORDER BY date DESC) AS rn
+                    FROM price_bars WHERE symbol IN ({placeholders})
+                )
+                WHERE rn <= ?
+                ORDER BY symbol, date
+            """, (*chunk, limit)).fetchall()
+            for r in rows:
+                result.setdefault(r["symbol"], []).append(tuple(r)[1:])
+    return result
+
+
+def get_price_bar_coverage(symbols: list[str]) -> dict[str, tuple[int, str]]:
+    """จำนวนแท่ง + วันที่ล่าสุดที่เก็บไว้ของแต่ละ symbol → {symbol: (count, last_date)}"""
+    result = {}
+    with get_db() as conn:
+        for chunk in _chunks(list(symbols)):
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"""
+                SELECT symbol, COUNT(*) AS bars, MAX(date) AS last_date
+                FROM price_bars WHERE symbol IN ({placeholders})
+                GROUP BY symbol
+            """, chunk).fetchall()
+            for r in rows:
+                result[r["symbol"]] = (r["bars"], r["last_date"])
+    return result
+
+
+def prune_price_bars(keep_days: int = 400) -> int:
+    """ลบแท่งที่เก่ากว่า keep_days วัน (indicator ใช้ไม่เกิน ~1 ปี)"""
+    cutoff = (datetime.now(BKK) - timedelta(days=keep_days)).strftime("%Y-%m-%d")
+    with get_db() as conn:
+        cursor = conn.execute("DELETE FROM price_bars WHERE date < ?", (cutoff,))
+        return cursor.rowcount
+
+
+if __name__ == "__main__":
+    # One-shot maintenance: python database.py rebuild-streaks
+    import sys
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "rebuild-streaks":
+        init_db()
+        print(f"[OK] Rebuilt user_streaks for {rebuild_user_streaks()} users")
+    else:
+        print("usage: python database.py rebuild-streaks")
@@ -0,0 +1,144 @@
+"""
+indicators.py — Vectorized Technical Indicator Engine (NumPy)
+คำนวณ indicator ของหลาย symbol พร้อมกันในรอบเดียว แทนการสร้าง pandas Series ทีละตัว
+
+input: array 2 มิติ (N symbols × T bars) — ข้อมูลแต่ละแถวชิดขวา เติม NaN ทางซ้าย
+       (แถวที่สั้นกว่า T จะมี NaN นำหน้า) ใช้ pack_rows() สร้างได้
+output: dict ของ array 1 มิติ (ยาว N) — ค่าดิบยังไม่ปัด, NaN = ข้อมูลไม่พอ
+
+ผลลัพธ์ (หลังปัดเศษ) ตรงกับ logic เดิมใน stock_service (rolling mean ของ pandas, RSI แบบ simple average)
+rolling window ทั้งหมดคิดจาก cumulative sum → O(N × T) ไม่ว่าจะมีกี่ window
+ข้อยกเว้นเดียว: ค่าเฉลี่ยที่ตกพอดีกึ่งกลาง (เช่น 61.725) pandas อาจคลาด 1 ulp จาก running sum
+แล้วปัดไปอีกทาง ±0.01 — ที่นี่ใช้ค่าที่ปัดจากผลรวมจริง (ตรวจได้ด้วย benchmark.py indicators)
+"""
+
+import numpy as np
+
+SMA_WINDOWS = (20, 50, 200)
+RSI_PERIOD = 14
+VOLUME_WINDOW = 20
+RANGE_WINDOW = 30  # แนวรับ/แนวต้าน 30 วัน
+PERF_WINDOWS = {"perf_1w": 5, "perf_1m": 22, "perf_3m": 66}
+
+
+def pack_rows(rows: list, width: int | None = None) -> np.ndarray:
+    """รวม list ของ sequence (ยาวไม่เท่ากัน) เป็น array (N × width) ชิดขวา เติม NaN ทางซ้าย"""
+    if width is None:
+        width = max((len(r) for r in rows), default=0)
+    out = np.full((len(rows), width), np.nan)
+    for i, row in enumerate(rows):
+        if len(row):
+            tail = np.asarray(row[-width:], dtype=float)
+            out[i, width - len(tail):] = tail
+    return out
+
+
+def _valid_counts(x: np.ndarray) -> np.ndarray:
+    """จำนวนข้อมูลจริงในแต่ละแถว (padding อยู่ทางซ้ายเท่านั้น)"""
+    return np.count_nonzero(~np.isnan(x), axis=1)
+
+
+def _window_means(x: np.ndarray, window: int, offset: int = 0) -> np.ndarray:
+    """
+    ค่าเฉลี่ย window ที่จบที่ bar ที่ (T - 1 - offset) ของทุกแถว จาก cumulative sum
+    offset=0 → window ล่าสุด, offset=1 → window ก่อนหน้า (ใช้เช็ค cross)
+    """
+    n_rows, width = x.shape
+    end = width - offset
+    if end - window < 0:
+        return np.full(n_rows, np.nan)
+    # สะสมด้วย longdouble (80-bit บน x86) → ผลรวม window ที่แปลงกลับเป็น float64 ตรงกับผลรวมจริง
+    # แล้วหารใน float64 แบบเดียวกับ pandas (sum / nobs)
+    csum = np.zeros((n_rows, width + 1), dtype=np.longdouble)
+    np.cumsum(np.nan_to_num(x), axis=1, dtype=np.longdouble, out=csum[:, 1:])
+    return (csum[:, end] - csum[:, end - window]).astype(float) / window
+
+
+def _rolling_mean_last(x: np.ndarray, counts: np.ndarray, window: int, offset: int = 0) -> np.ndarray:
+    """ค่าเฉลี่ย window ล่าสุด (หรือก่อนหน้า ถ้า offset=1) — NaN ถ้าข้อมูลในแถวไม่พอ"""
+    means = _window_means(x, window, offset)
+    return np.where(counts >= window + offset, means, np.nan)
+
+
+def _last(x: np.ndarray, counts: np.ndarray, back: int = 0) -> np.ndarray:
+    """ค่าที่ตำแหน่ง -1 - back ของแต่ละแถว (NaN ถ้าแถวสั้นเกิน)"""
+    width = x.shape[1]
+    if back >= width:
+        return np.full(x.shape[0], np.nan)
+    return np.where(counts > back, x[:, width - 1 - back], np.nan)
+
+
+def _tail_reduce(x: np.ndarray, window: int | None, fn, fill: float) -> np.ndarray:
+    """min/max ของ window ท้ายแถว (None = ทั้งแถว) โดยข้าม NaN — แถวว่างได้ NaN"""
+    part = x if window is None else x[:, -window:]
+    if part.shape[1] == 0:
+        return np.full(x.shape[0], np.nan)
+    mask = np.isnan(part)
+    reduced = fn(np.where(mask, fill, part), axis=1)
+    return np.where(mask.all(axis=1), np.nan, reduced)
+
+
+def compute_indicators(
+    closes: np.ndarray,
+    highs: np.ndarray,
+    lows: np.ndarray,
+    volumes: np.ndarray,
+) -> dict[str, np.ndarray]:
+    """
+    คำนวณ indicator ทั้งหมดของ N symbols ในรอบเดียว
+    Returns dict (ค่าดิบ ยาว N):
+      n_closes, price, prev_close, sma_20/50/200, sma_20_prev, sma_50_prev,
+      rsi_14, volume, avg_volume_20d, support_30d, resistance_30d,
+      high_52w, low_52w, perf_1w, perf_1m, perf_3m
+    """
+    closes = np.asarray(closes, dtype=float)
+    highs = np.asarray(highs, dtype=float)
+    lows = np.asarray(lows, dtype=float)
+    volumes = np.asarray(volumes, dtype=float)
+
+    n_closes = _valid_counts(closes)
+    n_volumes = _valid_counts(volumes)
+
+    price = _last(closes, n_closes)
+    prev_close = np.where(n_closes >= 2, _last(closes, n_closes, 1), price)
+
+    out: dict[str, np.ndarray] = {
+        "n_closes": n_closes,
+        "price": price,
+        "prev_close": prev_close,
+    }
+
+    # --- Moving Averages (+ ค่าก่อนหน้า 1 bar สำหรับ Golden/Death Cross) ---
+    for window in SMA_WINDOWS:
+        out[f"sma_{window}"] = _rolling_mean_last(closes, n_closes, window)
+    out["sma_20_prev"] = _rolling_mean_last(closes, n_closes, 20, offset=1)
+    out["sma_50_prev"] = _rolling_mean_last(closes, n_closes, 50, offset=1)
+
+    # --- RSI (14-day, simple average ของ gain/loss) ---
+    deltas = np.diff(closes, axis=1)
+    gains = np.where(deltas > 0, deltas, 0.0)
+    losses = np.where(deltas < 0, -deltas, 0.0)
+    avg_gain = _window_means(gains, RSI_PERIOD)
+    avg_loss = _window_means(losses, RSI_PERIOD)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi = np.where(avg_loss == 0, 100.0, 100 - (100 / (1 + avg_gain / avg_loss)))
+    out["rsi_14"] = np.where(n_closes >= RSI_PERIOD + 1, rsi, np.nan)
+
+    # --- Volume ---
+    out["volume"] = np.where(n_volumes > 0, _last(volumes, n_volumes), 0.0)
+    out["avg_volume_20d"] = _rolling_mean_last(volumes, n_volumes, VOLUME_WINDOW)
+
+    # --- Support & Resistance (30 วัน) / High-Low ทั้งช่วง ---
+    out["support_30d"] = _tail_reduce(lows, RANGE_WINDOW, np.min, np.inf)
+    out["resistance_30d"] = _tail_reduce(highs, RANGE_WINDOW, np.max, -np.inf)
+    out["high_52w"] = _tail_reduce(highs, None, np.max, -np.inf)
+    out["low_52w"] = _tail_reduce(lows, None, np.min, np.inf)
+
+    # --- Price Performance ---
+    for name, days in PERF_WINDOWS.items():
+        old = _last(closes, n_closes, days)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            perf = (price - old) / old * 100
+        out[name] = np.where((n_closes > days) & (old > 0), perf, np.nan)
+
+    return out
@@ -0,0 +1,281 @@
+"""
+intent_model.py — Local Intent Classifier (ตัดสินว่าข้อความไหนตอบเองได้โดยไม่ต้องเรียก Claude)
+Naive Bayes บน character n-gram (1-3 ตัวอักษร) — ภาษาไทยไม่มีช่องว่างระหว่างคำ
+n-gram ของตัวอักษรจึงจับคำได้โดยไม่ต้องตัดคำ
+
+train offline จาก data/intents_train.tsv → data/intent_model.json (เก็บเฉพาะ count แบบ sparse)
+server โหลดไฟล์ตอน startup แล้วสร้าง matrix log-prob (NumPy) → classify 1 ข้อความ ~20-50 µs
+
+    python intent_model.py train
+    python intent_model.py eval --threshold 0.85
+
+eval: replay data/intents_eval.tsv → accuracy, deflection rate (สัดส่วนที่ตอบเองได้),
+      precision ของข้อความที่ตอบเอง (คุณภาพคำตอบ), ข้อความ "other" ที่หลุดมาตอบเอง,
+      ตาราง threshold sweep และเทียบกับ trigger substring เดิมของ QUICK_REPLIES
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path(__file__).parent / "data"
+MODEL_PATH = Path(os.getenv("INTENT_MODEL_PATH", str(DATA_DIR / "intent_model.json")))
+TRAIN_PATH = DATA_DIR / "intents_train.tsv"
+EVAL_PATH = DATA_DIR / "intents_eval.tsv"
+
+# posterior ขั้นต่ำที่ยอมตอบเอง — ต่ำกว่านี้ส่งให้ Claude (ดูผลจาก `python intent_model.py eval`)
+INTENT_THRESHOLD = float(os.getenv("INTENT_THRESHOLD", "0.85"))
+# ข้อความยาวกว่านี้มักมีรายละเอียดที่ template ตอบไม่ได้ → ส่งให้ Claude เสมอ (เท่า trigger เดิม)
+INTENT_MAX_CHARS = int(os.getenv("INTENT_MAX_CHARS", "40"))
+
+# สัดส่วน n-gram ของข้อความที่ model เคยเห็นขั้นต่ำ — ต่ำกว่านี้ถือว่า "other"
+# (NB มั่นใจเกินจริงกับข้อความที่ไม่คล้ายข้อมูล train เช่นประโยคอังกฤษยาว ๆ)
+INTENT_MIN_COVERAGE = float(os.getenv("INTENT_MIN_COVERAGE", "0.75"))
+
+OTHER = "other"  # intent สำหรับข้อความที่ต้องให้ LLM ตอบ
+NGRAM_RANGE = (1, 3)
+ALPHA = 0.5      # Laplace smoothing
+
+# คำสั่งให้ทำ (ลบ/เลื่อนนัด) หรือขอคำแนะนำ (ควรขายไหม) — template ตอบได้แค่ "ดู" ข้อมูล
+# ข้อความผสมเช่น "PTT ราคาเท่าไหร่ ควรขายไหม" จึงต้องไป Claude แม้ model จะจับ intent ราคาได้
+_ACTION_RE = re.compile(
+    r"ลบ|ยกเลิก|เลื่อน|แก้|เปลี่ยน|ควร|ซื้อ|ขาย|น่าเข้า|น่าเก็บ|แนะนำ|วิเคราะห์|delete|cancel|remove|buy|sell",
+    re.IGNORECASE,
+)
+
+# ticker หุ้นที่พิมพ์ตัวใหญ่ (PTT, KBANK.BK) → "#" ให้ model เรียนรูปประโยค ไม่ใช่ชื่อหุ้น
+_TICKER_RE = re.compile(r"(?<![A-Za-z0-9])[A-Z][A-Z0-9]{1,5}(?:\.BK)?(?![A-Za-z0-9])")
+_SPACE_RE = re.compile(r"\s+")
+# ตัวอักษรซ้ำ (555555, ฟ้าาาา) → เหลือ 2 ตัว
+_REPEAT_RE = re.compile(r"(.)\1{2,}")
+
+
+def normalize(text: str) -> str:
+    text = _TICKER_RE.sub("#", text.strip())
+    text = _REPEAT_RE.sub(r"\1\1", text.lower())
+    return _SPACE_RE.sub(" ", text)
+
+
+def char_ngrams(text: str) -> set[str]:
+    """n-gram ของตัวอักษร (ไม่ซ้ำ) จากข้อความที่ normalize แล้ว — เติมช่องว่างหัวท้ายให้รู้ขอบประโยค"""
+    padded = f" {text} "
+    lo, hi = NGRAM_RANGE
+    return {
+        padded[i:i + n]
+        for n in range(lo, hi + 1)
+        for i in range(len(padded) - n + 1)
+    }
+
+
+def load_examples(path: Path) -> list[tuple[str, str]]:
+    """อ่าน TSV (intent, text) — ข้ามบรรทัดว่างและ comment"""
+    examples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            intent, _, text = line.rstrip("\n").partition("\t")
+            if intent and text:
+                examples.append((intent.strip(), text.strip()))
+    return examples
+
+
+def train(examples: list[tuple[str, str]], alpha: float = ALPHA) -> dict:
+    """นับ n-gram ต่อ intent (binary ต่อข้อความ) → dict ที่ serialize เป็น JSON ได้"""
+    docs = Counter()
+    counts: dict[str, Counter] = {}
+    for intent, text in examples:
+        docs[intent] += 1
+        counts.setdefault(intent, Counter()).update(char_ngrams(normalize(text)))
+    intents = sorted(docs)
+    return {
+        "version": 1,
+        "ngram_range": list(NGRAM_RANGE),
+        "alpha": alpha,
+        "intents": intents,
+        "docs": {intent: docs[intent] for intent in intents},
+        "counts": {intent: dict(sorted(counts[intent].items())) for intent in intents},
+    }
+
+
+class IntentModel:
+    """
+    Multinomial NB ที่คำนวณ log-prob ไว้ล่วงหน้า
+      score(c) = log P(c) + n × unseen(c) + Σ weights[g, c]  (เฉพาะ g ที่อยู่ใน vocab)
+    weights[g, c] = log P(g|c) - unseen(c) → n-gram ที่ไม่รู้จักไม่ต้อง lookup เลย
+    """
+
+    def __init__(self, data: dict):
+        self.intents: list[str] = data["intents"]
+        alpha = data.get("alpha", ALPHA)
+        counts = data["counts"]
+        vocab = sorted({gram for intent in self.intents for gram in counts[intent]})
+        self._vocab = {gram: i for i, gram in enumerate(vocab)}
+
+        n_vocab = len(vocab)
+        matrix = np.zeros((n_vocab, len(self.intents)))
+        for j, intent in enumerate(self.intents):
+            for gram, count in counts[intent].items():
+                matrix[self._vocab[gram], j] = count
+        totals = matrix.sum(axis=0) + alpha * n_vocab
+        self._unseen = np.log(alpha / totals)
+        self._weights = np.log((matrix + alpha) / totals) - self._unseen
+
+        docs = np.array([data["docs"][intent] for intent in self.intents], dtype=float)
+        self._prior = np.log(docs / docs.sum())
+
+    def predict(self, text: str) -> tuple[str, float]:
+        """(intent, posterior) ของ intent ที่คะแนนสูงสุด — n-gram ที่รู้จักน้อยเกินได้ ("other", 1.0)"""
+        grams = char_ngrams(normalize(text))
+        rows = [i for i in map(self._vocab.get, grams) if i is not None]
+        if len(rows) < INTENT_MIN_COVERAGE * len(grams):
+            return OTHER, 1.0
+        scores = self._prior + len(grams) * self._unseen
+        if rows:
+            scores = scores + self._weights[rows].sum(axis=0)
+        probs = np.exp(scores - scores.max())
+        best = int(probs.argmax())
+        return self.intents[best], float(probs[best] / probs.sum())
+
+
+# ==================== Runtime ====================
+
+_model: IntentModel | None = None
+
+
+def load_model(path: Path = MODEL_PATH) -> IntentModel | None:
+    """โหลด model ตอน startup — ไม่มีไฟล์/อ่านไม่ได้ → None (ทุกข้อความไปหา Claude ตามเดิม)"""
+    global _model
+    try:
+        with open(path, encoding="utf-8") as f:
+            _model = IntentModel(json.load(f))
+        logger.info(f"[Intent] model loaded: {len(_model.intents)} intents, {len(_model._vocab)} n-grams")
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"[Intent] model not loaded ({path}): {e}")
+        _model = None
+    return _model
+
+
+def routable(text: str) -> bool:
+    """ข้อความที่ให้ model ตัดสินได้ — ไม่ว่าง ไม่ยาวเกิน และไม่มีคำสั่ง/ขอคำแนะนำ"""
+    return bool(text) and len(text) <= INTENT_MAX_CHARS and not _ACTION_RE.search(text)
+
+
+def classify(message: str, threshold: float = INTENT_THRESHOLD) -> tuple[str | None, float]:
+    """
+    Returns: (intent, confidence) — intent เป็น None ถ้าควรส่งให้ Claude
+    (ไม่มี model, ข้อความยาวเกิน/มีคำสั่ง, ได้ "other" หรือ confidence ต่ำกว่า threshold)
+    """
+    if _model is None:
+        return None, 0.0
+    text = message.strip()
+    if not routable(text):
+        return None, 0.0
+    intent, confidence = _model.predict(text)
+    if intent == OTHER or confidence < threshold:
+        return None, confidence
+    return intent, confidence
+
+
+# ==================== CLI: train / eval ====================
+
+def _legacy_intent(message: str) -> str | None:
+    """trigger substring เดิมของ try_local_reply (ใช้เทียบใน eval)"""
+    from ai_brain import QUICK_REPLIES
+
+    msg_lower = message.strip().lower()
+    if len(msg_lower) >= 40:
+        return None
+    for category, data in QUICK_REPLIES.items():
+        if any(trigger in msg_lower for trigger in data["triggers"]):
+            return category
+    return None
+
+
+def _report(label: str, examples: list[tuple[str, str]], predicted: list[str | None]):
+    """deflection = ตอบเอง, precision = ตอบเองถูก intent, leaked = ข้อความ other ที่ถูกตอบเอง"""
+    deflected = [(gold, pred) for (gold, _), pred in zip(examples, predicted) if pred is not None]
+    correct = sum(1 for gold, pred in deflected if gold == pred)
+    leaked = sum(1 for gold, _ in deflected if gold == OTHER)
+    answerable = sum(1 for gold, _ in examples if gold != OTHER)
+    print(
+        f"{label:<22} deflection {len(deflected) / len(examples):6.1%}"
+        f"  precision {correct / len(deflected) if deflected else 0:6.1%}"
+        f"  recall {correct / answerable if answerable else 0:6.1%}"
+        f"  leaked-other {leaked}"
+    )
+
+
+def run_eval(model_path: Path, eval_path: Path, threshold: float):
+    model = load_model(model_path)
+    if model is None:
+        raise SystemExit(f"no model at {model_path} — run: python intent_model.py train")
+    examples = load_examples(eval_path)
+
+    timings = []
+    raw = []
+    for _, text in examples:
+        start = time.perf_counter()
+        raw.append(model.predict(text))
+        timings.append((time.perf_counter() - start) * 1e6)
+
+    def routed(t: float) -> list[str | None]:
+        return [
+            None if intent == OTHER or conf < t or not routable(text.strip()) else intent
+            for (intent, conf), (_, text) in zip(raw, examples)
+        ]
+
+    accuracy = sum(1 for (gold, _), (intent, _) in zip(examples, raw) if gold == intent) / len(examples)
+    timings.sort()
+    print(f"eval set: {len(examples)} messages ({eval_path.name}), top-1 accuracy {accuracy:.1%}")
+    print(f"latency: p50 {timings[len(timings) // 2]:.0f} µs, p99 {timings[int(len(timings) * 0.99)]:.0f} µs\n")
+
+    _report("legacy triggers", examples, [_legacy_intent(text) for _, text in examples])
+    for t in sorted({0.5, 0.7, 0.8, 0.9, 0.95, threshold}):
+        _report(f"model @ {t:.2f}" + (" *" if t == threshold else ""), examples, routed(t))
+
+    print(f"\nerrors at threshold {threshold:.2f}:")
+    for (gold, text), pred, (intent, conf) in zip(examples, routed(threshold), raw):
+        if pred is not None and pred != gold:
+            print(f"  WRONG   {gold:>15} → {pred:<15} {conf:.2f}  {text}")
+        elif pred is None and gold != OTHER:
+            print(f"  MISSED  {gold:>15} ({intent} {conf:.2f})  {text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI Friend local intent classifier")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_train = sub.add_parser("train", help="train model from TSV → JSON")
+    p_train.add_argument("--data", type=Path, default=TRAIN_PATH)
+    p_train.add_argument("--out", type=Path, default=MODEL_PATH)
+    p_train.add_argument("--alpha", type=float, default=ALPHA)
+
+    p_eval = sub.add_parser("eval", help="replay eval set → deflection / precision per threshold")
+    p_eval.add_argument("--model", type=Path, default=MODEL_PATH)
+    p_eval.add_argument("--data", type=Path, default=EVAL_PATH)
+    p_eval.add_argument("--threshold", type=float, default=INTENT_THRESHOLD)
+
+    args = parser.parse_args()
+    if args.command == "train":
+        examples = load_examples(args.data)
+        data = train(examples, args.alpha)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        n_grams = sum(len(c) for c in data["counts"].values())
+        print(f"trained on {len(examples)} examples, {len(data['intents'])} intents, {n_grams} n-gram counts → {args.out}")
+    elif args.command == "eval":
+        run_eval(args.model, args.data, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ main.py — AI Friend Backend
 API endpoints ทั้งหมดสำหรับแอป ฟ้า AI Friend
 """
 
+import asyncio
 import io
 import json
 import re
@@ -11,7 +12,7 @@ from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -21,15 +22,27 @@ import logging
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import database as db
-from ai_brain import try_local_reply, call_haiku, parse_reminder_text
+import async_db as adb
+from ai_brain import (
+    try_local_reply, call_haiku, stream_haiku, parse_reminder_text,
+    post_messages, start_http_client, close_http_client, get_llm_stats,
+    detect_local_intent, local_reply_for, get_local_reply_stats,
+)
+import intent_model
+import answer_cache
+import conversation_summary
+import market_hours
 from memory import process_memory_update, get_memory_summary
 from morning_brief import generate_morning_brief, generate_night_wrap
 from news_fetcher import run_alert_fetch_job
+from quote_hub import hub as quote_hub, QuoteSubscriber, quote_fields
+from side_effects import pipeline as side_effect_pipeline
+import symbol_index
 from push_sender import init_firebase, send_push_to_user
 from stock_service import (
-    get_stock_price, check_stock_alerts, format_symbol,
+    get_stock_prices, format_symbol,
     get_stock_analysis, format_analysis_for_ai,
-    is_stock_related_message, detect_stock_symbols_in_message,
+    scan_stock_message,
     get_market_overview, format_market_overview_for_ai,
     get_watchlist_summary, get_watchlist_brief,
     # Direct HTTP (bypass yfinance)
@@ -37,7 +50,8 @@ from stock_service import (
     # Cached versions (อ่านจาก DB — ตอบทันที)
     get_stock_price_cached, get_stock_analysis_cached,
     get_market_overview_cached, get_watchlist_summary_cached,
-    get_watchlist_brief_cached, refresh_stock_cache,
+    get_watchlist_brief_cached, refresh_stock_cache, get_refresh_stats,
+    STOCK_REFRESH_TICK, get_cached_quotes, market_is_open,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -53,12 +67,21 @@ async def lifespan(app: FastAPI):
     """เริ่มต้น: สร้างตาราง DB + เริ่ม Alert Scheduler"""
     global reminder_scheduler
 
-    db.init_db()
+    await adb.init_db()
     print("[OK] Database initialized")
 
     # เริ่มต้น Firebase Admin SDK (สำหรับ push notifications)
     init_firebase()
 
+    # Shared HTTP client สำหรับ Claude API (keep-alive ข้าม request)
+    await start_http_client()
+
+    # งานหลังตอบแชท (memory / reminder / stock alert) — ไม่ block การส่ง reply
+    side_effect_pipeline.start()
+
+    # Local intent classifier (ตอบข้อความง่าย ๆ เองโดยไม่เรียก Claude)
+    intent_model.load_model()
+
     # เริ่ม APScheduler — ดึงข่าว/แผ่นดินไหวทุก 7 นาที + schedule push
     reminder_scheduler = AsyncIOScheduler(timezone="Asia/Bangkok")
     reminder_scheduler.add_job(
@@ -71,28 +94,20 @@ async def lifespan(app: FastAPI):
         max_instances=1,
         misfire_grace_time=60,
     )
-    reminder_scheduler.add_job(
-        check_stock_alerts,
-        trigger="interval",
-        minutes=5,
-        id="stock_check",
-        name="Check stock price alerts",
-        replace_existing=True,
-        max_instances=1,
-        misfire_grace_time=60,
-    )
+    # รอบแรกรันทันทีผ่าน scheduler (next_run_time) → max_instances=1 กันรอบแรกซ้อนกับ tick ถัดไป
     reminder_scheduler.add_job(
         refresh_stock_cache,
         trigger="interval",
-        minutes=5,
+        seconds=STOCK_REFRESH_TICK,
         id="stock_cache_refresh",
-        name="Pre-fetch stock data to cache",
+        name="Market snapshot: stock cache + price alerts",
         replace_existing=True,
         max_instances=1,
         misfire_grace_time=60,
+        next_run_time=datetime.now(ZoneInfo("Asia/Bangkok")),
     )
     reminder_scheduler.start()
-    print("[OK] Alert scheduler started (alerts: 7min, stocks: 5min, cache: 5min)")
+    print(f"[OK] Alert scheduler started (alerts: 7min, stock snapshot + alerts: tick {STOCK_REFRESH_TICK}s, session-aware)")
 
     # ดึงข้อมูลทันทีตอน start
     try:
@@ -101,18 +116,14 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"[WARN] Initial alert fetch failed: {e}")
 
-    # Pre-fetch stock cache ตอน start (ทำใน background thread ไม่ block server)
-    import asyncio
-    try:
-        asyncio.get_event_loop().run_in_executor(None, refresh_stock_cache)
-        print("[OK] Stock cache refresh started in background")
-    except Exception as e:
-        print(f"[WARN] Initial stock cache failed: {e}")
-
     yield
 
+    await side_effect_pipeline.stop()
     reminder_scheduler.shutdown(wait=False)
     reminder_scheduler = None
+    await close_http_client()
+    adb.shutdown()
+    db.close_db_pool()
     print("[BYE] Scheduler stopped. Server shutting down")
 
 
@@ -132,8 +143,9 @@ def schedule_push_for_reminder(user_id: str, message: str, remind_at: str):
         # ถ้าเลยเวลาแล้ว → ส่งทันที
         now = datetime.now(ZoneInfo("Asia/Bangkok"))
         if run_time <= now:
+            # ส่งผ่าน scheduler (รันใน thread pool ทันที) — ไม่ block event loop ระหว่างรอ FCM
             logger.info(f"Reminder time already passed — sending push now")
-            send_push_to_user(user_id, "🤖 ฟ้าเตือน~", message)
+            reminder_scheduler.add_job(send_push_to_user, args=[user_id, "🤖 ฟ้าเตือน~", message])
             return
 
         job_id = f"push_{user_id}_{remind_at.replace(' ', '_')}"
@@ -264,9 +276,9 @@ async def register(req: RegisterRequest):
     """
     user_id = str(uuid.uuid4())[:8]  # ID สั้น ๆ
 
-    db.create_user(user_id, req.name, req.personality)
-    db.update_user_field(user_id, "wake_time", req.wake_time)
-    db.update_user_field(user_id, "sleep_time", req.sleep_time)
+    await adb.create_user(user_id, req.name, req.personality)
+    await adb.update_user_field(user_id, "wake_time", req.wake_time)
+    await adb.update_user_field(user_id, "sleep_time", req.sleep_time)
 
     # สร้างข้อความต้อนรับตามบุคลิก
     welcome_messages = {
@@ -284,211 +296,401 @@ async def register(req: RegisterRequest):
     )
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
-    """
-    แชทกับ AI เพื่อน
-    ส่ง: user_id + message
-    ได้: reply + reminder (ถ้ามี)
+# ==================== Chat Helpers ====================
 
-    ระบบ 2 ชั้น:
-    1. ลอง local reply ก่อน (ฟรี)
-    2. ถ้าตอบไม่ได้ → ส่งไป Claude Haiku
-    """
+def _parse_user_memory(user: dict, user_id: str) -> dict:
     logger = logging.getLogger(__name__)
-
-    # ดึงข้อมูลผู้ใช้
-    user = db.get_user(req.user_id)
-    if not user:
-        logger.warning(f"User not found: {req.user_id}")
-        raise HTTPException(status_code=404, detail="User not found. Please register first.")
-
-    user_name = user["name"]
-    personality = user["personality"]
-
     try:
         memory = json.loads(user["memory"]) if isinstance(user["memory"], str) else user["memory"]
         if memory is None:
             memory = {}
     except (json.JSONDecodeError, TypeError):
-        logger.warning(f"Bad memory JSON for user {req.user_id}, resetting")
+        logger.warning(f"Bad memory JSON for user {user_id}, resetting")
         memory = {}
+    return memory
+
+
+async def _load_chat_state(req: ChatRequest):
+    """โหลด context ทั้งหมด + บันทึกข้อความผู้ใช้ → (ctx, memory)"""
+    logger = logging.getLogger(__name__)
+
+    # ดึงข้อมูลผู้ใช้ + context ทั้งหมดในรอบเดียว (ก่อนบันทึกข้อความใหม่ → history ไม่ซ้ำกับข้อความนี้)
+    today_str = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
+    ctx = await adb.load_chat_context(req.user_id, today_str, **conversation_summary.history_limits())
+    if not ctx:
+        logger.warning(f"User not found: {req.user_id}")
+        raise HTTPException(status_code=404, detail="User not found. Please register first.")
+
+    # ประวัติที่ยังไม่สรุปยาวถึงเกณฑ์ → พับข้อความเก่าเข้า summary ใน background (ไม่รอ)
+    if conversation_summary.should_fold(ctx.unsummarized_count):
+        conversation_summary.schedule_fold(req.user_id, ctx.user["name"])
+
+    memory = _parse_user_memory(ctx.user, req.user_id)
 
     # บันทึกข้อความผู้ใช้
     try:
-        db.save_message(req.user_id, "user", req.message)
+        await adb.save_message(req.user_id, "user", req.message)
     except Exception as e:
         logger.error(f"Failed to save user message: {e}")
 
+    return ctx, memory
+
+
+async def _build_stock_context(user_id: str, message: str, include_watchlist: bool = True) -> str | None:
+    """
+    Smart Stock Injection: ดึงจาก CACHE (ตอบทันที ไม่ต้องรอ yfinance)
+    include_watchlist=False → เฉพาะข้อมูลกลาง (ใช้กับคำถามที่ cache คำตอบข้ามผู้ใช้ได้)
+    """
+    logger = logging.getLogger(__name__)
+    keywords, symbols = scan_stock_message(message)
+    if not keywords and not symbols:
+        return None
+
     try:
-        # ========== รวบรวม Full Context (ข้อมูลทั้งหมดของผู้ใช้) ==========
-        today_str = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
-        mood_history = db.get_mood_history(req.user_id, days=7)
-        routines = db.get_routines(req.user_id)
-        pending_reminders = db.get_pending_reminders(req.user_id)
-        stats = db.get_user_stats(req.user_id)
-
-        routine_status = []
-        for r in routines:
-            done = db.is_routine_done_today(r["id"], today_str)
-            routine_status.append({
-                "title": r["title"],
-                "time": r.get("time", ""),
-                "done": done,
-                "points": r["points"],
-            })
-
-        user_context = {
-            "wake_time": user.get("wake_time", "07:00"),
-            "sleep_time": user.get("sleep_time", "23:00"),
-            "mood_history": mood_history,
-            "routine_status": routine_status,
-            "pending_reminders": [dict(r) for r in pending_reminders],
-            "streak": stats.get("streak", 0),
-            "total_points": stats.get("total_points", 0),
-        }
+        context_parts = []
+
+        # 1. ข้อมูลวิเคราะห์หุ้นที่ถาม (จาก cache)
+        if symbols:
+            for sym in symbols[:2]:
+                yahoo_sym, _ = format_symbol(sym)
+                analysis = await asyncio.to_thread(get_stock_analysis_cached, yahoo_sym)
+                if analysis:
+                    context_parts.append(format_analysis_for_ai(analysis))
+
+        # 2. ภาพรวมตลาด (จาก cache)
+        market = await asyncio.to_thread(get_market_overview_cached)
+        if market:
+            context_parts.append(format_market_overview_for_ai(market))
+
+        # 3. Watchlist ของผู้ใช้ (จาก cache)
+        if include_watchlist:
+            watchlist = await asyncio.to_thread(get_watchlist_summary_cached, user_id)
+            if watchlist:
+                context_parts.append(watchlist)
+
+        if context_parts:
+            logger.info(f"📊 Stock context from CACHE: symbols={symbols}, market={'Yes' if market else 'No'}")
+            return "\n\n".join(context_parts)
+    except Exception as e:
+        logger.warning(f"Stock context injection failed (skipping): {e}")
+    return None
+
+
+async def _try_local_reply(message: str, user_name: str, user_context: dict) -> str | None:
+    """ชั้น 1: intent ที่ตอบเองได้ — ถามราคาหุ้นใช้ราคาใน cache เท่านั้น (ไม่มีใน cache → ให้ Claude ตอบ)"""
+    intent = detect_local_intent(message)
+    stock_quotes = None
+    if intent == "stock_price":
+        _, symbols = scan_stock_message(message)
+        if symbols:
+            yahoo_symbols = list(dict.fromkeys(format_symbol(s)[0] for s in symbols))
+            stock_quotes = await asyncio.to_thread(get_cached_quotes, yahoo_symbols)
+    return local_reply_for(intent, user_name, user_context, stock_quotes)
+
+
+async def _plan_shared_answer(message: str, personality: str) -> tuple[tuple, str, int] | None:
+    """
+    คำถามหุ้นที่คำตอบขึ้นกับข้อมูลกลางเท่านั้น → (cache key, stock context ที่ไม่มี watchlist, ttl)
+    None = ไม่ใช้ answer cache (ต่อจากบทสนทนาก่อน / ขึ้นกับพอร์ต / ไม่ระบุหุ้น)
+    """
+    keywords, symbols = scan_stock_message(message)
+    if not (keywords or symbols) or not answer_cache.is_cacheable(message, symbols):
+        return None
+    stock_context = await _build_stock_context("", message, include_watchlist=False)
+    if not stock_context:
+        return None
+    markets = {market_hours.market_of(format_symbol(s)[0]) for s in symbols[:2]} or {market_hours.SET, market_hours.US}
+    ttl = answer_cache.ttl_for(any(market_is_open(m) for m in markets))
+    return answer_cache.AnswerCache.key(message, personality, stock_context), stock_context, ttl
+
+
+def _store_shared_answer(plan: tuple[tuple, str, int], ai_result: dict, user_name: str, message: str):
+    """
+    เก็บคำตอบเฉพาะที่มาจาก Claude จริง (มี usage) และไม่มี side effect (memory/reminder/stock alert)
+    ai_result ต้องมาจาก answer_cache.shared_llm_args (ข้อมูลกลางเท่านั้น) — ชื่อผู้ถามอยู่นอกคำทัก → ไม่เก็บ
+    """
+    if "usage" not in ai_result or not ai_result.get("reply"):
+        return
+    if ai_result.get("memory_update") or ai_result.get("reminder") or ai_result.get("stock_alert"):
+        return
+    cache_key, stock_context, ttl = plan
+    answer_cache.cache.put(
+        cache_key, ai_result["reply"], user_name, ai_result["usage"], ttl, source=f"{message}\n{stock_context}",
+    )
+
+
+# ==================== Post-response Side Effects ====================
+# รันใน side_effect_pipeline หลังส่ง reply แล้ว — raise = retry (backoff) จนครบจำนวนครั้ง
+# ส่งด้วย key=user_id → งานของผู้ใช้คนเดียวกันทำทีละงาน retry ต้องไม่ทำขั้นที่สำเร็จแล้วซ้ำ
+
+async def _apply_memory_update(user_id: str, memory_update: str):
+    await adb.run(process_memory_update, user_id, memory_update)
+
+
+async def _apply_reminder(user_id: str, message: str, remind_at: str):
+    logger = logging.getLogger(__name__)
+    # มีอยู่แล้ว (retry หลังรอบก่อนบันทึกสำเร็จ / AI ตั้งซ้ำ) → ไม่ตั้ง push ซ้ำ
+    if not await adb.add_reminder(user_id, message, remind_at):
+        logger.info(f"Reminder already exists: {remind_at} — {message}")
+        return
+
+    # ตั้ง push notification ตรงเวลา
+    schedule_push_for_reminder(user_id, message, remind_at)
+    logger.info(f"✅ Reminder scheduled: {remind_at} — {message}")
+
+
+async def _apply_stock_alert(
+    user_id: str, yahoo_sym: str, display_name: str,
+    alert_type: str, target_val: float, price_cached: bool,
+):
+    logger = logging.getLogger(__name__)
+    # ไม่มีราคาใน cache → ยืนยัน symbol กับ Yahoo ก่อนเพิ่ม (ช้าได้ ผู้ใช้ได้ reply ไปแล้ว)
+    if not price_cached:
+        price_data = (await asyncio.to_thread(get_stock_prices, [yahoo_sym])).get(yahoo_sym)
+        if not price_data:
+            raise LookupError(f"Could not get price for {yahoo_sym}")
+
+    await adb.add_stock_alert(user_id, yahoo_sym, display_name, alert_type, target_val)
+    logger.info(f"📊 Stock alert added: {display_name} ({yahoo_sym}) {alert_type} {target_val}")
+
+
+async def _apply_ai_result(user_id: str, ai_result: dict) -> ChatResponse:
+    """
+    บันทึกคำตอบ AI → ChatResponse ทันที
+    memory / reminder / stock alert ส่งเข้า side_effect_pipeline — reminder และหุ้นใน response
+    เป็นค่าที่ parse ได้ (optimistic) ราคาหุ้นมาจาก cache เท่านั้น (ไม่รอ Yahoo)
+    """
+    logger = logging.getLogger(__name__)
+    reply = ai_result["reply"]
+
+    # บันทึกคำตอบ AI (ต้องอยู่ใน history ก่อนข้อความถัดไปของผู้ใช้)
+    await adb.save_message(user_id, "assistant", reply)
+
+    # ========== จัดการ Memory ==========
+    if ai_result["memory_update"]:
+        side_effect_pipeline.submit(
+            "memory_update", _apply_memory_update, user_id, ai_result["memory_update"], key=user_id,
+        )
+
+    # ========== จัดการ Reminder ==========
+    response = ChatResponse(reply=reply)
+
+    # ส่ง raw reminder line กลับ Flutter เสมอ (debug)
+    raw_reminder_line = ai_result.get("raw_reminder_line")
+    if raw_reminder_line:
+        response.debug_reminder_raw = raw_reminder_line
+
+    raw_reminder = ai_result.get("reminder")
+    if raw_reminder:
+        logger.info(f"🔔 Parsed reminder value: '{raw_reminder}'")
+        parsed = parse_reminder_text(raw_reminder)
+        if parsed:
+            response.has_reminder = True
+            response.reminder_message = parsed["message"]
+            response.reminder_time = parsed["remind_at"]
+            side_effect_pipeline.submit(
+                "reminder", _apply_reminder, user_id, parsed["message"], parsed["remind_at"], key=user_id,
+            )
+        else:
+            logger.warning(f"⚠️ parse_reminder_text FAILED for: '{raw_reminder}'")
+    else:
+        logger.info(f"ℹ️ No reminder (raw_reminder_line='{raw_reminder_line}')")
+
+    # ========== จัดการ Stock Alert ==========
+    raw_stock = ai_result.get("stock_alert")
+    if raw_stock:
+        try:
+            parts = raw_stock.split("|")
+            if len(parts) >= 3:
+                sym_input = parts[0].strip()
+                alert_type = parts[1].strip()
+                target_val = float(parts[2].strip())
+
+                yahoo_sym, display_name = format_symbol(sym_input)
+
+                # ราคาจาก cache เท่านั้น — ไม่มีก็ตอบไปก่อน (แอปแสดงราคาเฉพาะเมื่อมี)
+                price_data = (await asyncio.to_thread(get_cached_quotes, [yahoo_sym])).get(yahoo_sym)
+                response.stock_symbol = display_name
+                if price_data:
+                    response.stock_price = price_data["price"]
+                    response.stock_change_pct = price_data.get("change_pct")
+                    response.stock_currency = price_data.get("currency")
+
+                side_effect_pipeline.submit(
+                    "stock_alert", _apply_stock_alert,
+                    user_id, yahoo_sym, display_name, alert_type, target_val, price_data is not None,
+                    key=user_id,
+                )
+        except Exception as e:
+            logger.error(f"Stock alert processing error: {e}")
+
+    return response
+
+
+def _chat_fallback_reply(message: str, user_name: str) -> str:
+    """Fallback: ลอง local reply อย่างเดียว (ไม่ต้อง context)"""
+    try:
+        local = try_local_reply(message, user_name)
+        if local:
+            return local
+    except Exception:
+        pass
+    return f"ขอโทษนะ {user_name} ฟ้ามีปัญหาชั่วคราว ลองใหม่อีกทีนะ~ 😅"
+
+
+def _sse(event: str, data: dict) -> str:
+    """format 1 event แบบ server-sent events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(req: ChatRequest):
+    """
+    แชทกับ AI เพื่อน
+    ส่ง: user_id + message
+    ได้: reply + reminder (ถ้ามี)
+
+    ระบบ 3 ชั้น:
+    1. ลอง local reply ก่อน (ฟรี)
+    2. คำถามหุ้นที่ไม่ขึ้นกับผู้ใช้ → answer cache (ฟรีถ้า hit)
+    3. ถ้าตอบไม่ได้ → ส่งไป Claude Haiku พร้อม context เต็ม (miss ของชั้น 2 เก็บคำตอบเข้า cache)
+    """
+    logger = logging.getLogger(__name__)
+
+    ctx, memory = await _load_chat_state(req)
+    user_name = ctx.user["name"]
+    personality = ctx.user["personality"]
+
+    try:
+        # ========== Full Context (ข้อมูลทั้งหมดของผู้ใช้ — โหลดมาแล้วจาก load_chat_context) ==========
+        user_context = ctx.to_user_context()
 
         # ========== ชั้น 1: Local Reply (ฟรี) + Context-Aware ==========
-        local_reply = try_local_reply(req.message, user_name, user_context)
+        local_reply = await _try_local_reply(req.message, user_name, user_context)
         if local_reply:
-            db.save_message(req.user_id, "assistant", local_reply)
+            await adb.save_message(req.user_id, "assistant", local_reply)
             logger.info(f"Local reply for '{user_name}': {local_reply[:50]}")
             return ChatResponse(reply=local_reply)
 
-        # ========== ชั้น 2: Claude Haiku + Full Context ==========
-        recent_messages = db.get_recent_messages(req.user_id, limit=6)
-
-        # Smart Stock Injection: ดึงจาก CACHE (ตอบทันที ไม่ต้องรอ yfinance)
-        stock_context = None
-        if is_stock_related_message(req.message):
-            try:
-                context_parts = []
-
-                # 1. ข้อมูลวิเคราะห์หุ้นที่ถาม (จาก cache)
-                symbols = detect_stock_symbols_in_message(req.message)
-                if symbols:
-                    for sym in symbols[:2]:
-                        yahoo_sym, _ = format_symbol(sym)
-                        analysis = get_stock_analysis_cached(yahoo_sym)
-                        if analysis:
-                            context_parts.append(format_analysis_for_ai(analysis))
-
-                # 2. ภาพรวมตลาด (จาก cache)
-                market = get_market_overview_cached()
-                if market:
-                    context_parts.append(format_market_overview_for_ai(market))
-
-                # 3. Watchlist ของผู้ใช้ (จาก cache)
-                watchlist = get_watchlist_summary_cached(req.user_id)
-                if watchlist:
-                    context_parts.append(watchlist)
-
-                if context_parts:
-                    stock_context = "\n\n".join(context_parts)
-                    logger.info(f"📊 Stock context from CACHE: symbols={symbols}, market={'Yes' if market else 'No'}")
-            except Exception as e:
-                logger.warning(f"Stock context injection failed (skipping): {e}")
-
-        ai_result = await call_haiku(
+        # ========== ชั้น 2: Answer Cache (คำถามหุ้นที่ไม่ขึ้นกับผู้ใช้) ==========
+        shared = await _plan_shared_answer(req.message, personality)
+        if shared:
+            cached_reply = answer_cache.cache.get(shared[0], user_name)
+            if cached_reply:
+                await adb.save_message(req.user_id, "assistant", cached_reply)
+                logger.info(f"Answer cache hit for '{user_name}': {cached_reply[:50]}")
+                return ChatResponse(reply=cached_reply)
+
+        # ========== ชั้น 3: Claude Haiku + Full Context ==========
+        # miss ของชั้น 2 → คำตอบจะถูกใช้ซ้ำกับคนอื่น: ส่งเฉพาะข้อมูลกลาง (ไม่มีข้อมูลส่วนตัวของผู้ถาม)
+        llm_args = dict(
             message=req.message,
             user_name=user_name,
             personality=personality,
             memory=memory,
-            recent_messages=recent_messages,
+            recent_messages=ctx.recent_messages,
             user_context=user_context,
-            stock_context=stock_context,
+            conversation_summary=ctx.conversation_summary,
         )
+        if shared:
+            llm_args = answer_cache.shared_llm_args(llm_args, shared[1])
+        else:
+            llm_args["stock_context"] = await _build_stock_context(req.user_id, req.message)
 
-        reply = ai_result["reply"]
-
-        # บันทึกคำตอบ AI
-        db.save_message(req.user_id, "assistant", reply)
+        ai_result = await call_haiku(**llm_args)
+        if shared:
+            _store_shared_answer(shared, ai_result, user_name, req.message)
 
-        # ========== จัดการ Memory ==========
-        if ai_result["memory_update"]:
-            process_memory_update(req.user_id, ai_result["memory_update"])
+        return await _apply_ai_result(req.user_id, ai_result)
 
-        # ========== จัดการ Reminder ==========
-        response = ChatResponse(reply=reply)
+    except Exception as e:
+        logger.error(f"Chat error for user '{user_name}' ({req.user_id}): {e}", exc_info=True)
+        return ChatResponse(reply=_chat_fallback_reply(req.message, user_name))
 
-        # ส่ง raw reminder line กลับ Flutter เสมอ (debug)
-        raw_reminder_line = ai_result.get("raw_reminder_line")
-        if raw_reminder_line:
-            response.debug_reminder_raw = raw_reminder_line
 
-        raw_reminder = ai_result.get("reminder")
-        if raw_reminder:
-            logger.info(f"🔔 Parsed reminder value: '{raw_reminder}'")
-            parsed = parse_reminder_text(raw_reminder)
-            if parsed:
-                db.add_reminder(req.user_id, parsed["message"], parsed["remind_at"])
-                response.has_reminder = True
-                response.reminder_message = parsed["message"]
-                response.reminder_time = parsed["remind_at"]
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """
+    แชทแบบ stream (server-sent events) — ส่งคำตอบทีละส่วนทันทีที่ Claude generate
+    event: token → {"text": "..."}   (ส่วนของ REPLY ต่อท้ายกันไปเรื่อย ๆ)
+    event: done  → ChatResponse ครบทุก field (reply ฉบับสมบูรณ์ + reminder + stock)
+    MEMORY_UPDATE / REMINDER / STOCK_ALERT ไม่ถูกส่งเป็น token — จัดการหลัง stream จบ
+    """
+    logger = logging.getLogger(__name__)
 
-                # ตั้ง push notification ตรงเวลา
-                schedule_push_for_reminder(req.user_id, parsed["message"], parsed["remind_at"])
+    ctx, memory = await _load_chat_state(req)  # 404 ก่อนเริ่ม stream
+    user_name = ctx.user["name"]
+    personality = ctx.user["personality"]
 
-                logger.info(f"✅ Reminder scheduled: {parsed['remind_at']} — {parsed['message']}")
+    async def event_stream():
+        try:
+            user_context = ctx.to_user_context()
+
+            # ชั้น 1: Local Reply — ส่งทั้งก้อนเป็น token เดียว
+            local_reply = await _try_local_reply(req.message, user_name, user_context)
+            if local_reply:
+                await adb.save_message(req.user_id, "assistant", local_reply)
+                logger.info(f"Local reply for '{user_name}': {local_reply[:50]}")
+                yield _sse("token", {"text": local_reply})
+                yield _sse("done", ChatResponse(reply=local_reply).model_dump())
+                return
+
+            # ชั้น 2: Answer Cache — hit ส่งทั้งก้อนเป็น token เดียว
+            shared = await _plan_shared_answer(req.message, personality)
+            if shared:
+                cached_reply = answer_cache.cache.get(shared[0], user_name)
+                if cached_reply:
+                    await adb.save_message(req.user_id, "assistant", cached_reply)
+                    logger.info(f"Answer cache hit for '{user_name}': {cached_reply[:50]}")
+                    yield _sse("token", {"text": cached_reply})
+                    yield _sse("done", ChatResponse(reply=cached_reply).model_dump())
+                    return
+
+            # ชั้น 3: Claude แบบ stream + context เต็ม (miss ของชั้น 2 ส่งเฉพาะข้อมูลกลาง — คำตอบถูกใช้ซ้ำ)
+            llm_args = dict(
+                message=req.message,
+                user_name=user_name,
+                personality=personality,
+                memory=memory,
+                recent_messages=ctx.recent_messages,
+                user_context=user_context,
+                conversation_summary=ctx.conversation_summary,
+            )
+            if shared:
+                llm_args = answer_cache.shared_llm_args(llm_args, shared[1])
             else:
-                logger.warning(f"⚠️ parse_reminder_text FAILED for: '{raw_reminder}'")
-        else:
-            logger.info(f"ℹ️ No reminder (raw_reminder_line='{raw_reminder_line}')")
+                llm_args["stock_context"] = await _build_stock_context(req.user_id, req.message)
+            ai_result = None
+            async for event in stream_haiku(**llm_args):
+                if event["type"] == "token":
+                    yield _sse("token", {"text": event["text"]})
+                else:
+                    ai_result = event["result"]
+
+            if shared:
+                _store_shared_answer(shared, ai_result, user_name, req.message)
+            response = await _apply_ai_result(req.user_id, ai_result)
+            yield _sse("done", response.model_dump())
 
-        # ========== จัดการ Stock Alert ==========
-        raw_stock = ai_result.get("stock_alert")
-        if raw_stock:
-            try:
-                parts = raw_stock.split("|")
-                if len(parts) >= 3:
-                    sym_input = parts[0].strip()
-                    alert_type = parts[1].strip()
-                    target_val = float(parts[2].strip())
-
-                    yahoo_sym, display_name = format_symbol(sym_input)
-
-                    # ดึงราคาปัจจุบัน
-                    price_data = get_stock_price(yahoo_sym)
-                    if price_data:
-                        db.add_stock_alert(
-                            req.user_id, yahoo_sym, display_name,
-                            alert_type, target_val,
-                        )
-                        logger.info(f"📊 Stock alert added: {display_name} ({yahoo_sym}) {alert_type} {target_val}")
-
-                        response.stock_symbol = display_name
-                        response.stock_price = price_data["price"]
-                        response.stock_change_pct = price_data["change_pct"]
-                        response.stock_currency = price_data["currency"]
-                    else:
-                        logger.warning(f"⚠️ Could not get price for {yahoo_sym}")
-            except Exception as e:
-                logger.error(f"Stock alert processing error: {e}")
-
-        return response
+        except Exception as e:
+            logger.error(f"Chat stream error for user '{user_name}' ({req.user_id}): {e}", exc_info=True)
+            yield _sse("error", {"reply": _chat_fallback_reply(req.message, user_name)})
 
-    except Exception as e:
-        logger.error(f"Chat error for user '{user_name}' ({req.user_id}): {e}", exc_info=True)
-        # Fallback: ลอง local reply อย่างเดียว (ไม่ต้อง context)
-        try:
-            local = try_local_reply(req.message, user_name)
-            if local:
-                return ChatResponse(reply=local)
-        except Exception:
-            pass
-        return ChatResponse(
-            reply=f"ขอโทษนะ {user_name} ฟ้ามีปัญหาชั่วคราว ลองใหม่อีกทีนะ~ 😅"
-        )
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/reminders/{user_id}", response_model=list[ReminderItem])
 async def get_reminders(user_id: str):
     """ดึง reminder ที่ยังไม่เสร็จ"""
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    reminders = db.get_pending_reminders(user_id)
+    reminders = await adb.get_pending_reminders(user_id)
     return [
         ReminderItem(
             id=r["id"],
@@ -503,7 +705,7 @@ async def get_reminders(user_id: str):
 @app.get("/memory/{user_id}")
 async def get_memory(user_id: str):
     """ดึง memory ทั้งหมด (สำหรับ debug หรือแสดงในแอป)"""
-    memory = get_memory_summary(user_id)
+    memory = await adb.run(get_memory_summary, user_id)
     if not memory:
         raise HTTPException(status_code=404, detail="User not found")
     return memory
@@ -518,11 +720,12 @@ class AddReminderRequest(BaseModel):
 @app.post("/reminders")
 async def add_reminder(req: AddReminderRequest):
     """เพิ่ม reminder ใหม่ (จาก UI โดยตรง)"""
-    user = db.get_user(req.user_id)
+    user = await adb.get_user(req.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    db.add_reminder(req.user_id, req.message, req.remind_at)
+    if not await adb.add_reminder(req.user_id, req.message, req.remind_at):
+        return {"status": "ok", "message": "Reminder already exists"}
 
     # ตั้ง push notification ตรงเวลา
     schedule_push_for_reminder(req.user_id, req.message, req.remind_at)
@@ -533,7 +736,7 @@ async def add_reminder(req: AddReminderRequest):
 @app.post("/reminders/{reminder_id}/done")
 async def complete_reminder(reminder_id: int):
     """ทำเครื่องหมาย reminder ว่าเสร็จแล้ว"""
-    db.mark_reminder_done(reminder_id)
+    await adb.mark_reminder_done(reminder_id)
     return {"status": "ok"}
 
 
@@ -546,7 +749,7 @@ async def register_device_token(req: DeviceTokenRequest):
     if not req.user_id or not req.fcm_token:
         raise HTTPException(status_code=400, detail="user_id and fcm_token required")
 
-    db.save_device_token(req.user_id, req.fcm_token)
+    await adb.save_device_token(req.user_id, req.fcm_token)
     logger.info(f"FCM token registered for user {req.user_id}: {req.fcm_token[:20]}...")
     return {"status": "ok", "message": "Token registered"}
 
@@ -556,17 +759,25 @@ async def register_device_token(req: DeviceTokenRequest):
 @app.get("/stocks/market")
 async def market_overview():
     """ภาพรวมตลาด — SET Index, S&P 500, Gold, Oil (จาก cache)"""
-    data = get_market_overview_cached()
+    data = await asyncio.to_thread(get_market_overview_cached)
     if not data:
         raise HTTPException(status_code=503, detail="ไม่สามารถดึงข้อมูลตลาดได้ (รอ cache อัพเดท)")
     return data
 
 
+@app.get("/stocks/search")
+async def search_stocks(q: str, limit: int = 10):
+    """ค้นหาหุ้นจากชื่อย่อหรือชื่อบริษัท (prefix + สะกดผิด 1 ตัว) — ค้นใน memory ไม่ยิง Yahoo"""
+    limit = max(1, min(limit, 50))
+    results = symbol_index.search(q, limit)
+    return {"query": q, "count": len(results), "results": [r.to_dict() for r in results]}
+
+
 @app.get("/stocks/price/{symbol}")
 async def stock_price(symbol: str):
     """ดึงราคาหุ้นปัจจุบัน (จาก cache)"""
     yahoo_sym, display_name = format_symbol(symbol)
-    data = get_stock_price_cached(yahoo_sym)
+    data = await asyncio.to_thread(get_stock_price_cached, yahoo_sym)
     if not data:
         raise HTTPException(status_code=404, detail=f"ไม่พบข้อมูลหุ้น {symbol}")
     return data
@@ -576,7 +787,7 @@ async def stock_price(symbol: str):
 async def stock_analysis(symbol: str):
     """วิเคราะห์หุ้นเชิงลึก — Technical + Fundamental (จาก cache)"""
     yahoo_sym, display_name = format_symbol(symbol)
-    data = get_stock_analysis_cached(yahoo_sym)
+    data = await asyncio.to_thread(get_stock_analysis_cached, yahoo_sym)
     if not data:
         raise HTTPException(status_code=404, detail=f"ไม่พบข้อมูลหุ้น {symbol}")
     return data
@@ -585,28 +796,28 @@ async def stock_analysis(symbol: str):
 @app.get("/stocks/watchlist/{user_id}")
 async def stock_watchlist(user_id: str):
     """ดู watchlist ของ user"""
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    alerts = db.get_user_stock_alerts(user_id)
+    alerts = await adb.get_user_stock_alerts(user_id)
     return {"count": len(alerts), "watchlist": alerts}
 
 
 @app.post("/stocks/watch")
 async def add_stock_watch(req: StockWatchRequest):
     """เพิ่มหุ้นเข้า watchlist"""
-    user = db.get_user(req.user_id)
+    user = await adb.get_user(req.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     yahoo_sym, display_name = format_symbol(req.symbol)
 
     # ตรวจสอบว่า symbol ถูกต้อง
-    price_data = get_stock_price(yahoo_sym)
+    price_data = (await asyncio.to_thread(get_stock_prices, [yahoo_sym])).get(yahoo_sym)
     if not price_data:
         raise HTTPException(status_code=404, detail=f"ไม่พบข้อมูลหุ้น {req.symbol}")
 
-    alert_id = db.add_stock_alert(
+    alert_id = await adb.add_stock_alert(
         req.user_id, yahoo_sym, display_name,
         req.alert_type, req.target_value,
     )
@@ -625,10 +836,83 @@ async def add_stock_watch(req: StockWatchRequest):
 @app.delete("/stocks/watch/{alert_id}")
 async def remove_stock_watch(alert_id: int):
     """ลบหุ้นออกจาก watchlist"""
-    db.delete_stock_alert(alert_id)
+    await adb.delete_stock_alert(alert_id)
     return {"status": "ok"}
 
 
+# ==================== Live Quotes (WebSocket) ====================
+# ws://.../ws/quotes?user_id=xxx → subscribe watchlist ของ user ให้อัตโนมัติ
+# client → {"action": "subscribe" | "unsubscribe", "symbols": ["PTT", "AAPL"]}
+# server → {"type": "snapshot", "quotes": {symbol: quote}}   (ตอน subscribe — ค่าจาก cache)
+#          {"type": "quotes", "quotes": {symbol: {field ที่เปลี่ยน}}}  (ทุกครั้งที่ refresh เขียน cache)
+#          {"type": "error", "detail": "..."}
+
+WS_MAX_SYMBOLS = 50  # symbol สูงสุดต่อ connection
+
+
+async def _ws_send_quotes(websocket: WebSocket, subscriber: QuoteSubscriber):
+    """ส่ง diff ที่ hub กระจายมาให้ client (update ที่ค้างถูกรวมเป็นข้อความเดียว)"""
+    try:
+        while True:
+            batch = await subscriber.next_batch()
+            await websocket.send_json({"type": "quotes", "quotes": batch})
+    except (WebSocketDisconnect, RuntimeError):
+        pass  # client ปิดไปแล้ว — ฝั่ง receive จะเก็บกวาดเอง
+
+
+async def _ws_subscribe(websocket: WebSocket, subscriber: QuoteSubscriber, symbols: list[str]):
+    """subscribe symbols (แปลงเป็น Yahoo symbol) แล้วส่ง snapshot — symbol ที่ hub ยังไม่รู้ค่าอ่านจาก cache"""
+    yahoo_symbols = list(dict.fromkeys(format_symbol(s)[0] for s in symbols if s and s.strip()))
+    room = WS_MAX_SYMBOLS - len(subscriber.symbols)
+    if len(yahoo_symbols) > room:
+        await websocket.send_json({"type": "error", "detail": f"subscribe ได้สูงสุด {WS_MAX_SYMBOLS} symbols"})
+        yahoo_symbols = yahoo_symbols[:max(room, 0)]
+    if not yahoo_symbols:
+        return
+
+    snapshot = quote_hub.subscribe(subscriber, yahoo_symbols)
+    unknown = [s for s in yahoo_symbols if s not in snapshot]
+    if unknown:
+        for symbol, row in (await asyncio.to_thread(get_cached_quotes, unknown)).items():
+            quote_hub.seed(symbol, row)
+            snapshot[symbol] = quote_fields(row)
+    await websocket.send_json({"type": "snapshot", "quotes": snapshot})
+
+
+@app.websocket("/ws/quotes")
+async def ws_quotes(websocket: WebSocket, user_id: str | None = None):
+    """ราคาหุ้นแบบ push — ส่งเฉพาะสิ่งที่เปลี่ยนทุกครั้งที่ refresh pipeline เขียน cache ใหม่"""
+    await websocket.accept()
+    subscriber = QuoteSubscriber()
+    sender = asyncio.create_task(_ws_send_quotes(websocket, subscriber))
+    try:
+        if user_id:
+            alerts = await adb.get_user_stock_alerts(user_id)
+            await _ws_subscribe(websocket, subscriber, [a["symbol"] for a in alerts])
+
+        while True:
+            try:
+                msg = await websocket.receive_json()
+            except ValueError:
+                await websocket.send_json({"type": "error", "detail": "invalid JSON"})
+                continue
+            action = msg.get("action") if isinstance(msg, dict) else None
+            symbols = msg.get("symbols") if isinstance(msg, dict) else None
+            if action not in ("subscribe", "unsubscribe") or not isinstance(symbols, list):
+                await websocket.send_json({"type": "error", "detail": "expected {action, symbols: [...]}"})
+                continue
+            symbols = [str(s) for s in symbols]
+            if action == "subscribe":
+                await _ws_subscribe(websocket, subscriber, symbols)
+            else:
+                quote_hub.unsubscribe(subscriber, [format_symbol(s)[0] for s in symbols])
+    except WebSocketDisconnect:
+        pass
+    finally:
+        quote_hub.unsubscribe(subscriber)
+        sender.cancel()
+
+
 # ==================== Health Check ====================
 
 @app.get("/health")
@@ -642,27 +926,17 @@ async def health():
 @app.get("/debug/test-ai")
 async def debug_test_ai():
     """ทดสอบ Anthropic API key — เรียกด้วย message ง่ายๆ"""
-    import httpx as _httpx
-    from ai_brain import ANTHROPIC_API_KEY, MODEL, API_URL
+    from ai_brain import ANTHROPIC_API_KEY, MODEL
 
     if not ANTHROPIC_API_KEY:
         return {"status": "error", "detail": "ANTHROPIC_API_KEY is not set"}
 
     try:
-        async with _httpx.AsyncClient(timeout=15.0) as client:
-            resp = await client.post(
-                API_URL,
-                headers={
-                    "x-api-key": ANTHROPIC_API_KEY,
-                    "anthropic-version": "2023-06-01",
-                    "content-type": "application/json",
-                },
-                json={
-                    "model": MODEL,
-                    "max_tokens": 50,
-                    "messages": [{"role": "user", "content": "Say hello in Thai"}],
-                },
-            )
+        resp = await post_messages({
+            "model": MODEL,
+            "max_tokens": 50,
+            "messages": [{"role": "user", "content": "Say hello in Thai"}],
+        })
         if resp.status_code == 200:
             data = resp.json()
             reply = data["content"][0]["text"]
@@ -683,6 +957,26 @@ async def debug_test_ai():
         return {"status": "error", "detail": str(e)}
 
 
+@app.get("/debug/llm-stats")
+async def debug_llm_stats():
+    """
+    ดูสถิติการเรียก Claude API — latency p50/p95/p99, retries, status codes
+    + deflection ของ local intent / answer cache + การสรุปบทสนทนา
+    """
+    return {
+        **get_llm_stats(),
+        "local_replies": get_local_reply_stats(),
+        "answer_cache": answer_cache.cache.stats(),
+        "conversation_summaries": conversation_summary.get_summary_stats(),
+    }
+
+
+@app.get("/debug/side-effects")
+async def debug_side_effects():
+    """สถิติ pipeline งานหลังตอบแชท — คิว, retry, ล้มเหลว, เวลาจาก submit → เสร็จ"""
+    return side_effect_pipeline.stats()
+
+
 @app.get("/debug/test-stock-direct")
 async def debug_test_stock_direct():
     """ทดสอบ Direct HTTP Yahoo Finance — ไม่ผ่าน yfinance"""
@@ -690,7 +984,7 @@ async def debug_test_stock_direct():
     results = {}
     for sym in test_symbols:
         try:
-            price = get_stock_price_direct(sym)
+            price = await asyncio.to_thread(get_stock_price_direct, sym)
             results[sym] = {
                 "status": "ok" if price else "no_data",
                 "price": price.get("price") if price else None,
@@ -701,19 +995,29 @@ async def debug_test_stock_direct():
     return {"direct_http_test": results}
 
 
+@app.get("/debug/stock-refresh")
+async def debug_stock_refresh():
+    """ดูสถิติรอบ refresh stock cache ล่าสุด (ระยะเวลา, symbols สำเร็จ, requests, 429) + hit/miss ของ memory cache"""
+    return get_refresh_stats()
+
+
 @app.get("/debug/db-stats")
 async def debug_db_stats():
-    """ดูสถานะ Database — มี user กี่คน, message กี่ข้อความ"""
-    conn = db.get_db()
-    users = conn.execute("SELECT COUNT(*) as cnt FROM users").fetchone()["cnt"]
-    messages = conn.execute("SELECT COUNT(*) as cnt FROM messages").fetchone()["cnt"]
-    conn.close()
+    """ดูสถานะ Database — มี user กี่คน, message กี่ข้อความ + สถิติ connection pool"""
+    def _count_rows():
+        with db.get_db() as conn:
+            users = conn.execute("SELECT COUNT(*) as cnt FROM users").fetchone()["cnt"]
+            messages = conn.execute("SELECT COUNT(*) as cnt FROM messages").fetchone()["cnt"]
+        return users, messages
+
+    users, messages = await adb.run(_count_rows)
     return {
         "status": "ok",
         "users": users,
         "messages": messages,
         "db_path": str(db.DB_PATH),
         "db_exists": db.DB_PATH.exists(),
+        "pool": db.get_pool_stats(),
     }
 
 
@@ -722,25 +1026,25 @@ async def debug_db_stats():
 @app.post("/mood")
 async def add_mood(req: MoodRequest):
     """บันทึกอารมณ์ประจำวัน (1-5)"""
-    user = db.get_user(req.user_id)
+    user = await adb.get_user(req.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     if not 1 <= req.score <= 5:
         raise HTTPException(status_code=400, detail="Score must be 1-5")
 
-    db.save_mood(req.user_id, req.score, req.note)
+    await adb.save_mood(req.user_id, req.score, req.note)
     return {"status": "ok", "message": "Mood saved"}
 
 
 @app.get("/mood/{user_id}")
 async def get_mood_history(user_id: str, days: int = 7):
     """ดึงประวัติอารมณ์ย้อนหลัง"""
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    moods = db.get_mood_history(user_id, days)
+    moods = await adb.get_mood_history(user_id, days)
     return moods
 
 
@@ -749,33 +1053,31 @@ async def get_mood_history(user_id: str, days: int = 7):
 @app.get("/routines/{user_id}")
 async def get_routines(user_id: str):
     """ดึงรายการกิจวัตรทั้งหมด"""
-    user = db.get_user(user_id)
-    if not user:
+    today = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
+    ctx = await adb.load_chat_context(user_id, today)
+    if not ctx:
         raise HTTPException(status_code=404, detail="User not found")
 
-    routines = db.get_routines(user_id)
-    today = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
-    result = []
-    for r in routines:
-        done_today = db.is_routine_done_today(r["id"], today)
-        result.append({
+    return [
+        {
             "id": r["id"],
             "title": r["title"],
             "time": r["time"],
             "points": r["points"],
-            "done_today": done_today,
-        })
-    return result
+            "done_today": r["done_today"],
+        }
+        for r in ctx.routines
+    ]
 
 
 @app.post("/routines")
 async def create_routine(req: RoutineRequest):
     """สร้างกิจวัตรใหม่"""
-    user = db.get_user(req.user_id)
+    user = await adb.get_user(req.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    routine_id = db.create_routine(req.user_id, req.title, req.time, req.points)
+    routine_id = await adb.create_routine(req.user_id, req.title, req.time, req.points)
     return {"status": "ok", "id": routine_id}
 
 
@@ -783,14 +1085,14 @@ async def create_routine(req: RoutineRequest):
 async def complete_routine(routine_id: int):
     """เช็คกิจวัตรว่าทำแล้ววันนี้"""
     today = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
-    points = db.complete_routine(routine_id, today)
+    points = await adb.complete_routine(routine_id, today)
     return {"status": "ok", "points_earned": points}
 
 
 @app.delete("/routines/{routine_id}")
 async def delete_routine(routine_id: int):
     """ลบกิจวัตร"""
-    db.delete_routine(routine_id)
+    await adb.delete_routine(routine_id)
     return {"status": "ok"}
 
 
@@ -799,11 +1101,11 @@ async def delete_routine(routine_id: int):
 @app.get("/stats/{user_id}")
 async def get_user_stats(user_id: str):
     """ดึงสถิติ: streak, total points"""
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    stats = db.get_user_stats(user_id)
+    stats = await adb.get_user_stats(user_id)
     return stats
 
 
@@ -812,16 +1114,16 @@ async def get_user_stats(user_id: str):
 @app.put("/settings")
 async def update_settings(req: SettingsRequest):
     """อัพเดทการตั้งค่า"""
-    user = db.get_user(req.user_id)
+    user = await adb.get_user(req.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     if req.personality:
-        db.update_user_field(req.user_id, "personality", req.personality)
+        await adb.update_user_field(req.user_id, "personality", req.personality)
     if req.wake_time:
-        db.update_user_field(req.user_id, "wake_time", req.wake_time)
+        await adb.update_user_field(req.user_id, "wake_time", req.wake_time)
     if req.sleep_time:
-        db.update_user_field(req.user_id, "sleep_time", req.sleep_time)
+        await adb.update_user_field(req.user_id, "sleep_time", req.sleep_time)
 
     return {"status": "ok"}
 
@@ -831,36 +1133,33 @@ async def update_settings(req: SettingsRequest):
 @app.get("/brief/morning/{user_id}")
 async def morning_brief(user_id: str):
     """สร้างข้อความสรุปเช้า"""
-    user = db.get_user(user_id)
-    if not user:
+    today = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
+    ctx = await adb.load_chat_context(user_id, today)
+    if not ctx:
         raise HTTPException(status_code=404, detail="User not found")
 
-    reminders = db.get_pending_reminders(user_id)
-    routines = db.get_routines(user_id)
-    stock_brief = get_watchlist_brief_cached(user_id)
-    brief = generate_morning_brief(user["name"], reminders, routines, stock_brief)
+    stock_brief = await asyncio.to_thread(get_watchlist_brief_cached, user_id)
+    brief = generate_morning_brief(ctx.user["name"], ctx.pending_reminders, ctx.routines, stock_brief)
     return {"message": brief}
 
 
 @app.get("/brief/night/{user_id}")
 async def night_wrap(user_id: str):
     """สร้างข้อความสรุปก่อนนอน"""
-    user = db.get_user(user_id)
-    if not user:
+    today = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
+    ctx = await adb.load_chat_context(user_id, today)
+    if not ctx:
         raise HTTPException(status_code=404, detail="User not found")
 
-    today = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d")
-    routines = db.get_routines(user_id)
-    done_count = sum(1 for r in routines if db.is_routine_done_today(r["id"], today))
-    moods = db.get_mood_history(user_id, 1)
-    stats = db.get_user_stats(user_id)
+    done_count = sum(1 for r in ctx.routines if r["done_today"])
+    mood_today = next((m for m in ctx.mood_history if m["created_at"] == today), None)
 
     wrap = generate_night_wrap(
-        user_name=user["name"],
-        total_routines=len(routines),
+        user_name=ctx.user["name"],
+        total_routines=len(ctx.routines),
         done_count=done_count,
-        mood_today=moods[0] if moods else None,
-        streak=stats.get("streak", 0),
+        mood_today=mood_today,
+        streak=ctx.streak,
     )
     return {"message": wrap}
 
@@ -870,7 +1169,7 @@ async def night_wrap(user_id: str):
 @app.get("/alerts", response_model=list[AlertItem])
 async def get_alerts(severity: str | None = None, limit: int = 20):
     """ดึง alerts ทั้งหมดที่ยังไม่หมดอายุ (กรอง severity ได้)"""
-    alerts = db.get_active_alerts(severity=severity, limit=limit)
+    alerts = await adb.get_active_alerts(severity=severity, limit=limit)
     return [
         AlertItem(
             id=a["id"],
@@ -891,7 +1190,7 @@ async def get_alerts(severity: str | None = None, limit: int = 20):
 @app.get("/alerts/critical-summary")
 async def critical_summary(hours: int = 6):
     """สรุป critical alerts ใน X ชั่วโมงล่าสุด (ใช้แสดง banner)"""
-    alerts = db.get_latest_critical_alerts(hours_back=hours)
+    alerts = await adb.get_latest_critical_alerts(hours_back=hours)
     return {
         "count": len(alerts),
         "alerts": [
@@ -913,7 +1212,7 @@ async def refresh_alerts():
     """เรียก fetch alerts ทันที (manual trigger)"""
     try:
         await run_alert_fetch_job()
-        alerts = db.get_active_alerts(limit=5)
+        alerts = await adb.get_active_alerts(limit=5)
         return {
             "status": "ok",
             "message": "Alerts refreshed",
@@ -0,0 +1,69 @@
+"""
+market_hours.py — ตารางเวลาทำการของตลาดหุ้น
+ใช้ตัดสินว่าควร refresh ราคาหุ้นตัวไหนเมื่อไหร่ (ตลาดปิด = ราคาไม่เปลี่ยน ไม่ต้องยิง Yahoo)
+
+SET: จันทร์-ศุกร์ 09:55-12:30, 14:25-16:40 (รวมช่วง pre-open และ closing auction)
+US (NYSE/NASDAQ): จันทร์-ศุกร์ 09:30-16:00 เวลานิวยอร์ก (ZoneInfo จัดการ DST ให้)
+ไม่มีปฏิทินวันหยุด — stock_service ใช้ market_state ที่ Yahoo ส่งมาจับวันหยุดเอง
+"""
+
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+SET = "SET"
+US = "US"
+ALWAYS_OPEN = "24H"  # futures / FX / crypto — เทรดแทบตลอดเวลา
+
+MARKET_SESSIONS = {
+    SET: (ZoneInfo("Asia/Bangkok"), ((time(9, 55), time(12, 30)), (time(14, 25), time(16, 40)))),
+    US: (ZoneInfo("America/New_York"), ((time(9, 30), time(16, 0)),)),
+}
+
+
+def market_of(symbol: str) -> str:
+    """จัดกลุ่ม Yahoo symbol ตามตลาด: .BK / ^SET → SET, มี = หรือ -USD → 24H, ที่เหลือ → US"""
+    if symbol.endswith(".BK") or symbol.startswith("^SET"):
+        return SET
+    if "=" in symbol or symbol.endswith("-USD"):
+        return ALWAYS_OPEN
+    return US
+
+
+def _sessions_on(market: str, day) -> list[tuple[datetime, datetime]]:
+    """ช่วงเวลาซื้อขายของวันนั้น (วันตามเวลาท้องถิ่นของตลาด) — เสาร์/อาทิตย์ได้ list ว่าง"""
+    tz, sessions = MARKET_SESSIONS[market]
+    if day.weekday() >= 5:
+        return []
+    return [
+        (datetime.combine(day, start, tzinfo=tz), datetime.combine(day, end, tzinfo=tz))
+        for start, end in sessions
+    ]
+
+
+def current_session(market: str, now: datetime) -> tuple[datetime, datetime] | None:
+    """(เปิด, ปิด) ของ session ที่กำลังเปิดอยู่ตามตาราง — None ถ้าอยู่นอกเวลา"""
+    if market not in MARKET_SESSIONS:
+        return None
+    local = now.astimezone(MARKET_SESSIONS[market][0])
+    for start, end in _sessions_on(market, local.date()):
+        if start <= local < end:
+            return start, end
+    return None
+
+
+def is_scheduled_open(market: str, now: datetime) -> bool:
+    if market == ALWAYS_OPEN:
+        return True
+    return current_session(market, now) is not None
+
+
+def last_close(market: str, now: datetime) -> datetime | None:
+    """เวลาปิดของ session ล่าสุดที่จบไปแล้ว (ย้อนหลังไม่เกิน 7 วัน) — None สำหรับตลาด 24H"""
+    if market not in MARKET_SESSIONS:
+        return None
+    local = now.astimezone(MARKET_SESSIONS[market][0])
+    for back in range(8):
+        ends = [end for _, end in _sessions_on(market, local.date() - timedelta(days=back)) if end <= local]
+        if ends:
+            return max(ends)
+    return None
@@ -11,7 +11,7 @@ import xml.etree.ElementTree as ET
 
 import httpx
 
-import database as db
+import async_db as adb
 
 logger = logging.getLogger(__name__)
 
@@ -112,7 +112,7 @@ async def fetch_earthquakes() -> int:
                 f"บริเวณ {place} ความลึก {depth_km:.0f} กม."
             )
 
-            saved = db.save_alert(
+            saved = await adb.save_alert(
                 alert_type="earthquake",
                 severity=severity,
                 title=title,
@@ -203,7 +203,7 @@ async def fetch_thai_news() -> int:
                         item["guid"].encode()
                     ).hexdigest()[:16]
 
-                    saved = db.save_alert(
+                    saved = await adb.save_alert(
                         alert_type="news",
                         severity=severity,
                         title=item["title"],
@@ -233,7 +233,7 @@ async def run_alert_fetch_job():
             fetch_earthquakes(),
             fetch_thai_news(),
         )
-        db.expire_old_alerts()
+        await adb.expire_old_alerts()
         logger.info(f"[AlertJob] Done: +{eq_count} earthquakes, +{news_count} news")
     except Exception as e:
         logger.error(f"[AlertJob] Error: {e}")
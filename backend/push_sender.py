@@ -6,6 +6,7 @@ push_sender.py — Firebase Cloud Messaging Push Notification Sender
 import json
 import os
 import logging
+import time
 
 import firebase_admin
 from firebase_admin import credentials, messaging
@@ -70,35 +71,92 @@ def send_push_to_user(user_id: str, title: str, body: str,
     notification_type: "reminder" หรือ "stock_alert"
     Returns: จำนวนอุปกรณ์ที่ส่งสำเร็จ
     """
-    if not _initialized:
-        logger.warning("Firebase not initialized — skipping push")
-        return 0
+    return send_push_batch([(user_id, title, body)], notification_type)["sent"]
 
-    tokens = db.get_user_fcm_tokens(user_id)
-    if not tokens:
-        logger.info(f"No FCM tokens for user {user_id}")
-        return 0
 
-    success_count = 0
-    for token in tokens:
+# ==================== Batched Fan-out ====================
+# รวม notification ทั้งรอบ → ดึง token ทุก user ใน query เดียว → ส่งผ่าน messaging.send_each ทีละ 500
+# (FCM รับได้สูงสุด 500 message ต่อ batch) → token ที่ unregistered ลบทีเดียวตอนจบ
+
+FCM_BATCH_SIZE = 500
+
+
+def _build_message(token: str, title: str, body: str, notification_type: str) -> messaging.Message:
+    # ใช้ data-only message เพื่อให้ background handler ทำงาน
+    return messaging.Message(
+        data={
+            "type": notification_type,
+            "title": title,
+            "body": body,
+        },
+        android=messaging.AndroidConfig(priority="high"),
+        token=token,
+    )
+
+
+def send_push_batch(notifications: list[tuple[str, str, str]],
+                    notification_type: str = "reminder",
+                    transport=None) -> dict:
+    """
+    ส่ง push หลายรายการในรอบเดียว
+    notifications: [(user_id, title, body), ...] — user คนเดียวกันมีหลายรายการได้
+    transport: ฟังก์ชันแบบ messaging.send_each(list[Message]) → BatchResponse (ใส่ตัวปลอมเพื่อทดสอบได้)
+    Returns: สถิติ {notifications, tokens, sent, failed, pruned, batches, duration_s, msgs_per_sec}
+    """
+    stats = {
+        "notifications": len(notifications), "tokens": 0, "sent": 0, "failed": 0,
+        "pruned": 0, "batches": 0, "duration_s": 0.0, "msgs_per_sec": 0.0,
+    }
+    if not notifications:
+        return stats
+    if transport is None:
+        if not _initialized:
+            logger.warning("Firebase not initialized — skipping push")
+            return stats
+        transport = messaging.send_each
+
+    started = time.perf_counter()
+    tokens_by_user = db.get_fcm_tokens_for_users([n[0] for n in notifications])
+
+    outgoing: list[tuple[str, messaging.Message]] = []
+    for user_id, title, body in notifications:
+        tokens = tokens_by_user.get(user_id)
+        if not tokens:
+            logger.info(f"No FCM tokens for user {user_id}")
+            continue
+        for token in tokens:
+            outgoing.append((token, _build_message(token, title, body, notification_type)))
+    stats["tokens"] = len(outgoing)
+
+    dead_tokens: set[str] = set()
+    for i in range(0, len(outgoing), FCM_BATCH_SIZE):
+        chunk = outgoing[i:i + FCM_BATCH_SIZE]
+        stats["batches"] += 1
         try:
-            # ใช้ data-only message เพื่อให้ background handler ทำงาน
-            message = messaging.Message(
-                data={
-                    "type": notification_type,
-                    "title": title,
-                    "body": body,
-                },
-                android=messaging.AndroidConfig(priority="high"),
-                token=token,
-            )
-            messaging.send(message)
-            success_count += 1
-            logger.info(f"Push sent to {token[:20]}...")
-        except messaging.UnregisteredError:
-            logger.warning(f"Token expired, removing: {token[:20]}...")
-            db.delete_fcm_token(token)
+            response = transport([message for _, message in chunk])
         except Exception as e:
-            logger.error(f"Push failed for {token[:20]}...: {e}")
-
-    return success_count
+            logger.error(f"Push batch of {len(chunk)} failed: {e}")
+            stats["failed"] += len(chunk)
+            continue
+        for (token, _), result in zip(chunk, response.responses):
+            if result.success:
+                stats["sent"] += 1
+            elif isinstance(result.exception, messaging.UnregisteredError):
+                dead_tokens.add(token)
+                stats["failed"] += 1
+            else:
+                logger.error(f"Push failed for {token[:20]}...: {result.exception}")
+                stats["failed"] += 1
+
+    if dead_tokens:
+        logger.warning(f"Removing {len(dead_tokens)} expired tokens")
+        stats["pruned"] = db.delete_fcm_tokens(list(dead_tokens))
+
+    duration = time.perf_counter() - started
+    stats["duration_s"] = round(duration, 3)
+    stats["msgs_per_sec"] = round(stats["tokens"] / duration, 1) if duration else 0.0
+    logger.info(
+        f"Push batch: {stats['sent']}/{stats['tokens']} sent in {stats['batches']} batches, "
+        f"{stats['pruned']} pruned, {stats['msgs_per_sec']} msgs/sec"
+    )
+    return stats
@@ -0,0 +1,115 @@
+"""
+quote_hub.py — In-process Pub/Sub ของราคาหุ้น (สำหรับ /ws/quotes)
+refresh_stock_cache เขียน cache รอบใหม่ → publish() ครั้งเดียว → กระจายเฉพาะ field ที่เปลี่ยน
+ไปยังทุก WebSocket ที่ subscribe symbol นั้น (แทนการที่ทุก client poll ทุก symbol)
+
+ต่อ 1 connection มี QuoteSubscriber 1 ตัว — update ที่ยังไม่ได้ส่งจะถูกรวมกัน (ต่อ symbol)
+client ที่ช้าจึงได้ค่าล่าสุดเสมอ และ memory ไม่โตตามจำนวนรอบ refresh
+ทุก method เรียกจาก event loop เท่านั้น (ไม่ thread-safe)
+"""
+
+import asyncio
+
+# field ที่ส่งให้ client — ที่เหลือ (indicator ฯลฯ) ดูผ่าน /stocks/analysis
+QUOTE_FIELDS = ("price", "previous_close", "change_pct", "currency", "market_state", "volume")
+
+
+def quote_fields(row: dict) -> dict:
+    """ตัดเหลือเฉพาะ field ของ quote (รองรับทั้ง analysis dict ที่ใช้ prev_close และ price dict)"""
+    quote = {field: row.get(field) for field in QUOTE_FIELDS}
+    if quote["previous_close"] is None:
+        quote["previous_close"] = row.get("prev_close")
+    return {k: v for k, v in quote.items() if v is not None}
+
+
+class QuoteSubscriber:
+    """ฝั่งรับของ 1 connection — รวม diff ที่ค้างส่งไว้ใน dict เดียว"""
+
+    def __init__(self):
+        self.symbols: set[str] = set()
+        self._pending: dict[str, dict] = {}
+        self._ready = asyncio.Event()
+
+    def push(self, symbol: str, diff: dict):
+        self._pending.setdefault(symbol, {}).update(diff)
+        self._ready.set()
+
+    async def next_batch(self) -> dict[str, dict]:
+        """รอจนมี update แล้วคืนทั้งหมดที่ค้างอยู่ {symbol: {field: value}}"""
+        await self._ready.wait()
+        self._ready.clear()
+        batch, self._pending = self._pending, {}
+        return batch
+
+
+class QuoteHub:
+    """pub/sub keyed by symbol + ค่าล่าสุดที่ publish ไปแล้ว (ใช้คิด diff และส่ง snapshot ตอน subscribe)"""
+
+    def __init__(self):
+        self._subscribers: dict[str, set[QuoteSubscriber]] = {}
+        self._last: dict[str, dict] = {}
+        self.published = 0   # symbol ที่มีการเปลี่ยนแปลง (รวมทุกรอบ)
+        self.delivered = 0   # diff ที่ส่งถึง subscriber (รวมทุกรอบ)
+
+    def subscribe(self, subscriber: QuoteSubscriber, symbols) -> dict[str, dict]:
+        """เพิ่ม symbols ให้ subscriber — คืน snapshot ของ symbol ที่ hub รู้ค่าแล้ว"""
+        snapshot = {}
+        for symbol in symbols:
+            self._subscribers.setdefault(symbol, set()).add(subscriber)
+            subscriber.symbols.add(symbol)
+            if symbol in self._last:
+                snapshot[symbol] = dict(self._last[symbol])
+        return snapshot
+
+    def unsubscribe(self, subscriber: QuoteSubscriber, symbols=None):
+        """เอา symbols ออก (None = ทั้งหมด — ใช้ตอน connection ปิด)"""
+        for symbol in list(subscriber.symbols if symbols is None else symbols):
+            subs = self._subscribers.get(symbol)
+            if subs is not None:
+                subs.discard(subscriber)
+                if not subs:
+                    del self._subscribers[symbol]
+            subscriber.symbols.discard(symbol)
+
+    def seed(self, symbol: str, row: dict):
+        """ตั้งค่าเริ่มต้นจาก cache (ไม่แจ้ง subscriber) — ถ้า hub ยังไม่รู้ค่าของ symbol นี้"""
+        if symbol not in self._last:
+            self._last[symbol] = quote_fields(row)
+
+    def publish(self, rows: list[dict]) -> int:
+        """
+        รับแถวที่เพิ่งเขียนลง cache → ส่งเฉพาะ field ที่เปลี่ยนจากค่าล่าสุด
+        Returns: จำนวน diff ที่ส่งถึง subscriber
+        """
+        delivered = 0
+        for row in rows:
+            symbol = row.get("symbol")
+            if not symbol:
+                continue
+            quote = quote_fields(row)
+            last = self._last.get(symbol, {})
+            diff = {k: v for k, v in quote.items() if last.get(k) != v}
+            self._last[symbol] = {**last, **quote}
+            if not diff:
+                continue
+            self.published += 1
+            for subscriber in self._subscribers.get(symbol, ()):
+                subscriber.push(symbol, diff)
+                delivered += 1
+        self.delivered += delivered
+        return delivered
+
+    def stats(self) -> dict:
+        connections = set()
+        for subs in self._subscribers.values():
+            connections.update(subs)
+        return {
+            "connections": len(connections),
+            "symbols_subscribed": len(self._subscribers),
+            "symbols_known": len(self._last),
+            "published": self.published,
+            "delivered": self.delivered,
+        }
+
+
+hub = QuoteHub()
@@ -0,0 +1,142 @@
+"""
+side_effects.py — Pipeline งานหลังตอบแชท (memory update / reminder + push / stock alert)
+/chat ส่ง reply ให้ผู้ใช้ทันที — งานที่ต้องแตะ DB หรือรอ Yahoo ถูกส่งเข้าคิวแล้วทำใน background
+
+งาน = async function — raise เมื่อไหร่ถือว่าล้มเหลว → retry แบบ exponential backoff
+ครบ SIDE_EFFECT_MAX_ATTEMPTS ครั้งแล้วยังไม่ผ่าน → log error แล้วทิ้ง (ไม่กระทบคำตอบที่ส่งไปแล้ว)
+คิวเต็ม (DB ค้าง/ช้ามาก) → ทิ้งงานใหม่พร้อม log แทนการให้ memory โตไม่จำกัด
+worker แต่ละตัวมีคิวของตัวเอง — งานที่ส่ง key เดียวกัน (user_id) ลงคิวเดียวกันเสมอ → ทำทีละงาน
+ไม่มี read-modify-write ของผู้ใช้คนเดียวกันซ้อนกันข้าม worker (retry กลับเข้าคิวเดิม)
+งานต้อง idempotent เอง — retry รันทั้งฟังก์ชันใหม่ ขั้นที่สำเร็จไปแล้วต้องไม่ทำซ้ำ
+ทุก method เรียกจาก event loop เท่านั้น (ไม่ thread-safe) — เริ่ม/หยุดผ่าน FastAPI lifespan
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+SIDE_EFFECT_WORKERS = int(os.getenv("SIDE_EFFECT_WORKERS", "4"))
+SIDE_EFFECT_QUEUE_SIZE = int(os.getenv("SIDE_EFFECT_QUEUE_SIZE", "1000"))
+SIDE_EFFECT_MAX_ATTEMPTS = int(os.getenv("SIDE_EFFECT_MAX_ATTEMPTS", "3"))
+SIDE_EFFECT_RETRY_DELAY = float(os.getenv("SIDE_EFFECT_RETRY_DELAY", "2"))  # วินาที — รอบที่ n รอ delay * 2^(n-1)
+
+
+class SideEffectPipeline:
+    """asyncio.Queue ต่อ worker — งานที่ต้อง retry รอ backoff นอกคิว (ไม่กั้น worker)"""
+
+    def __init__(
+        self,
+        workers: int = SIDE_EFFECT_WORKERS,
+        maxsize: int = SIDE_EFFECT_QUEUE_SIZE,
+        max_attempts: int = SIDE_EFFECT_MAX_ATTEMPTS,
+        retry_delay: float = SIDE_EFFECT_RETRY_DELAY,
+    ):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # maxsize รวมทุกคิว — แบ่งเท่า ๆ กันต่อ worker
+        self._queues: list[asyncio.Queue] = [
+            asyncio.Queue(maxsize=max(1, maxsize // workers)) for _ in range(workers)
+        ]
+        self._workers: list[asyncio.Task] = []
+        self._retries: set[asyncio.Task] = set()
+        self._stats = Counter()
+        self._latencies_ms: list[float] = []  # เวลาจาก submit → สำเร็จ (1000 งานล่าสุด)
+
+    def submit(self, name: str, func, *args, key: str | None = None) -> bool:
+        """
+        ส่งงานเข้าคิว (ไม่รอ) — key เดียวกันลงคิวเดียวกัน (ทำตามลำดับ) ไม่มี key → คิวที่สั้นที่สุด
+        Returns: False ถ้าคิวเต็ม
+        """
+        if key is None:
+            index = min(range(len(self._queues)), key=lambda i: self._queues[i].qsize())
+        else:
+            index = hash(key) % len(self._queues)
+        try:
+            self._queues[index].put_nowait((name, func, args, 1, time.perf_counter(), index))
+        except asyncio.QueueFull:
+            self._stats["dropped"] += 1
+            logger.error(f"[SideEffects] queue full — dropped {name}{args}")
+            return False
+        self._stats["submitted"] += 1
+        return True
+
+    async def _retry_later(self, job: tuple, delay: float):
+        await asyncio.sleep(delay)
+        await self._queues[job[-1]].put(job)
+
+    async def _run(self, job: tuple):
+        name, func, args, attempt, submitted_at, index = job
+        try:
+            await func(*args)
+        except Exception as e:
+            if attempt >= self.max_attempts:
+                self._stats["failed"] += 1
+                logger.error(f"[SideEffects] {name} failed after {attempt} attempts: {e}", exc_info=True)
+                return
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            self._stats["retried"] += 1
+            logger.warning(f"[SideEffects] {name} attempt {attempt} failed: {e} — retry in {delay:g}s")
+            task = asyncio.create_task(self._retry_later((name, func, args, attempt + 1, submitted_at, index), delay))
+            self._retries.add(task)
+            task.add_done_callback(self._retries.discard)
+            return
+        self._stats["completed"] += 1
+        self._latencies_ms.append((time.perf_counter() - submitted_at) * 1000)
+        if len(self._latencies_ms) > 1000:
+            del self._latencies_ms[:-1000]
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            job = await queue.get()
+            try:
+                await self._run(job)
+            finally:
+                queue.task_done()
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    def _queued(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    async def stop(self, timeout: float = 10.0):
+        """รองานที่อยู่ในคิวให้เสร็จ (ไม่เกิน timeout) แล้วหยุด worker — retry ที่ยังรอ backoff ถูกทิ้ง"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[SideEffects] shutdown: {self._queued()} jobs left in queue")
+        if self._retries:
+            logger.warning(f"[SideEffects] shutdown: dropped {len(self._retries)} pending retries")
+        for task in [*self._workers, *self._retries]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._retries, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> dict:
+        ordered = sorted(self._latencies_ms)
+
+        def pct(p: float) -> float | None:
+            if not ordered:
+                return None
+            return round(ordered[max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))], 1)
+
+        return {
+            "workers": len(self._workers),
+            "queued": self._queued(),
+            "pending_retries": len(self._retries),
+            "submitted": self._stats["submitted"],
+            "completed": self._stats["completed"],
+            "retried": self._stats["retried"],
+            "failed": self._stats["failed"],
+            "dropped": self._stats["dropped"],
+            "latency_ms": {"p50": pct(50), "p95": pct(95)},
+        }
+
+
+pipeline = SideEffectPipeline()
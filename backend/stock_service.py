@@ -5,17 +5,30 @@ stock_service.py — Stock Price Monitor & Alert System + Smart Analysis
 แจ้งเตือนเมื่อถึงเงื่อนไขที่ผู้ใช้ตั้งไว้
 """
 
+import asyncio
+import bisect
 import logging
+import os
 import re
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
 from zoneinfo import ZoneInfo
 
 import yfinance as yf
 import httpx
 import pandas as pd
 
+import async_db as adb
 import database as db
+import indicators
+import market_hours
 import push_sender
+import quote_hub
+import symbol_index
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +48,26 @@ THAI_STOCK_HINTS = {
 }
 
 
+# คำที่บอกว่าข้อความเกี่ยวกับหุ้น/การลงทุน (ไม่สนตัวพิมพ์ใหญ่-เล็ก, เจอเป็น substring ก็นับ)
+STOCK_KEYWORDS = (
+    "หุ้น", "ราคาหุ้น", "ลงทุน", "กองทุน", "ตลาดหุ้น", "SET", "พอร์ต",
+    "ซื้อหุ้น", "ขายหุ้น", "วิเคราะห์หุ้น", "แนะนำหุ้น", "กราฟ",
+    "แนวรับ", "แนวต้าน", "เทคนิคอล", "RSI", "SMA", "ถัวเฉลี่ย",
+    "P/E", "ปันผล", "dividend", "stock", "invest",
+    "NASDAQ", "S&P", "ดาวโจนส์", "Dow Jones",
+)
+
+# คำอังกฤษตัวใหญ่ 2-5 ตัวที่ไม่ใช่ชื่อหุ้น
+COMMON_WORDS = {
+    "THE", "AND", "FOR", "NOT", "BUT", "ALL", "CAN", "HAD",
+    "HER", "WAS", "ONE", "OUR", "OUT", "ARE", "HAS", "HIS",
+    "HOW", "ITS", "MAY", "NEW", "NOW", "OLD", "SEE", "WAY",
+    "WHO", "DID", "GET", "LET", "SAY", "SHE", "TOO", "USE",
+    "NONE", "SET", "BIG", "TOP", "LOW", "HIGH", "BEST",
+    "GOOD", "LONG", "DAY", "TELL",
+}
+
+
 def format_symbol(user_input: str) -> tuple[str, str]:
     """
     แปลง input ของ user เป็น Yahoo Finance symbol
@@ -48,7 +81,18 @@ def format_symbol(user_input: str) -> tuple[str, str]:
         display = symbol.replace(".BK", "")
         return symbol, display
 
-    # ตรวจว่าเป็นหุ้นไทยหรือไม่
+    # ตรวจจากรายชื่อหุ้นจริง (symbol_index) — ticker ที่ซ้ำ 2 ตลาด (เช่น BA, U)
+    # เลือกหุ้นไทยเฉพาะตัวที่อยู่ใน THAI_STOCK_HINTS ไม่งั้นเป็น US ตามพฤติกรรมเดิม
+    listings = symbol_index.lookup(symbol)
+    if listings:
+        thai = [l for l in listings if l.is_thai]
+        if thai and (len(thai) == len(listings) or symbol in THAI_STOCK_HINTS):
+            return thai[0].yahoo_symbol, thai[0].symbol
+        us = next(l for l in listings if not l.is_thai)
+        return us.yahoo_symbol, us.symbol
+
+    # ไม่อยู่ในรายชื่อ — ใช้ hint เดิม (หุ้นที่เปลี่ยนชื่อ/ออกจากตลาดไปแล้ว
+    # และหุ้นไทยที่ symbols.tsv ยังไม่ครอบคลุม — ไฟล์มี SET/mai แค่บางส่วน)
     if symbol in THAI_STOCK_HINTS:
         return f"{symbol}.BK", symbol
 
@@ -60,6 +104,26 @@ def format_symbol(user_input: str) -> tuple[str, str]:
 # yfinance ถูก block บน cloud servers (Render, Heroku, AWS)
 # ใช้ direct HTTP ไปที่ Yahoo Finance v8 chart API แทน — endpoint นี้มักไม่ถูก block
 
+YAHOO_CHART_HOSTS = ("query1.finance.yahoo.com", "query2.finance.yahoo.com")
+
+YAHOO_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Accept': 'application/json,text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Referer': 'https://finance.yahoo.com/',
+    'Origin': 'https://finance.yahoo.com',
+}
+
+# ดัชนีตลาดที่ใช้ใน market overview: symbol → ชื่อที่แสดง
+MARKET_INDICES = {
+    "^SET.BK": "SET Index",
+    "^GSPC": "S&P 500",
+    "^DJI": "Dow Jones",
+    "GC=F": "Gold",
+    "CL=F": "Crude Oil",
+}
+
+
 def _safe_float(val, decimals=2):
     """Convert to rounded float, return None if NaN/None"""
     if val is None:
@@ -73,16 +137,29 @@ def _safe_float(val, decimals=2):
         return None
 
 
+# ผล None ล่าสุดของ _yahoo_direct_fetch ใน thread นี้ — not_found=True เมื่อทุก host ตอบชัดว่าไม่มี symbol
+# (_fetch_live ใช้แยก "ไม่มี symbol" ที่ cache ได้ ออกจาก timeout / 429 / 5xx ที่ต้องลองใหม่)
+_chart_status = threading.local()
+
+
+def _chart_not_found(resp) -> bool:
+    """Yahoo ตอบชัดว่าไม่มี symbol นี้ — chart.error.code == "Not Found" (ปกติมากับ HTTP 404)"""
+    try:
+        error = (resp.json().get('chart') or {}).get('error') or {}
+    except ValueError:
+        return False
+    return error.get('code') == 'Not Found'
+
+
 def _yahoo_direct_fetch(symbol: str, range_str: str = '6mo', interval: str = '1d') -> dict | None:
     """
     ดึงข้อมูลหุ้นจาก Yahoo Finance v8 chart API โดยตรง (ไม่ผ่าน yfinance)
     ใช้ได้บน cloud servers ที่ yfinance ถูก block
     Returns raw chart result dict or None
     """
-    urls = [
-        f'https://query1.finance.yahoo.com/v8/finance/chart/{symbol}',
-        f'https://query2.finance.yahoo.com/v8/finance/chart/{symbol}',
-    ]
+    urls = [f'https://{host}/v8/finance/chart/{symbol}' for host in YAHOO_CHART_HOSTS]
+    _chart_status.not_found = False
+    not_found = 0
 
     params = {
         'range': range_str,
@@ -90,17 +167,9 @@ def _yahoo_direct_fetch(symbol: str, range_str: str = '6mo', interval: str = '1d
         'includePrePost': 'false',
     }
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-        'Accept': 'application/json,text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Referer': 'https://finance.yahoo.com/',
-        'Origin': 'https://finance.yahoo.com',
-    }
-
     for url in urls:
         try:
-            with httpx.Client(headers=headers, timeout=15.0, follow_redirects=True) as client:
+            with httpx.Client(headers=YAHOO_HEADERS, timeout=15.0, follow_redirects=True) as client:
                 resp = client.get(url, params=params)
 
                 if resp.status_code == 200:
@@ -110,10 +179,13 @@ def _yahoo_direct_fetch(symbol: str, range_str: str = '6mo', interval: str = '1d
                         logger.debug(f"Yahoo direct OK: {symbol}")
                         return results[0]
 
+                if _chart_not_found(resp):
+                    not_found += 1
                 logger.debug(f"Yahoo direct: HTTP {resp.status_code} for {symbol}")
         except Exception as e:
             logger.debug(f"Yahoo direct error: {symbol}: {e}")
 
+    _chart_status.not_found = not_found == len(urls)
     return None
 
 
@@ -122,10 +194,40 @@ def get_stock_price_direct(symbol: str) -> dict | None:
     chart = _yahoo_direct_fetch(symbol, range_str='5d', interval='1d')
     if not chart:
         return None
+    return _price_from_chart(symbol, chart)
 
+
+def _chart_market_state(meta: dict) -> str:
+    """
+    สถานะตลาดจาก chart meta — ใช้ marketState ถ้ามี ไม่งั้นเทียบเวลาปัจจุบันกับ currentTradingPeriod
+    REGULAR = อยู่ในช่วงซื้อขายและมีการซื้อขายแล้วใน session นี้ (วันหยุดจะไม่มี trade → ไม่ใช่ REGULAR)
+    """
+    if meta.get('marketState'):
+        return meta['marketState']
+    regular = (meta.get('currentTradingPeriod') or {}).get('regular') or {}
+    start, end = regular.get('start'), regular.get('end')
+    if not start or not end:
+        return 'UNKNOWN'
+    now = time.time()
+    if now < start:
+        return 'PRE'
+    if now >= end:
+        return 'CLOSED'
+    return 'REGULAR' if (meta.get('regularMarketTime') or 0) >= start else 'PRE'
+
+
+def _price_from_chart(symbol: str, chart: dict) -> dict | None:
+    """แปลง chart result (v8) → price dict"""
     meta = chart.get('meta', {})
     price = meta.get('regularMarketPrice', 0)
-    prev_close = meta.get('chartPreviousClose') or meta.get('previousClose', 0)
+
+    # ราคาปิดก่อนหน้า = close ของแท่งรองสุดท้าย (chartPreviousClose คือ close ก่อนต้นช่วง chart
+    # ซึ่งเป็น 5 วัน/6 เดือนก่อน ไม่ใช่เมื่อวาน) — ถ้ามีไม่ถึง 2 แท่งค่อยใช้ค่าจาก meta
+    closes = [c for c in chart.get('indicators', {}).get('quote', [{}])[0].get('close', []) if c is not None]
+    if len(closes) >= 2:
+        prev_close = closes[-2]
+    else:
+        prev_close = meta.get('previousClose') or meta.get('chartPreviousClose', 0)
 
     if not price or price <= 0:
         return None
@@ -145,63 +247,142 @@ def get_stock_price_direct(symbol: str) -> dict | None:
         "change": round(change, 2),
         "change_pct": round(change_pct, 2),
         "currency": currency,
-        "market_state": meta.get('marketState', 'UNKNOWN'),
+        "market_state": _chart_market_state(meta),
     }
 
 
+# ==================== Price History (price_bars) ====================
+# เก็บแท่งราคารายวันไว้ใน DB → แต่ละรอบ fetch แค่ 5 วันล่าสุดแล้ว merge
+# (ไม่ต้องโหลด chart 6 เดือนทุกรอบ) และมีข้อมูลครบ ~1 ปีสำหรับ SMA200 / 52-week high-low
+
+HISTORY_BARS = 252        # ~1 ปีทำการ
+HISTORY_RANGE = '1y'      # fetch ครั้งแรก (หรือขาดช่วงนาน)
+INCREMENTAL_RANGE = '5d'  # fetch ปกติ — แค่ส่วนท้าย
+
+
+def _history_range(coverage: tuple[int, str] | None, today) -> str:
+    """เลือก range ที่ต้อง fetch จากข้อมูลที่มีใน DB (count, last_date)"""
+    if not coverage:
+        return HISTORY_RANGE
+    try:
+        gap_days = (today - datetime.strptime(coverage[1], "%Y-%m-%d").date()).days
+    except (TypeError, ValueError):
+        return HISTORY_RANGE
+    if gap_days <= 5:
+        return INCREMENTAL_RANGE  # 5d = 5 วันทำการ ครอบคลุมช่วงหยุดเสาร์-อาทิตย์
+    if gap_days <= 25:
+        return '1mo'
+    return HISTORY_RANGE
+
+
+def _chart_to_bars(chart: dict) -> list[tuple]:
+    """แปลง chart result (daily) → [(date, open, high, low, close, volume), ...] ตามเวลาท้องถิ่นของตลาด"""
+    timestamps = chart.get('timestamp') or []
+    quotes = chart.get('indicators', {}).get('quote', [{}])[0]
+    gmtoffset = chart.get('meta', {}).get('gmtoffset', 0) or 0
+    opens = quotes.get('open') or [None] * len(timestamps)
+    highs = quotes.get('high') or [None] * len(timestamps)
+    lows = quotes.get('low') or [None] * len(timestamps)
+    closes = quotes.get('close') or [None] * len(timestamps)
+    volumes = quotes.get('volume') or [None] * len(timestamps)
+
+    bars = []
+    for ts, o, h, l, c, v in zip(timestamps, opens, highs, lows, closes, volumes):
+        if c is None:
+            continue
+        day = datetime.fromtimestamp(ts + gmtoffset, tz=timezone.utc).strftime("%Y-%m-%d")
+        bars.append((day, o, h, l, c, int(v) if v is not None else None))
+    return bars
+
+
+def _merge_bars(stored: list[tuple], fetched: list[tuple], limit: int = HISTORY_BARS) -> list[tuple]:
+    """รวมแท่งที่เก็บไว้กับที่เพิ่ง fetch (วันเดียวกัน → ใช้ของใหม่) เก็บ `limit` แท่งล่าสุด"""
+    by_date = {bar[0]: bar for bar in stored}
+    by_date.update((bar[0], bar) for bar in fetched)
+    return [by_date[d] for d in sorted(by_date)][-limit:]
+
+
 def get_stock_analysis_direct(symbol: str) -> dict | None:
-    """วิเคราะห์หุ้นเชิงลึกผ่าน Direct HTTP API (ไม่ใช้ yfinance)"""
-    chart = _yahoo_direct_fetch(symbol, range_str='6mo', interval='1d')
+    """วิเคราะห์หุ้นเชิงลึกผ่าน Direct HTTP API (ไม่ใช้ yfinance) — ใช้ประวัติใน price_bars + fetch ส่วนที่ขาด"""
+    today = datetime.now(BKK_TZ).date()
+    coverage = db.get_price_bar_coverage([symbol]).get(symbol)
+    chart = _yahoo_direct_fetch(symbol, range_str=_history_range(coverage, today), interval='1d')
     if not chart:
         return None
 
-    meta = chart.get('meta', {})
-    indicators = chart.get('indicators', {})
-    quotes = indicators.get('quote', [{}])[0]
-
-    closes_raw = quotes.get('close', [])
-    highs_raw = quotes.get('high', [])
-    lows_raw = quotes.get('low', [])
-    volumes_raw = quotes.get('volume', [])
-
-    # Convert to pandas Series (drop None/NaN)
-    closes = pd.Series(closes_raw).dropna().reset_index(drop=True)
-    highs = pd.Series(highs_raw).dropna().reset_index(drop=True)
-    lows = pd.Series(lows_raw).dropna().reset_index(drop=True)
-    volumes = pd.Series(volumes_raw).fillna(0).reset_index(drop=True)
-
-    if len(closes) < 20:
-        logger.warning(f"Not enough data for direct analysis: {symbol} ({len(closes)} points)")
-        return None
+    fetched = _chart_to_bars(chart)
+    db.upsert_price_bars_many([(symbol, *bar) for bar in fetched])
+    stored = db.get_price_bars([symbol], HISTORY_BARS).get(symbol, []) if coverage else []
+    bars = _merge_bars(stored, fetched)
+    return _analyses_from_bars([(symbol, chart.get('meta', {}), bars)])[0]
+
+
+def _bar_series(bars: list[tuple]) -> tuple[list, list, list, list]:
+    """แยกแท่งราคา → closes, highs/lows (ตัด None), volumes (None → 0)"""
+    closes = [b[4] for b in bars]
+    highs = [b[2] for b in bars if b[2] is not None]
+    lows = [b[3] for b in bars if b[3] is not None]
+    volumes = [b[5] if b[5] is not None else 0 for b in bars]
+    return closes, highs, lows, volumes
+
+
+def _analyses_from_bars(items: list[tuple[str, dict, list[tuple]]]) -> list[dict | None]:
+    """
+    วิเคราะห์หลาย symbol พร้อมกัน — คำนวณ indicator ทั้งหมดใน NumPy รอบเดียว (indicators.py)
+    items: [(symbol, chart_meta, bars), ...] → list ของ analysis dict ตามลำดับเดิม (None = ข้อมูลไม่พอ)
+    """
+    if not items:
+        return []
+
+    series = [_bar_series(bars) for _, _, bars in items]
+    ind = indicators.compute_indicators(
+        indicators.pack_rows([s[0] for s in series]),
+        indicators.pack_rows([s[1] for s in series]),
+        indicators.pack_rows([s[2] for s in series]),
+        indicators.pack_rows([s[3] for s in series]),
+    )
+
+    results = []
+    for i, (symbol, meta, _) in enumerate(items):
+        n_closes = int(ind["n_closes"][i])
+        if n_closes < 20:
+            logger.warning(f"Not enough data for direct analysis: {symbol} ({n_closes} points)")
+            results.append(None)
+            continue
+        results.append(_build_analysis(symbol, meta, ind, i))
+    return results
 
-    current = float(closes.iloc[-1])
-    prev_close = float(closes.iloc[-2]) if len(closes) >= 2 else current
+
+def _build_analysis(symbol: str, meta: dict, ind: dict, i: int) -> dict:
+    """ประกอบ analysis dict ของ symbol ที่ i จากผล compute_indicators (ปัดเศษ + สร้าง signals)"""
+    current = float(ind["price"][i])
+    prev_close = float(ind["prev_close"][i])
 
     # --- Moving Averages ---
-    sma_20 = _safe_float(closes.rolling(20).mean().iloc[-1]) if len(closes) >= 20 else None
-    sma_50 = _safe_float(closes.rolling(50).mean().iloc[-1]) if len(closes) >= 50 else None
-    sma_200 = _safe_float(closes.rolling(200).mean().iloc[-1]) if len(closes) >= 200 else None
+    sma_20 = _safe_float(ind["sma_20"][i])
+    sma_50 = _safe_float(ind["sma_50"][i])
+    sma_200 = _safe_float(ind["sma_200"][i])
 
     # --- RSI (14-day) ---
-    rsi = _calculate_rsi(closes, period=14)
+    rsi = _safe_float(ind["rsi_14"][i], 1)
 
     # --- Volume Analysis ---
-    avg_vol_20 = _safe_float(volumes.rolling(20).mean().iloc[-1], 0) if len(volumes) >= 20 else None
-    current_vol = float(volumes.iloc[-1]) if len(volumes) > 0 else 0
+    avg_vol_20 = _safe_float(ind["avg_volume_20d"][i], 0)
+    current_vol = float(ind["volume"][i])
     vol_ratio = _safe_float(current_vol / avg_vol_20) if avg_vol_20 and avg_vol_20 > 0 else None
 
     # --- Price Performance ---
-    perf_1w = _calc_performance(closes, 5)
-    perf_1m = _calc_performance(closes, 22)
-    perf_3m = _calc_performance(closes, 66)
+    perf_1w = _safe_float(ind["perf_1w"][i])
+    perf_1m = _safe_float(ind["perf_1m"][i])
+    perf_3m = _safe_float(ind["perf_3m"][i])
 
     # --- Support & Resistance ---
-    support = _safe_float(lows.tail(30).min()) if len(lows) > 0 else None
-    resistance = _safe_float(highs.tail(30).max()) if len(highs) > 0 else None
+    support = _safe_float(ind["support_30d"][i])
+    resistance = _safe_float(ind["resistance_30d"][i])
 
     # --- 52-week High/Low ---
-    high_52w = _safe_float(highs.max())
-    low_52w = _safe_float(lows.min())
+    high_52w = _safe_float(ind["high_52w"][i])
+    low_52w = _safe_float(ind["low_52w"][i])
 
     # --- Trend Detection ---
     trend = "sideways"
@@ -218,11 +399,9 @@ def get_stock_analysis_direct(symbol: str) -> dict | None:
             signals.append("RSI > 70 (Overbought — อาจปรับตัวลง)")
         elif rsi < 30:
             signals.append("RSI < 30 (Oversold — อาจเด้งกลับ)")
-    if sma_20 and sma_50 and len(closes) >= 51:
-        sma20_series = closes.rolling(20).mean()
-        sma50_series = closes.rolling(50).mean()
-        sma20_prev = _safe_float(sma20_series.iloc[-2])
-        sma50_prev = _safe_float(sma50_series.iloc[-2])
+    if sma_20 and sma_50 and ind["n_closes"][i] >= 51:
+        sma20_prev = _safe_float(ind["sma_20_prev"][i])
+        sma50_prev = _safe_float(ind["sma_50_prev"][i])
         if sma20_prev and sma50_prev:
             if sma_20 > sma_50 and sma20_prev <= sma50_prev:
                 signals.append("Golden Cross (SMA20 ตัด SMA50 ขึ้น — สัญญาณบวก)")
@@ -254,7 +433,7 @@ def get_stock_analysis_direct(symbol: str) -> dict | None:
         "sma_20": sma_20,
         "sma_50": sma_50,
         "sma_200": sma_200,
-        "rsi_14": _safe_float(rsi, 1),
+        "rsi_14": rsi,
         "volume": int(current_vol) if current_vol else None,
         "avg_volume_20d": int(avg_vol_20) if avg_vol_20 else None,
         "volume_ratio": vol_ratio,
@@ -267,6 +446,7 @@ def get_stock_analysis_direct(symbol: str) -> dict | None:
         "perf_3m": perf_3m,
         "trend": trend,
         "signals": signals,
+        "market_state": _chart_market_state(meta),
     }
 
 
@@ -281,6 +461,11 @@ def get_stock_price(symbol: str) -> dict | None:
         return direct
 
     # Layer 2: yfinance (fallback for local development)
+    return _get_stock_price_yfinance(symbol)
+
+
+def _get_stock_price_yfinance(symbol: str) -> dict | None:
+    """ดึงราคาผ่าน yfinance (fallback)"""
     try:
         ticker = yf.Ticker(symbol)
         info = ticker.fast_info
@@ -322,6 +507,104 @@ def get_stock_price(symbol: str) -> dict | None:
         return None
 
 
+# ==================== Batch Quotes (multi-symbol) ====================
+# ราคาอย่างเดียวของหลาย symbol ใน request เดียวผ่าน Yahoo v7 quote endpoint
+# endpoint นี้บางครั้งต้องใช้ cookie/crumb (ตอบ 401) หรือโดน 429 → ปิด batch ชั่วคราวแล้วใช้ chart ทีละ symbol
+# พร้อมกันหลาย thread แทน (ผลลัพธ์หน้าตาเดียวกับ get_stock_price)
+
+YAHOO_QUOTE_URL = os.getenv("YAHOO_QUOTE_URL", "https://query1.finance.yahoo.com/v7/finance/quote")
+QUOTE_BATCH_SIZE = 50          # symbols ต่อ request
+QUOTE_BATCH_COOLDOWN = 600     # วินาทีที่ปิด batch หลัง endpoint ใช้ไม่ได้
+PRICE_FETCH_WORKERS = 8        # thread สำหรับ fallback ทีละ symbol
+
+_quote_batch_disabled_until = 0.0
+
+
+def _price_from_quote(quote: dict) -> dict | None:
+    """แปลง 1 รายการจาก quoteResponse.result → price dict (หน้าตาเดียวกับ _price_from_chart)"""
+    symbol = quote.get('symbol')
+    price = quote.get('regularMarketPrice')
+    if not symbol or not price or price <= 0:
+        return None
+    prev_close = quote.get('regularMarketPreviousClose') or 0
+    change = price - prev_close if prev_close else 0
+    change_pct = (change / prev_close * 100) if prev_close else 0
+    currency = quote.get('currency') or ('THB' if symbol.endswith('.BK') else 'USD')
+    return {
+        "symbol": symbol,
+        "name": quote.get('shortName') or quote.get('longName') or symbol,
+        "price": round(price, 2),
+        "previous_close": round(prev_close, 2),
+        "change": round(change, 2),
+        "change_pct": round(change_pct, 2),
+        "currency": currency,
+        "market_state": quote.get('marketState', 'UNKNOWN'),
+    }
+
+
+def _parse_quote_response(data: dict) -> dict[str, dict]:
+    results = (data.get('quoteResponse') or {}).get('result') or []
+    prices = {}
+    for quote in results:
+        price = _price_from_quote(quote)
+        if price:
+            prices[price["symbol"]] = price
+    return prices
+
+
+def _disable_quote_batch(reason: str):
+    global _quote_batch_disabled_until
+    _quote_batch_disabled_until = time.time() + QUOTE_BATCH_COOLDOWN
+    logger.info(f"Yahoo batch quote unavailable ({reason}) — per-symbol fallback for {QUOTE_BATCH_COOLDOWN}s")
+
+
+def _yahoo_quote_fetch(symbols: list[str]) -> dict[str, dict] | None:
+    """ยิง quote endpoint 1 ครั้ง — None = batch ใช้ไม่ได้ตอนนี้ (ให้ caller fallback)"""
+    if time.time() < _quote_batch_disabled_until:
+        return None
+    try:
+        with httpx.Client(headers=YAHOO_HEADERS, timeout=15.0, follow_redirects=True) as client:
+            resp = client.get(YAHOO_QUOTE_URL, params={'symbols': ','.join(symbols)})
+        if resp.status_code != 200:
+            _disable_quote_batch(f"HTTP {resp.status_code}")
+            return None
+        return _parse_quote_response(resp.json())
+    except Exception as e:
+        _disable_quote_batch(str(e))
+        return None
+
+
+def get_stock_prices(symbols: list[str]) -> dict[str, dict]:
+    """
+    ราคาปัจจุบันของหลาย symbol — batch quote ทีละ QUOTE_BATCH_SIZE ตัว
+    symbol ที่ batch ไม่ได้ (endpoint ใช้ไม่ได้ / ไม่อยู่ในผล) → get_stock_price พร้อมกันหลาย thread
+    Returns: {symbol: price dict} เฉพาะตัวที่ได้ราคา
+    """
+    unique = list(dict.fromkeys(s for s in symbols if s))
+    prices: dict[str, dict] = {}
+    missing: list[str] = []
+    for i in range(0, len(unique), QUOTE_BATCH_SIZE):
+        chunk = unique[i:i + QUOTE_BATCH_SIZE]
+        batch = _yahoo_quote_fetch(chunk)
+        if batch:
+            prices.update({s: batch[s] for s in chunk if s in batch})
+        missing.extend(s for s in chunk if s not in prices)
+
+    if missing:
+        def fetch(symbol):
+            try:
+                return get_stock_price(symbol)
+            except Exception as e:
+                logger.debug(f"get_stock_prices fallback failed for {symbol}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(PRICE_FETCH_WORKERS, len(missing))) as pool:
+            for symbol, data in zip(missing, pool.map(fetch, missing)):
+                if data:
+                    prices[symbol] = data
+    return prices
+
+
 def get_stock_analysis(symbol: str) -> dict | None:
     """
     วิเคราะห์หุ้นเชิงลึก — ลอง Direct HTTP ก่อน, fallback yfinance
@@ -333,11 +616,16 @@ def get_stock_analysis(symbol: str) -> dict | None:
         return direct
 
     # Layer 2: yfinance (fallback for local development)
+    return _get_stock_analysis_yfinance(symbol)
+
+
+def _get_stock_analysis_yfinance(symbol: str) -> dict | None:
+    """วิเคราะห์หุ้นผ่าน yfinance (fallback)"""
     try:
         ticker = yf.Ticker(symbol)
 
-        # ดึงข้อมูลราคาย้อนหลัง 6 เดือน
-        hist = ticker.history(period="6mo")
+        # ดึงข้อมูลราคาย้อนหลัง 1 ปี (พอสำหรับ SMA200 + 52-week high/low)
+        hist = ticker.history(period="1y")
         if hist.empty or len(hist) < 20:
             logger.warning(f"Not enough history for {symbol}")
             return None
@@ -550,57 +838,94 @@ def format_analysis_for_ai(analysis: dict) -> str:
     return "\n".join(lines)
 
 
+# ==================== Message Scanner ====================
+# หา keyword หุ้น + ชื่อหุ้นในข้อความแชทด้วย regex ตัวเดียวที่ compile ไว้ตอน import (ผ่านข้อความรอบเดียว)
+# รายการคำถูกแปลงเป็น trie regex (เช่น PTT|PTTEP|PTTGC → PTT(?:EP|GC)?) → ต้นทุนต่อตัวอักษร
+# ขึ้นกับความยาวคำ ไม่ใช่จำนวนคำ — ใส่ชื่อหุ้นทั้งตลาดหลายพันตัวได้โดยไม่ช้าลง
+# keyword หาแยกอีก pattern (substring ไม่สนตัวพิมพ์ เหมือนวิธีเดิม) — ถ้ารวมใน pattern เดียวกัน
+# keyword จะกินหัวของ ticker (SMA ใน SMAR, SET ใน SETI) จนหาชื่อหุ้นไม่เจอ
+
+def _trie_regex(words) -> str:
+    """สร้าง regex (ไม่มี group จับ) ที่ match คำใดคำหนึ่งใน words — เลือกคำที่ยาวที่สุดก่อน"""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def emit(node: dict) -> str:
+        optional = "" in node
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if optional:
+            # จบคำตรงนี้ได้ แต่ลองคำที่ยาวกว่าก่อน (? แบบ greedy)
+            return body + "?" if len(branches) > 1 or len(branches[0]) == 1 else f"(?:{body})?"
+        return body
+
+    return emit(trie)
+
+
+class StockScanner:
+    """scanner ที่ compile ครั้งเดียว — scan() คืน (keywords ที่เจอ, ชื่อหุ้นที่เจอ)"""
+
+    def __init__(self, keywords, thai_symbols, common_words=frozenset()):
+        self._keywords = {kw.lower(): kw for kw in keywords}
+        self._thai_symbols = frozenset(s.upper() for s in thai_symbols)
+        self._common_words = frozenset(common_words)
+        self._keyword_pattern = re.compile(rf"(?i:{_trie_regex(self._keywords)})")
+        self._symbol_pattern = re.compile(
+            rf"\b(?P<thai>(?i:{_trie_regex(self._thai_symbols)}))\b"
+            r"|\b(?P<us>[A-Z]{2,5})\b"
+        )
+
+    def scan(self, message: str) -> tuple[list[str], list[str]]:
+        """หุ้นไทยที่รู้จักมาก่อน (ตามลำดับในข้อความ) แล้วตามด้วยตัวย่อหุ้นต่างประเทศ — ไม่ซ้ำ"""
+        keywords = {self._keywords.get(m.lower(), m): None for m in self._keyword_pattern.findall(message)}
+        thai: dict[str, None] = {}
+        foreign: dict[str, None] = {}
+        for m in self._symbol_pattern.finditer(message):
+            kind = m.lastgroup
+            text = m.group(kind)
+            if kind == "thai":
+                thai[text.upper()] = None
+            elif text not in self._common_words and text not in self._thai_symbols:
+                foreign[text] = None
+        return list(keywords), list(thai) + [s for s in foreign if s not in thai]
+
+
+_scanner = StockScanner(STOCK_KEYWORDS, THAI_STOCK_HINTS, COMMON_WORDS)
+
+
+def scan_stock_message(message: str) -> tuple[list[str], list[str]]:
+    """(keywords หุ้น, ชื่อหุ้นสูงสุด 3 ตัว) จากข้อความแชท ในการ scan รอบเดียว"""
+    keywords, symbols = _scanner.scan(message)
+    return keywords, symbols[:3]  # max 3 symbols per message
+
+
 def detect_stock_symbols_in_message(message: str) -> list[str]:
     """ตรวจจับชื่อหุ้นในข้อความแชท — ใช้ตอน detect ว่าผู้ใช้ถามเรื่องหุ้น"""
-    symbols = []
-
-    # ตรวจจับหุ้นไทยที่รู้จัก
-    msg_upper = message.upper()
-    for sym in THAI_STOCK_HINTS:
-        if sym in msg_upper:
-            # ตรวจว่าเป็น whole word
-            pattern = r'\b' + re.escape(sym) + r'\b'
-            if re.search(pattern, msg_upper):
-                symbols.append(sym)
-
-    # ตรวจจับหุ้นต่างประเทศ (1-5 ตัวอักษร uppercase, ไม่ใช่คำธรรมดา)
-    common_words = {"THE", "AND", "FOR", "NOT", "BUT", "ALL", "CAN", "HAD",
-                    "HER", "WAS", "ONE", "OUR", "OUT", "ARE", "HAS", "HIS",
-                    "HOW", "ITS", "MAY", "NEW", "NOW", "OLD", "SEE", "WAY",
-                    "WHO", "DID", "GET", "LET", "SAY", "SHE", "TOO", "USE",
-                    "NONE", "SET", "BIG", "TOP", "LOW", "HIGH", "BEST",
-                    "GOOD", "LONG", "DAY", "TELL"}
-    us_pattern = re.findall(r'\b([A-Z]{2,5})\b', message)
-    for sym in us_pattern:
-        if sym not in common_words and sym not in THAI_STOCK_HINTS and sym not in symbols:
-            symbols.append(sym)
-
-    return symbols[:3]  # max 3 symbols per message
+    return scan_stock_message(message)[1]
+
+
+def is_stock_related_message(message: str) -> bool:
+    """ตรวจว่าข้อความเกี่ยวกับหุ้น/การลงทุนหรือไม่ (มี keyword หรือมีชื่อหุ้น)"""
+    keywords, symbols = scan_stock_message(message)
+    return bool(keywords or symbols)
 
 
 def get_market_overview() -> dict | None:
     """
     ดึงสถานะตลาดรวม — SET Index, S&P 500, ทองคำ, น้ำมัน
-    ใช้ get_stock_price() ซึ่งลอง Direct HTTP ก่อน yfinance
-    """
-    indices = {
-        "^SET.BK": "SET Index",
-        "^GSPC": "S&P 500",
-        "^DJI": "Dow Jones",
-        "GC=F": "Gold",
-        "CL=F": "Crude Oil",
+    ใช้ get_stock_prices() — ทุก index ใน request เดียว (fallback ทีละตัวผ่าน Direct HTTP / yfinance)
+    """
+    prices = get_stock_prices(list(MARKET_INDICES))
+    results = {
+        name: {"price": prices[sym]["price"], "change_pct": prices[sym]["change_pct"]}
+        for sym, name in MARKET_INDICES.items() if sym in prices
     }
-    results = {}
-    for sym, name in indices.items():
-        try:
-            data = get_stock_price(sym)
-            if data:
-                results[name] = {
-                    "price": data["price"],
-                    "change_pct": data["change_pct"],
-                }
-        except Exception as e:
-            logger.debug(f"Market overview skip {sym}: {e}")
     return results if results else None
 
 
@@ -642,10 +967,11 @@ def get_watchlist_summary(user_id: str) -> str:
             alert_desc = f"เตือนถ้าเปลี่ยน ±{a['target_value']}%"
         symbols[sym]["alerts"].append(alert_desc)
 
-    # Fetch current prices
+    # Fetch current prices (ทุก symbol ใน batch เดียว)
+    prices = get_stock_prices(list(symbols))
     lines = [f"📋 หุ้นที่ {user_id[:8]} ติดตามอยู่:"]
     for sym, info in symbols.items():
-        price_data = get_stock_price(sym)
+        price_data = prices.get(sym)
         if price_data:
             emoji = "📈" if price_data["change_pct"] >= 0 else "📉"
             lines.append(
@@ -669,9 +995,10 @@ def get_watchlist_brief(user_id: str) -> str | None:
     symbols = set(a["symbol"] for a in alerts)
     display_map = {a["symbol"]: a["display_name"] for a in alerts}
 
+    prices = get_stock_prices(sorted(symbols))
     parts = []
     for sym in symbols:
-        price_data = get_stock_price(sym)
+        price_data = prices.get(sym)
         if price_data:
             display = display_map.get(sym, sym)
             pct = price_data["change_pct"]
@@ -683,11 +1010,308 @@ def get_watchlist_brief(user_id: str) -> str | None:
     return "หุ้นวันนี้: " + " | ".join(parts)
 
 
+# ==================== In-Process Quote Cache ====================
+# ชั้น memory หน้า stock_cache / market_cache — chat path ไม่ต้องเปิด SQLite, parse fetched_at, decode signals_json ทุกครั้ง
+# refresh_stock_cache เขียนผ่าน (write-through) ทุกรอบ, miss ค่อยอ่าน DB แล้วเก็บไว้
+# อายุข้อมูลนับจาก fetched_at จริง (ไม่ใช่เวลาที่เข้า memory) → max_age_minutes ให้ผลเหมือนอ่าน DB
+
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "2048"))
+QUOTE_CACHE_TTL = int(os.getenv("QUOTE_CACHE_TTL", "900"))  # วินาที — เท่ากับ max_age สูงสุดที่ caller ใช้ (15 นาที)
+
+MARKET_CACHE_KEY = "__market__"
+
+
+class _TTLCache:
+    """
+    LRU + TTL cache (thread-safe — ถูกเรียกจาก asyncio.to_thread และ DB executor พร้อมกันได้)
+    value ที่คืนไปเป็น object ตัวเดียวกับที่เก็บไว้ — ผู้เรียกห้ามแก้ไข
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str, max_age: float | None = None):
+        """
+        คืน value ถ้ายังไม่เกิน max_age วินาที (default = ttl) — ไม่งั้น None
+        max_age เกิน ttl ได้ (ราคาของตลาดที่ปิดอยู่ ใช้ได้จนกว่าตลาดจะเปิด)
+        """
+        limit = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            fetched_ts, value = entry
+            age = time.time() - fetched_ts
+            if age > limit:
+                if age > max(limit, self.ttl):
+                    del self._data[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value, fetched_ts: float | None = None):
+        with self._lock:
+            self._data[key] = (time.time() if fetched_ts is None else fetched_ts, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys=None) -> int:
+        """ลบ key ที่ระบุ (None = ล้างทั้งหมด) — คืนจำนวนที่ลบ"""
+        with self._lock:
+            if keys is None:
+                removed = len(self._data)
+                self._data.clear()
+            else:
+                removed = sum(1 for k in keys if self._data.pop(k, None) is not None)
+            self.invalidations += removed
+            return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+_quote_cache = _TTLCache(QUOTE_CACHE_SIZE, QUOTE_CACHE_TTL)
+
+
+def _fetched_ts(fetched_at: str | None) -> float | None:
+    try:
+        fetched = datetime.fromisoformat(fetched_at)
+    except (TypeError, ValueError):
+        return None
+    if fetched.tzinfo is None:
+        fetched = fetched.replace(tzinfo=BKK_TZ)
+    return fetched.timestamp()
+
+
+def _stock_cache_entry(data: dict) -> dict:
+    """แปลง analysis dict (จาก refresh) ให้หน้าตาเหมือนแถว stock_cache ที่ db.get_stock_cache คืน"""
+    entry = dict(data)
+    entry["previous_close"] = data.get("previous_close") or data.get("prev_close")
+    entry["signals"] = data.get("signals") or []
+    return entry
+
+
+def _effective_max_age(symbol: str, max_age_minutes: int) -> float:
+    """
+    อายุสูงสุด (วินาที) ที่ยอมรับได้ของข้อมูล symbol นี้
+    ตลาดปิด → ราคาไม่เปลี่ยนตั้งแต่ปิด: ข้อมูลที่ดึงหลังเวลาปิดล่าสุดยังใช้ได้ (freeze)
+    """
+    max_age = max_age_minutes * 60
+    market = market_hours.market_of(symbol)
+    if market_is_open(market):
+        return max_age
+    closed_at = market_hours.last_close(market, datetime.now(BKK_TZ))
+    if closed_at is None:
+        return max_age
+    return max(max_age, time.time() - closed_at.timestamp())
+
+
+def _cached_stock(symbol: str, max_age_minutes: int) -> dict | None:
+    """อ่าน stock cache จาก memory ก่อน — miss ค่อยอ่าน DB แล้วเก็บไว้"""
+    max_age = _effective_max_age(symbol, max_age_minutes)
+    data = _quote_cache.get(symbol, max_age)
+    if data is not None:
+        return data
+    data = db.get_stock_cache(symbol, max_age_minutes=max_age / 60)
+    if data:
+        fetched_ts = _fetched_ts(data.get("fetched_at"))
+        if fetched_ts is not None:
+            _quote_cache.put(symbol, data, fetched_ts)
+    return data
+
+
+def _put_market(overview: dict, fetched: dict[str, float]):
+    """เก็บ market overview ใน memory พร้อมเวลาที่ดึงราย index (symbol → timestamp) — entry นับอายุจาก index ที่เก่าสุด"""
+    _quote_cache.put(MARKET_CACHE_KEY, (overview, fetched), min(fetched.values()))
+
+
+def _cached_market(max_age_minutes: int) -> dict | None:
+    """
+    market overview จาก memory ก่อน — miss ค่อยอ่าน DB แล้วเก็บไว้จนกว่า refresh จะเขียนรอบใหม่
+    เช็คอายุราย index: index ของตลาดที่ปิดอยู่ไม่ถูก refresh → ใช้ได้ถึงเวลาปิดล่าสุดของตลาดนั้น (freeze)
+    index ของตลาดที่เปิดอยู่ต้องไม่เก่าเกิน max_age — index ที่หมดอายุไม่ถูกส่งออก
+    """
+    max_ages = {symbol: _effective_max_age(symbol, max_age_minutes) for symbol in MARKET_INDICES}
+    now = time.time()
+    entry = _quote_cache.get(MARKET_CACHE_KEY, max(max_ages.values()))
+    if entry is not None:
+        overview, fetched = entry
+        if all(now - ts <= max_ages.get(symbol, max_age_minutes * 60) for symbol, ts in fetched.items()):
+            return overview
+
+    overview, fetched = {}, {}
+    for row in db.get_market_cache_rows():
+        fetched_ts = _fetched_ts(row.get("fetched_at"))
+        if fetched_ts is None or now - fetched_ts > max_ages.get(row["symbol"], max_age_minutes * 60):
+            continue
+        overview[row["index_name"]] = {"price": row["price"], "change_pct": row["change_pct"]}
+        fetched[row["symbol"]] = fetched_ts
+    if not overview:
+        return None
+    _put_market(overview, fetched)
+    return overview
+
+
+def get_cached_quotes(symbols: list[str]) -> dict[str, dict]:
+    """ราคาล่าสุดใน cache (memory → DB) ของหลาย symbol — ไม่ดึงสด (ใช้ทำ snapshot ให้ /ws/quotes)"""
+    quotes = {}
+    for symbol in symbols:
+        cached = _cached_stock(symbol, max_age_minutes=15)
+        if cached and cached.get("price"):
+            quotes[symbol] = cached
+    return quotes
+
+
+def cache_stock_rows(rows: list[dict]):
+    """write-through หลังเขียน stock_cache — ข้อมูลรอบนี้ใช้ได้ทันทีโดยไม่ต้องอ่าน DB"""
+    now = time.time()
+    for row in rows:
+        if row.get("symbol"):
+            _quote_cache.put(row["symbol"], _stock_cache_entry(row), now)
+    _missing_symbols.invalidate([
+        f"{kind}:{row['symbol']}" for row in rows if row.get("symbol") for kind in ("price", "analysis")
+    ])
+
+
+def invalidate_quote_cache(symbols: list[str] | None = None) -> int:
+    """ล้าง memory cache ของ symbol ที่ระบุ (None = ทั้งหมด รวม market overview)"""
+    return _quote_cache.invalidate(symbols)
+
+
+def get_quote_cache_stats() -> dict:
+    """hit/miss/eviction ของ memory cache + single-flight + negative cache"""
+    return {
+        **_quote_cache.stats(),
+        "single_flight": _inflight.stats(),
+        "negative_cache": _missing_symbols.stats(),
+    }
+
+
+# ==================== Single-flight Live Fetch ====================
+# cache miss พร้อมกันหลาย request (เช่น 50 คนถาม PTT ในนาทีเดียว) → ยิง Yahoo จริงครั้งเดียว
+# thread แรกเป็นคนดึง ที่เหลือรอผลชุดเดียวกัน — symbol ที่ Yahoo ตอบว่าไม่มีจำไว้ช่วงหนึ่ง (negative cache)
+
+SINGLE_FLIGHT_WAIT = float(os.getenv("SINGLE_FLIGHT_WAIT", "20"))  # วินาทีที่ผู้รอยอมรอสูงสุด
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", "300"))    # วินาทีที่จำว่า symbol ไม่มีอยู่จริง
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Exception | None = None
+
+
+class _SingleFlight:
+    """รวม call ที่ key เดียวกันและเกิดพร้อมกัน (จากหลาย thread) ให้ทำงานจริงครั้งเดียว"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, _Flight] = {}
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key: str, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not call.done.wait(SINGLE_FLIGHT_WAIT):
+                self.timeouts += 1
+                logger.warning(f"Single-flight wait timed out: {key}")
+                return None
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"leaders": self.leaders, "shared": self.shared, "timeouts": self.timeouts, "in_flight": in_flight}
+
+
+_inflight = _SingleFlight()
+_missing_symbols = _TTLCache(1024, NEGATIVE_CACHE_TTL)  # key = "kind:symbol"
+
+
+def _fetch_live(kind: str, symbol: str, loader) -> dict | None:
+    """
+    ดึงสดผ่าน single-flight — จำ None ไว้ NEGATIVE_CACHE_TTL เฉพาะเมื่อ Yahoo chart ตอบ "Not Found"
+    None จาก timeout / 429 / 5xx ไม่จำ (request ถัดไปลองใหม่) — แยก key ตาม kind (price / analysis)
+    """
+    key = f"{kind}:{symbol}"
+    if _missing_symbols.get(key):
+        return None
+
+    def load():
+        _chart_status.not_found = False
+        data = loader(symbol)
+        if data is None and _chart_status.not_found:
+            _missing_symbols.put(key, True)
+        return data
+
+    return _inflight.do(key, load)
+
+
+def _load_stock_analysis(symbol: str) -> dict | None:
+    data = get_stock_analysis(symbol)
+    if data:
+        db.upsert_stock_cache(data)
+        cache_stock_rows([data])
+    return data
+
+
 # ==================== Cached Versions (อ่านจาก DB ก่อน, fallback ดึงสด) ====================
 
 def get_stock_price_cached(symbol: str) -> dict | None:
     """ดึงราคาหุ้นจาก cache ก่อน — ถ้าหมดอายุค่อย fetch ใหม่"""
-    cached = db.get_stock_cache(symbol, max_age_minutes=10)
+    cached = _cached_stock(symbol, max_age_minutes=10)
     if cached and cached.get("price"):
         return {
             "symbol": cached["symbol"],
@@ -699,11 +1323,10 @@ def get_stock_price_cached(symbol: str) -> dict | None:
             "currency": cached.get("currency", "THB" if symbol.endswith(".BK") else "USD"),
             "market_state": cached.get("market_state", "CACHED"),
         }
-    # Cache miss → ดึงสดแต่ limit timeout
+    # Cache miss → ดึงสด (request พร้อมกันของ symbol เดียวกันรอผลชุดเดียว)
     try:
-        data = get_stock_price(symbol)
         # ไม่ upsert price-only data ลง stock_cache — จะไป overwrite analysis data ที่มีอยู่
-        return data
+        return _fetch_live("price", symbol, get_stock_price)
     except Exception as e:
         logger.warning(f"get_stock_price_cached fallback failed for {symbol}: {e}")
         return None
@@ -711,7 +1334,7 @@ def get_stock_price_cached(symbol: str) -> dict | None:
 
 def get_stock_analysis_cached(symbol: str) -> dict | None:
     """ดึง analysis จาก cache ก่อน — ถ้าหมดอายุค่อย fetch ใหม่"""
-    cached = db.get_stock_cache(symbol, max_age_minutes=10)
+    cached = _cached_stock(symbol, max_age_minutes=10)
     # ต้องมี technical data (sma_20 หรือ rsi_14) ไม่ใช่แค่ price-only
     has_analysis = cached and cached.get("price") and (
         cached.get("sma_20") is not None or cached.get("rsi_14") is not None
@@ -747,12 +1370,9 @@ def get_stock_analysis_cached(symbol: str) -> dict | None:
             "trend": cached.get("trend", "sideways"),
             "signals": cached.get("signals", []),
         }
-    # Cache miss → ดึงสด
+    # Cache miss → ดึงสด + cache (request พร้อมกันของ symbol เดียวกันรอผลชุดเดียว)
     try:
-        data = get_stock_analysis(symbol)
-        if data:
-            db.upsert_stock_cache(data)
-        return data
+        return _fetch_live("analysis", symbol, _load_stock_analysis)
     except Exception as e:
         logger.warning(f"get_stock_analysis_cached fallback failed for {symbol}: {e}")
         return None
@@ -760,21 +1380,20 @@ def get_stock_analysis_cached(symbol: str) -> dict | None:
 
 def get_market_overview_cached() -> dict | None:
     """ดึง market overview จาก cache ก่อน"""
-    cached = db.get_market_cache(max_age_minutes=10)
+    cached = _cached_market(max_age_minutes=10)
     if cached:
         return cached
     # Cache miss → ดึงสด + cache
     try:
         data = get_market_overview()
         if data:
-            for name, info in data.items():
-                # หา symbol จาก name
-                sym_map = {
-                    "SET Index": "^SET.BK", "S&P 500": "^GSPC",
-                    "Dow Jones": "^DJI", "Gold": "GC=F", "Crude Oil": "CL=F",
-                }
-                sym = sym_map.get(name, "")
-                db.upsert_market_cache(name, sym, info["price"], info["change_pct"])
+            sym_map = {name: sym for sym, name in MARKET_INDICES.items()}
+            db.upsert_market_cache_many([
+                (name, sym_map.get(name, ""), info["price"], info["change_pct"])
+                for name, info in data.items()
+            ])
+            if len(data) == len(MARKET_INDICES):
+                _put_market(data, dict.fromkeys(MARKET_INDICES, time.time()))
         return data
     except Exception as e:
         logger.warning(f"get_market_overview_cached fallback failed: {e}")
@@ -803,7 +1422,7 @@ def get_watchlist_summary_cached(user_id: str) -> str:
 
     lines = [f"📋 หุ้นที่ติดตามอยู่:"]
     for sym, info in symbols.items():
-        cached = db.get_stock_cache(sym, max_age_minutes=15)
+        cached = _cached_stock(sym, max_age_minutes=15)
         if cached and cached.get("price"):
             emoji = "📈" if (cached.get("change_pct") or 0) >= 0 else "📉"
             currency = cached.get("currency", "THB")
@@ -828,7 +1447,7 @@ def get_watchlist_brief_cached(user_id: str) -> str | None:
 
     parts = []
     for sym in symbols:
-        cached = db.get_stock_cache(sym, max_age_minutes=15)
+        cached = _cached_stock(sym, max_age_minutes=15)
         if cached and cached.get("price"):
             display = display_map.get(sym, sym)
             pct = cached.get("change_pct", 0)
@@ -840,152 +1459,581 @@ def get_watchlist_brief_cached(user_id: str) -> str | None:
     return "หุ้นวันนี้: " + " | ".join(parts)
 
 
-# ==================== Background Pre-fetch Job ====================
+# ==================== Background Pre-fetch Job (Market Snapshot) ====================
+# 1 รอบ = 1 snapshot: ดึงทุก symbol ที่ถึงรอบครั้งเดียว (chart ส่วนท้าย) → ได้ทั้งราคาและ analysis
+# → เขียน stock_cache เป็น batch เดียว → เช็ค stock alerts จากราคาใน memory
+# ดึงพร้อมกันผ่าน AsyncClient ตัวเดียว (จำกัดจำนวนพร้อมกันด้วย semaphore + อัตรา request ต่อ host)
 
-def refresh_stock_cache():
-    """
-    Background job — ดึงข้อมูลหุ้นทั้งหมดใน watchlist + market overview
-    แล้วบันทึกลง cache ทุก 5 นาที (เรียกจาก APScheduler)
-    """
-    logger.info("🔄 Stock cache refresh started...")
+STOCK_REFRESH_CONCURRENCY = int(os.getenv("STOCK_REFRESH_CONCURRENCY", "8"))
+YAHOO_HOST_RPS = float(os.getenv("YAHOO_HOST_RPS", "5"))  # request/วินาที ต่อ host
+YAHOO_ASYNC_TIMEOUT = float(os.getenv("YAHOO_ASYNC_TIMEOUT", "10"))
 
-    # 1. ดึง symbols ทั้งหมดจาก watchlist
-    alerts = db.get_all_active_stock_alerts()
-    symbols = list(set(a["symbol"] for a in alerts))
-    logger.info(f"  Symbols to cache: {symbols}")
+_refresh_stats: dict = {
+    "cycles": 0,
+    "idle_ticks": 0,  # tick ที่ไม่มี symbol ถึงรอบ (ตลาดปิด) — ไม่ยิง request เลย
+    "last_cycle": None,
+    "last_prune": 0.0,
+}
 
-    cached_count = 0
-    for symbol in symbols:
+
+class _HostRateLimiter:
+    """เว้นระยะ request ต่อ host ให้ไม่เกิน rps ที่กำหนด (Yahoo จะตอบ 429 ถ้ายิงถี่เกินไป)"""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self._next_at: dict[str, float] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    async def wait(self, host: str):
+        if not self.interval:
+            return
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            next_at = self._next_at.get(host, now)
+            if next_at > now:
+                await asyncio.sleep(next_at - now)
+            self._next_at[host] = max(next_at, now) + self.interval
+
+
+async def _yahoo_direct_fetch_async(
+    client: httpx.AsyncClient,
+    limiter: _HostRateLimiter,
+    symbol: str,
+    range_str: str = '6mo',
+    interval: str = '1d',
+    counters: dict | None = None,
+) -> dict | None:
+    """async version ของ _yahoo_direct_fetch — ลอง query1 ก่อน แล้ว failover ไป query2"""
+    params = {
+        'range': range_str,
+        'interval': interval,
+        'includePrePost': 'false',
+    }
+    counters = counters if counters is not None else {}
+
+    for host in YAHOO_CHART_HOSTS:
+        await limiter.wait(host)
+        counters["requests"] = counters.get("requests", 0) + 1
         try:
-            # ดึง full analysis (รวม price, technical, fundamental)
-            analysis = get_stock_analysis(symbol)
-            if analysis:
-                db.upsert_stock_cache(analysis)
-                cached_count += 1
-                logger.debug(f"  ✅ Cached {symbol}: {analysis.get('price')}")
-            else:
-                # fallback: ดึงแค่ราคา
-                price_data = get_stock_price(symbol)
-                if price_data:
-                    db.upsert_stock_cache(price_data)
-                    cached_count += 1
-                    logger.debug(f"  ✅ Cached {symbol} (price only)")
+            resp = await client.get(f'https://{host}/v8/finance/chart/{symbol}', params=params)
+            counters["bytes"] = counters.get("bytes", 0) + len(resp.content)
+            if resp.status_code == 200:
+                results = resp.json().get('chart', {}).get('result')
+                if results:
+                    return results[0]
+            elif resp.status_code == 429:
+                counters["rate_limited"] = counters.get("rate_limited", 0) + 1
+            logger.debug(f"Yahoo async: HTTP {resp.status_code} for {symbol} ({host})")
         except Exception as e:
-            logger.warning(f"  ❌ Failed to cache {symbol}: {e}")
+            counters["errors"] = counters.get("errors", 0) + 1
+            logger.debug(f"Yahoo async error: {symbol} ({host}): {e}")
+
+    return None
+
+
+async def _fetch_symbol_chart(client, limiter, sem, symbol: str, range_str: str, counters: dict) -> dict | None:
+    """ดึง chart รายวันของ 1 symbol (จำกัดจำนวนพร้อมกันด้วย semaphore)"""
+    key = "incremental_fetches" if range_str == INCREMENTAL_RANGE else "history_fetches"
+    counters[key] = counters.get(key, 0) + 1
+    async with sem:
+        return await _yahoo_direct_fetch_async(client, limiter, symbol, range_str, '1d', counters)
+
+
+async def _fallback_symbol(symbol: str, counters: dict) -> dict | None:
+    """Direct HTTP ล้มเหลว → fallback yfinance (sync) ใน thread"""
+    counters["fallbacks"] = counters.get("fallbacks", 0) + 1
+    analysis = await asyncio.to_thread(_get_stock_analysis_yfinance, symbol)
+    if analysis:
+        return analysis
+    return await asyncio.to_thread(_get_stock_price_yfinance, symbol)
+
 
-    # 2. ดึง market overview
-    market_count = 0
+async def _refresh_symbols(client, limiter, sem, symbols: list[str], counters: dict) -> list:
+    """
+    ดึงเฉพาะแท่งที่ขาด (ปกติ 5 วัน) ของทุก symbol พร้อมกัน → merge กับ price_bars
+    → วิเคราะห์ทั้งชุดใน NumPy รอบเดียว (นอก event loop)
+    Returns list ตามลำดับ symbols: analysis dict / price dict / None / Exception
+    """
+    today = datetime.now(BKK_TZ).date()
+    coverage = await adb.get_price_bar_coverage(symbols)
+    charts = await asyncio.gather(
+        *(
+            _fetch_symbol_chart(client, limiter, sem, s, _history_range(coverage.get(s), today), counters)
+            for s in symbols
+        ),
+        return_exceptions=True,
+    )
+    fetched = {s: c for s, c in zip(symbols, charts) if isinstance(c, dict)}
+
+    # merge กับประวัติใน DB แล้วเขียนแท่งใหม่เป็น batch เดียว
+    stored = await adb.get_price_bars([s for s in fetched if s in coverage], HISTORY_BARS)
+    items = []
+    new_rows = []
+    for symbol, chart in fetched.items():
+        new_bars = _chart_to_bars(chart)
+        new_rows.extend((symbol, *bar) for bar in new_bars)
+        items.append((symbol, chart.get('meta', {}), _merge_bars(stored.get(symbol, []), new_bars)))
     try:
-        market = get_market_overview()
-        if market:
-            sym_map = {
-                "SET Index": "^SET.BK", "S&P 500": "^GSPC",
-                "Dow Jones": "^DJI", "Gold": "GC=F", "Crude Oil": "CL=F",
-            }
-            for name, info in market.items():
-                sym = sym_map.get(name, "")
-                db.upsert_market_cache(name, sym, info["price"], info["change_pct"])
-                market_count += 1
+        await adb.upsert_price_bars_many(new_rows)
     except Exception as e:
-        logger.warning(f"  ❌ Market overview cache failed: {e}")
+        logger.error(f"  ❌ price_bars write failed: {e}")
 
-    logger.info(f"🔄 Stock cache refresh done: {cached_count}/{len(symbols)} stocks, {market_count} indices")
+    analyses = dict(zip(fetched, await asyncio.to_thread(_analyses_from_bars, items)))
 
+    missing = [s for s, c in zip(symbols, charts) if not isinstance(c, dict)]
+    fallbacks = dict(zip(missing, await asyncio.gather(
+        *(_fallback_symbol(s, counters) for s in missing), return_exceptions=True,
+    )))
 
-def is_stock_related_message(message: str) -> bool:
-    """ตรวจว่าข้อความเกี่ยวกับหุ้น/การลงทุนหรือไม่"""
-    stock_keywords = [
-        "หุ้น", "ราคาหุ้น", "ลงทุน", "กองทุน", "ตลาดหุ้น", "SET", "พอร์ต",
-        "ซื้อหุ้น", "ขายหุ้น", "วิเคราะห์หุ้น", "แนะนำหุ้น", "กราฟ",
-        "แนวรับ", "แนวต้าน", "เทคนิคอล", "RSI", "SMA", "ถัวเฉลี่ย",
-        "P/E", "ปันผล", "dividend", "stock", "invest",
-        "NASDAQ", "S&P", "ดาวโจนส์", "Dow Jones",
-    ]
-    msg_lower = message.lower()
-    if any(kw.lower() in msg_lower for kw in stock_keywords):
+    results = []
+    for symbol, chart in zip(symbols, charts):
+        if symbol in fallbacks:
+            results.append(fallbacks[symbol])
+        else:
+            # ข้อมูลไม่พอวิเคราะห์ → เก็บแค่ราคาจาก chart เดียวกัน
+            results.append(analyses[symbol] or _price_from_chart(symbol, chart))
+    return results
+
+
+async def _refresh_index(client, limiter, sem, symbol: str, counters: dict) -> dict | None:
+    async with sem:
+        chart = await _yahoo_direct_fetch_async(client, limiter, symbol, '5d', '1d', counters)
+    if chart:
+        return _price_from_chart(symbol, chart)
+    return await asyncio.to_thread(_get_stock_price_yfinance, symbol)
+
+
+# ==================== Session-aware Refresh Scheduling ====================
+# job รันทุก STOCK_REFRESH_TICK วินาที แต่ดึงเฉพาะ symbol ที่ "ถึงรอบ":
+#   ตลาดเปิด: หุ้นที่มีคนติดตาม >= HOT_SYMBOL_WATCHERS ทุก STOCK_HOT_INTERVAL, ตัวอื่นทุก STOCK_OPEN_INTERVAL
+#   ตลาดปิด: ดึงครั้งเดียวหลังเวลาปิด (เก็บราคาปิด) แล้ว freeze จนตลาดเปิดใหม่
+# ตามตารางเปิดแต่ Yahoo บอก CLOSED (วันหยุด) → ถือว่าปิด, probe หุ้นตัวที่คนติดตามมากสุดทุก STOCK_CLOSED_PROBE
+# นอกตารางแต่ Yahoo บอก REGULAR (เปิดพิเศษ) → ถือว่าเปิด
+# symbol ที่ถึงรอบเรียงตามจำนวนคนติดตาม และจำกัดไม่เกิน STOCK_REFRESH_MAX_PER_TICK ต่อรอบ
+
+STOCK_REFRESH_TICK = int(os.getenv("STOCK_REFRESH_TICK", "60"))
+STOCK_HOT_INTERVAL = int(os.getenv("STOCK_HOT_INTERVAL", "60"))
+STOCK_OPEN_INTERVAL = int(os.getenv("STOCK_OPEN_INTERVAL", "300"))
+STOCK_CLOSED_PROBE = int(os.getenv("STOCK_CLOSED_PROBE", "900"))
+HOT_SYMBOL_WATCHERS = int(os.getenv("HOT_SYMBOL_WATCHERS", "3"))
+STOCK_REFRESH_MAX_PER_TICK = int(os.getenv("STOCK_REFRESH_MAX_PER_TICK", "200"))
+PRICE_BARS_PRUNE_INTERVAL = 86400  # ลบแท่งราคาเก่าวันละครั้ง
+
+_last_refreshed: dict[str, float] = {}               # symbol → epoch ที่ลอง refresh ล่าสุด
+_market_observed: dict[str, tuple[str, float]] = {}  # market → (market_state จาก Yahoo, epoch ที่เห็น)
+
+
+def market_is_open(market: str, now: datetime | None = None) -> bool:
+    """ตลาดเปิดอยู่ไหม — ตารางเวลา + market_state ล่าสุดที่ได้จาก Yahoo"""
+    if market == market_hours.ALWAYS_OPEN:
         return True
-    # ถ้ามีชื่อหุ้นที่รู้จัก
-    return len(detect_stock_symbols_in_message(message)) > 0
+    now = now or datetime.now(BKK_TZ)
+    state, seen_at = _market_observed.get(market, ("UNKNOWN", 0.0))
+    age = now.timestamp() - seen_at
+    session = market_hours.current_session(market, now)
+    if session:
+        # วันหยุด: Yahoo บอกว่าปิดระหว่าง session นี้ → เชื่อจนกว่า probe จะเห็นว่าเปิด
+        return not (state == "CLOSED" and seen_at >= session[0].timestamp())
+    return state == "REGULAR" and age < STOCK_OPEN_INTERVAL * 2
+
+
+def _observe_market_states(rows: list[dict]):
+    """จำ market_state ล่าสุดของแต่ละตลาดจากผล refresh (มีตัวไหน REGULAR = ตลาดเปิด)"""
+    states: dict[str, set] = {}
+    for row in rows:
+        state = row.get("market_state")
+        if state and state != "UNKNOWN":
+            states.setdefault(market_hours.market_of(row["symbol"]), set()).add(state)
+    now = time.time()
+    for market, seen in states.items():
+        _market_observed[market] = ("REGULAR" if "REGULAR" in seen else "CLOSED" if "CLOSED" in seen
+                                    else sorted(seen)[0], now)
+
+
+def _due_symbols(symbols: list[str], watchers: dict[str, int], now: datetime) -> tuple[list[str], int]:
+    """
+    เลือก symbol ที่ถึงรอบ refresh — เรียงตามจำนวนคนติดตาม (มากก่อน) แล้วตามความเก่า
+    Returns: (symbols ที่จะดึง, จำนวนที่ข้ามเพราะตลาดปิด/freeze)
+    """
+    now_ts = now.timestamp()
+    slack = STOCK_REFRESH_TICK / 2  # job ไม่ได้รันตรงวินาทีเป๊ะ
+    due: list[str] = []
+    frozen = 0
+    probes: dict[str, str] = {}
+    for symbol in symbols:
+        market = market_hours.market_of(symbol)
+        last = _last_refreshed.get(symbol)
+        if market_is_open(market, now):
+            interval = STOCK_HOT_INTERVAL if watchers.get(symbol, 0) >= HOT_SYMBOL_WATCHERS else STOCK_OPEN_INTERVAL
+            if last is None or now_ts - last >= interval - slack:
+                due.append(symbol)
+            continue
+        closed_at = market_hours.last_close(market, now)
+        if last is None or (closed_at and last < closed_at.timestamp()):
+            due.append(symbol)  # ยังไม่มีราคาปิดล่าสุด
+            continue
+        frozen += 1
+        if market_hours.is_scheduled_open(market, now):
+            # ตามตารางต้องเปิดแต่ Yahoo บอกปิด → probe ด้วยตัวที่คนติดตามมากที่สุดของตลาดนั้นตัวเดียว
+            best = probes.get(market)
+            if best is None or watchers.get(symbol, 0) > watchers.get(best, 0):
+                probes[market] = symbol
+
+    probes = {m: s for m, s in probes.items() if now_ts - _last_refreshed.get(s, 0.0) >= STOCK_CLOSED_PROBE}
+    due.sort(key=lambda s: (-watchers.get(s, 0), _last_refreshed.get(s, 0.0)))
+    due = due[:STOCK_REFRESH_MAX_PER_TICK]
+    return due + [s for s in probes.values() if s not in due], frozen - len(probes)
+
+
+async def _yahoo_quote_fetch_async(client, limiter, symbols: list[str], counters: dict) -> dict[str, dict] | None:
+    """async version ของ _yahoo_quote_fetch (ใช้ client/limiter ของรอบ refresh)"""
+    if time.time() < _quote_batch_disabled_until:
+        return None
+    await limiter.wait(urlsplit(YAHOO_QUOTE_URL).hostname or "")
+    counters["requests"] = counters.get("requests", 0) + 1
+    try:
+        resp = await client.get(YAHOO_QUOTE_URL, params={'symbols': ','.join(symbols)})
+        counters["bytes"] = counters.get("bytes", 0) + len(resp.content)
+        if resp.status_code != 200:
+            if resp.status_code == 429:
+                counters["rate_limited"] = counters.get("rate_limited", 0) + 1
+            _disable_quote_batch(f"HTTP {resp.status_code}")
+            return None
+        counters["batch_quotes"] = counters.get("batch_quotes", 0) + 1
+        return _parse_quote_response(resp.json())
+    except Exception as e:
+        counters["errors"] = counters.get("errors", 0) + 1
+        _disable_quote_batch(str(e))
+        return None
 
 
-def check_stock_alerts():
+async def _refresh_indices(client, limiter, sem, symbols: list[str], counters: dict) -> list:
+    """ราคา index ทั้งหมดใน batch quote เดียว — ตัวที่ไม่ได้ fallback เป็น chart ทีละตัว"""
+    if not symbols:
+        return []
+    async with sem:
+        batch = await _yahoo_quote_fetch_async(client, limiter, symbols, counters) or {}
+    missing = [s for s in symbols if s not in batch]
+    fallbacks = dict(zip(missing, await asyncio.gather(
+        *(_refresh_index(client, limiter, sem, s, counters) for s in missing), return_exceptions=True,
+    )))
+    return [batch[s] if s in batch else fallbacks[s] for s in symbols]
+
+
+async def refresh_stock_cache():
     """
-    เช็คเงื่อนไข stock alerts ทั้งหมด — เรียกจาก scheduler ทุก 5 นาที
-    ถ้าถึงเป้า → ส่ง push notification
+    Background job — ดึงข้อมูลหุ้นใน watchlist + market overview ที่ถึงรอบ (ตามเวลาทำการของตลาด)
+    บันทึกลง cache แล้วเช็ค stock alerts จากราคาชุดเดียวกัน
+    ทุก STOCK_REFRESH_TICK วินาที (APScheduler รัน coroutine นี้ใน event loop โดยตรง)
     """
-    alerts = db.get_all_active_stock_alerts()
-    if not alerts:
-        return
+    started = time.perf_counter()
+    now = datetime.now(BKK_TZ)
 
-    # Group by symbol เพื่อลด API calls
-    symbols = set(a["symbol"] for a in alerts)
-    prices = {}
+    # 1. เลือก symbols ที่ถึงรอบจาก watchlist (threshold index — โหลดใหม่เฉพาะเมื่อ watchlist เปลี่ยน)
+    alert_index = await load_alert_index()
+    watched = alert_index.symbols
+    symbols, frozen = _due_symbols(watched, alert_index.watchers, now)
+    indices, _ = _due_symbols(list(MARKET_INDICES), {}, now)
+    if not symbols and not indices:
+        _refresh_stats["idle_ticks"] += 1
+        logger.debug(f"Stock refresh: nothing due ({frozen} frozen)")
+        return None
+    logger.info(f"🔄 Stock cache refresh: {len(symbols)}/{len(watched)} symbols due, {len(indices)} indices")
+
+    counters: dict = {}
+    sem = asyncio.Semaphore(STOCK_REFRESH_CONCURRENCY)
+    limiter = _HostRateLimiter(YAHOO_HOST_RPS)
+    limits = httpx.Limits(
+        max_connections=STOCK_REFRESH_CONCURRENCY * len(YAHOO_CHART_HOSTS),
+        max_keepalive_connections=STOCK_REFRESH_CONCURRENCY * len(YAHOO_CHART_HOSTS),
+    )
 
-    for symbol in symbols:
-        data = get_stock_price(symbol)
-        if data:
-            prices[symbol] = data
+    async with httpx.AsyncClient(
+        headers=YAHOO_HEADERS, timeout=YAHOO_ASYNC_TIMEOUT, limits=limits, follow_redirects=True,
+    ) as client:
+        stock_results, index_results = await asyncio.gather(
+            _refresh_symbols(client, limiter, sem, symbols, counters),
+            _refresh_indices(client, limiter, sem, indices, counters),
+        )
+
+    # 2. เขียน DB เป็น batch เดียว
+    stock_rows = []
+    for symbol, result in zip(symbols, stock_results):
+        if isinstance(result, Exception):
+            logger.warning(f"  ❌ Failed to cache {symbol}: {result}")
+        elif result:
+            stock_rows.append(result)
+
+    index_rows = []
+    market_rows = []
+    for symbol, result in zip(indices, index_results):
+        if isinstance(result, Exception):
+            logger.debug(f"Market overview skip {symbol}: {result}")
+        elif result:
+            index_rows.append(result)
+            market_rows.append((MARKET_INDICES[symbol], symbol, result["price"], result["change_pct"]))
 
-    now = datetime.now(BKK_TZ)
+    try:
+        await adb.upsert_stock_cache_many(stock_rows)
+        await adb.upsert_market_cache_many(market_rows)
+    except Exception as e:
+        logger.error(f"  ❌ Stock cache batch write failed: {e}")
+
+    # นับเวลาจากการลองดึง (สำเร็จหรือไม่ก็ตาม) → symbol ที่ดึงไม่ได้ไม่ถูกยิงซ้ำทุก tick
+    refreshed_at = time.time()
+    for symbol in symbols + indices:
+        _last_refreshed[symbol] = refreshed_at
+    _observe_market_states(stock_rows + index_rows)
+
+    # write-through memory cache — ข้อมูลรอบนี้สดกว่าที่อยู่ใน memory เสมอ
+    cache_stock_rows(stock_rows)
+    # แจ้ง /ws/quotes — ส่งเฉพาะ field ที่เปลี่ยน ไปยังทุก connection ที่ subscribe symbol นั้น
+    pushed = quote_hub.hub.publish(stock_rows + index_rows)
+    if len(market_rows) == len(MARKET_INDICES):
+        _put_market(
+            {name: {"price": price, "change_pct": change_pct} for name, _, price, change_pct in market_rows},
+            {symbol: refreshed_at for _, symbol, _, _ in market_rows},
+        )
+    elif market_rows:
+        # ได้บาง index → ชุดเดิมใน memory ไม่ตรงกับ DB แล้ว ให้ไปอ่าน DB (อายุราย index) แทน
+        _quote_cache.invalidate([MARKET_CACHE_KEY])
+
+    # 3. เช็ค stock alerts จากราคาใน snapshot นี้ (ไม่ยิง Yahoo ซ้ำ) — symbol ที่ freeze อยู่ราคาไม่เปลี่ยน
+    triggered = 0
+    push_stats: dict = {}
+    alert_started = time.perf_counter()
+    try:
+        prices = {row["symbol"]: row for row in stock_rows}
+        triggered, push_stats = await check_stock_alerts(alert_index, prices)
+    except Exception as e:
+        logger.error(f"  ❌ Stock alert check failed: {e}")
+    alert_ms = (time.perf_counter() - alert_started) * 1000
+
+    duration = time.perf_counter() - started
+    cycle = {
+        "finished_at": datetime.now(BKK_TZ).isoformat(),
+        "duration_s": round(duration, 2),
+        "symbols": len(symbols),
+        "symbols_watched": len(watched),
+        "symbols_frozen": frozen,
+        "symbols_ok": len(stock_rows),
+        "indices": len(indices),
+        "indices_ok": len(market_rows),
+        "markets_open": {
+            market: market_is_open(market, now)
+            for market in (market_hours.SET, market_hours.US)
+        },
+        "http_requests": counters.get("requests", 0),
+        "rate_limited": counters.get("rate_limited", 0),
+        "http_errors": counters.get("errors", 0),
+        "batch_quote_requests": counters.get("batch_quotes", 0),
+        "yfinance_fallbacks": counters.get("fallbacks", 0),
+        "incremental_fetches": counters.get("incremental_fetches", 0),
+        "history_fetches": counters.get("history_fetches", 0),
+        "bytes_downloaded": counters.get("bytes", 0),
+        "ws_updates_pushed": pushed,
+        "alerts_checked": len(alert_index),
+        "alerts_triggered": triggered,
+        "alert_check_ms": round(alert_ms, 1),
+        "push_sent": push_stats.get("sent", 0),
+        "push_failed": push_stats.get("failed", 0),
+        "push_tokens_pruned": push_stats.get("pruned", 0),
+        "push_msgs_per_sec": push_stats.get("msgs_per_sec", 0.0),
+    }
+    _refresh_stats["cycles"] += 1
+    _refresh_stats["last_cycle"] = cycle
 
-    for alert in alerts:
-        symbol = alert["symbol"]
-        if symbol not in prices:
-            continue
+    # ลบแท่งราคาที่เก่าเกินใช้ วันละครั้ง
+    if refreshed_at - _refresh_stats.get("last_prune", 0.0) >= PRICE_BARS_PRUNE_INTERVAL:
+        _refresh_stats["last_prune"] = refreshed_at
+        try:
+            await adb.prune_price_bars()
+        except Exception as e:
+            logger.warning(f"  price_bars prune failed: {e}")
 
-        price_data = prices[symbol]
-        current_price = price_data["price"]
-        change_pct = price_data["change_pct"]
-        alert_type = alert["alert_type"]
-        target = alert["target_value"]
+    logger.info(
+        f"🔄 Stock cache refresh done in {duration:.1f}s: "
+        f"{len(stock_rows)}/{len(symbols)} stocks ({frozen} frozen), {len(market_rows)} indices, "
+        f"{cycle['http_requests']} requests ({cycle['rate_limited']} rate-limited), "
+        f"{triggered} alerts triggered"
+    )
+    return cycle
 
-        # อัพเดทราคาล่าสุด
-        db.update_stock_price(alert["id"], current_price)
 
-        # เช็คว่าเพิ่งแจ้งไปหรือยัง (ไม่แจ้งซ้ำภายใน 30 นาที)
-        last_notified = alert.get("last_notified_at")
-        if last_notified:
-            try:
-                last_dt = datetime.fromisoformat(last_notified).replace(tzinfo=BKK_TZ)
-                if now - last_dt < timedelta(minutes=30):
-                    continue
-            except Exception:
-                pass
+def get_refresh_stats() -> dict:
+    """สถิติรอบ refresh ล่าสุด (ระยะเวลา, จำนวนสำเร็จ, request ที่ยิงออกไป) + memory cache + /ws/quotes"""
+    return {**_refresh_stats, "quote_cache": get_quote_cache_stats(), "quote_hub": quote_hub.hub.stats()}
 
-        triggered = False
-        emoji = ""
-        message = ""
 
-        if alert_type == "price_above" and current_price >= target:
-            triggered = True
-            emoji = "📈"
-            currency = price_data["currency"]
-            message = f"{alert['display_name']} ขึ้นถึง {current_price} {currency}! (เป้า {target})"
+def _evaluate_stock_alert(alert: dict, price_data: dict) -> tuple[str, str] | None:
+    """เช็คเงื่อนไข alert 1 ตัวกับราคาล่าสุด → (title, message) ถ้าถึงเป้า"""
+    current_price = price_data["price"]
+    change_pct = price_data.get("change_pct") or 0
+    alert_type = alert["alert_type"]
+    target = alert["target_value"]
+    currency = price_data.get("currency", "")
 
-        elif alert_type == "price_below" and current_price <= target:
-            triggered = True
-            emoji = "📉"
-            currency = price_data["currency"]
-            message = f"{alert['display_name']} ตกถึง {current_price} {currency}! (เป้า {target})"
-
-        elif alert_type == "change_pct" and abs(change_pct) >= target:
-            triggered = True
-            if change_pct > 0:
-                emoji = "📈"
-                message = f"{alert['display_name']} ขึ้น {change_pct:+.2f}% (ราคา {current_price})"
-            else:
-                emoji = "📉"
-                message = f"{alert['display_name']} ลง {change_pct:+.2f}% (ราคา {current_price})"
+    emoji = ""
+    message = ""
+
+    if alert_type == "price_above" and current_price >= target:
+        emoji = "📈"
+        message = f"{alert['display_name']} ขึ้นถึง {current_price} {currency}! (เป้า {target})"
+
+    elif alert_type == "price_below" and current_price <= target:
+        emoji = "📉"
+        message = f"{alert['display_name']} ตกถึง {current_price} {currency}! (เป้า {target})"
 
-        if triggered:
-            title = f"{emoji} แจ้งเตือนหุ้น {alert['display_name']}"
-            logger.info(f"Stock alert triggered: {title} — {message}")
+    elif alert_type == "change_pct" and abs(change_pct) >= target:
+        if change_pct > 0:
+            emoji = "📈"
+            message = f"{alert['display_name']} ขึ้น {change_pct:+.2f}% (ราคา {current_price})"
+        else:
+            emoji = "📉"
+            message = f"{alert['display_name']} ลง {change_pct:+.2f}% (ราคา {current_price})"
 
-            # ส่ง push notification
-            push_sender.send_push_to_user(
-                alert["user_id"], title, message,
-                notification_type="stock_alert"
+    if not message:
+        return None
+    return f"{emoji} แจ้งเตือนหุ้น {alert['display_name']}", message
+
+
+# ==================== Stock Alert Engine ====================
+# เก็บ threshold ของทุก alert เป็น sorted list ต่อ symbol → รอบละ O(log n) ต่อ symbol แทนการวนทุก alert
+#   price_above: ถึงเป้าเมื่อ price >= target      → prefix ของ list ที่ target <= price
+#   price_below: ถึงเป้าเมื่อ price <= target      → suffix ของ list ที่ target >= price
+#   change_pct:  ถึงเป้าเมื่อ |change_pct| >= target → prefix ของ list ที่ target <= |change_pct|
+# โหลด watchlist ใหม่เฉพาะตอน fingerprint (จำนวน alert, id ล่าสุด) เปลี่ยน
+
+ALERT_COOLDOWN = timedelta(minutes=30)  # ไม่แจ้งซ้ำภายใน 30 นาที
+
+
+class _AlertIndex:
+    """threshold index ของ stock alerts ที่ active ทั้งหมด"""
+
+    def __init__(self, alerts: list[dict] | None = None, fingerprint: tuple | None = None):
+        self.fingerprint = fingerprint
+        self.alerts: dict[int, dict] = {}
+        # symbol → alert_type → (targets เรียงจากน้อยไปมาก, alert ids ลำดับเดียวกัน)
+        self._thresholds: dict[str, dict[str, tuple[list[float], list[int]]]] = {}
+        for alert in alerts or []:
+            self.alerts[alert["id"]] = alert
+        self._build()
+        # symbol → จำนวนผู้ใช้ (ไม่ซ้ำ) ที่ติดตาม — ใช้จัดลำดับความสำคัญตอน refresh
+        users: dict[str, set] = {}
+        for alert in self.alerts.values():
+            users.setdefault(alert["symbol"], set()).add(alert["user_id"])
+        self.watchers: dict[str, int] = {symbol: len(ids) for symbol, ids in users.items()}
+
+    def _build(self):
+        grouped: dict[str, dict[str, list[tuple[float, int]]]] = {}
+        for alert in self.alerts.values():
+            target = alert.get("target_value")
+            if target is None or alert["alert_type"] not in ("price_above", "price_below", "change_pct"):
+                continue
+            grouped.setdefault(alert["symbol"], {}).setdefault(alert["alert_type"], []).append(
+                (float(target), alert["id"])
             )
+        for symbol, kinds in grouped.items():
+            self._thresholds[symbol] = {}
+            for kind, pairs in kinds.items():
+                pairs.sort()
+                self._thresholds[symbol][kind] = ([t for t, _ in pairs], [i for _, i in pairs])
+
+    @property
+    def symbols(self) -> list[str]:
+        return sorted(set(a["symbol"] for a in self.alerts.values()))
+
+    def __len__(self) -> int:
+        return len(self.alerts)
+
+    def crossed(self, symbol: str, price: float, change_pct: float) -> list[int]:
+        """alert ids ของ symbol นี้ที่ถึงเงื่อนไขที่ราคา/เปอร์เซ็นต์เปลี่ยนปัจจุบัน"""
+        kinds = self._thresholds.get(symbol)
+        if not kinds:
+            return []
+        ids: list[int] = []
+        if "price_above" in kinds:
+            targets, kind_ids = kinds["price_above"]
+            ids.extend(kind_ids[:bisect.bisect_right(targets, price)])
+        if "price_below" in kinds:
+            targets, kind_ids = kinds["price_below"]
+            ids.extend(kind_ids[bisect.bisect_left(targets, price):])
+        if "change_pct" in kinds:
+            targets, kind_ids = kinds["change_pct"]
+            ids.extend(kind_ids[:bisect.bisect_right(targets, abs(change_pct))])
+        return ids
+
+
+_alert_index = _AlertIndex()
+
+
+async def load_alert_index() -> _AlertIndex:
+    """คืน index ปัจจุบัน — สร้างใหม่จาก DB เฉพาะเมื่อ watchlist เปลี่ยน"""
+    global _alert_index
+    fingerprint = await adb.get_stock_watchlist_fingerprint()
+    if fingerprint != _alert_index.fingerprint:
+        alerts = await adb.get_all_active_stock_alerts()
+        _alert_index = await asyncio.to_thread(_AlertIndex, alerts, fingerprint)
+        logger.info(f"  Alert index rebuilt: {len(_alert_index)} alerts")
+    return _alert_index
+
+
+def _recently_notified(alert: dict, now: datetime) -> bool:
+    last_notified = alert.get("last_notified_at")
+    if not last_notified:
+        return False
+    try:
+        last_dt = datetime.fromisoformat(last_notified).replace(tzinfo=BKK_TZ)
+    except Exception:
+        return False
+    return now - last_dt < ALERT_COOLDOWN
+
+
+async def check_stock_alerts(index: _AlertIndex, prices: dict[str, dict]) -> tuple[int, dict]:
+    """
+    เช็คเงื่อนไข stock alerts จากราคาใน snapshot (ไม่ดึงราคาซ้ำ)
+    เรียกจาก refresh_stock_cache ทุกรอบ — แตะเฉพาะ alert ที่ถึงเป้า
+    push ของทั้งรอบส่งเป็น batch เดียว (push_sender.send_push_batch)
+    last_price / last_notified_at ทั้งรอบเขียนใน transaction เดียว
+    Returns: (จำนวน alert ที่ trigger, สถิติการส่ง push)
+    """
+    now = datetime.now(BKK_TZ)
+    price_updates: list[tuple[str, float]] = []
+    notified_ids: list[int] = []
+    notifications: list[tuple[str, str, str]] = []
+    push_stats: dict = {}
 
-            # บันทึกว่าแจ้งแล้ว
-            db.mark_stock_notified(alert["id"])
+    try:
+        for symbol, price_data in prices.items():
+            price = price_data.get("price")
+            if not price:
+                continue
+            price_updates.append((symbol, price))
+
+            for alert_id in index.crossed(symbol, price, price_data.get("change_pct") or 0):
+                alert = index.alerts[alert_id]
+                if _recently_notified(alert, now):
+                    continue
+
+                result = _evaluate_stock_alert(alert, price_data)
+                if not result:
+                    continue
+
+                title, message = result
+                logger.info(f"Stock alert triggered: {title} — {message}")
+                notifications.append((alert["user_id"], title, message))
+
+                # จำใน index ด้วย → รอบถัดไปไม่ต้องโหลด watchlist ใหม่ก็รู้ว่าแจ้งแล้ว
+                alert["last_notified_at"] = now.isoformat()
+                notified_ids.append(alert_id)
+
+        if notifications:
+            # firebase เป็น sync → ทำใน thread
+            push_stats = await asyncio.to_thread(
+                push_sender.send_push_batch, notifications, notification_type="stock_alert",
+            )
+    finally:
+        # เขียนสิ่งที่ทำไปแล้วเสมอ (แม้การส่ง push จะ error) — กันแจ้งซ้ำรอบหน้า
+        await adb.update_stock_alert_state(price_updates, notified_ids)
+    return len(notified_ids), push_stats
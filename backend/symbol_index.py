@@ -0,0 +1,224 @@
+"""
+symbol_index.py — Symbol Universe (SET/mai + หุ้น US หลัก)
+โหลดรายชื่อหุ้นจาก data/symbols.tsv ครั้งแรกที่ถูกเรียกใช้ (lazy) แล้วเก็บเป็น sorted array
+ค้นด้วย bisect → lookup / prefix search ระดับไมโครวินาที ไม่ต้องยิง Yahoo
+
+ใช้กับ:
+  - format_symbol() — ตัดสินว่า ticker เป็นหุ้นไทย (.BK) หรือ US จากรายชื่อจริง
+  - /stocks/search?q= — ค้นจากชื่อย่อ/ชื่อบริษัท + สะกดผิด 1 ตัวอักษร
+
+ไฟล์ข้อมูล: TSV (symbol, exchange, name) บรรทัดที่ขึ้นต้นด้วย # เป็น comment
+ticker เดียวกันอยู่ได้หลายตลาด (เช่น BA = Bangkok Airways / Boeing) — lookup คืนทุก listing
+ไฟล์ที่ ship มาครอบคลุม SET/mai บางส่วน (214 จากราว 850 ตัว) — ticker ไทยที่ไม่อยู่ในไฟล์
+lookup/search หาไม่เจอ และ format_symbol ย้อนไปใช้ THAI_STOCK_HINTS (ดูหัวไฟล์ symbols.tsv)
+"""
+
+import bisect
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+SYMBOLS_PATH = Path(os.getenv("SYMBOLS_PATH", str(Path(__file__).parent / "data" / "symbols.tsv")))
+
+THAI_EXCHANGES = ("SET", "mai")
+
+_WORD_RE = re.compile(r"[A-Z0-9]+")
+
+
+class Listing(NamedTuple):
+    symbol: str     # ticker ตามตลาด (ไม่มี .BK)
+    exchange: str   # SET / mai / NASDAQ / NYSE / NYSEARCA
+    name: str
+
+    @property
+    def is_thai(self) -> bool:
+        return self.exchange in THAI_EXCHANGES
+
+    @property
+    def yahoo_symbol(self) -> str:
+        return f"{self.symbol}.BK" if self.is_thai else self.symbol
+
+    def to_dict(self) -> dict:
+        return {
+            "symbol": self.yahoo_symbol,
+            "display_name": self.symbol,
+            "name": self.name,
+            "exchange": self.exchange,
+        }
+
+
+def normalize_ticker(text: str) -> str:
+    """ตัวใหญ่ ไม่มีช่องว่าง ตัด .BK — class share พิมพ์ได้ทั้ง BRK.B / BRK-B"""
+    ticker = text.strip().upper().replace(" ", "")
+    if ticker.endswith(".BK"):
+        ticker = ticker[:-3]
+    return ticker.replace(".", "-")
+
+
+def _deletes(word: str) -> set[str]:
+    """ทุกคำที่ได้จากการลบ 1 ตัวอักษร (ใช้ทำ fuzzy match ระยะ 1 แบบ symmetric delete)"""
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def _within_one_edit(a: str, b: str) -> bool:
+    """ระยะ Damerau-Levenshtein ≤ 1 (แทนที่/เพิ่ม/ลบ/สลับ 2 ตัวติดกัน)"""
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if abs(la - lb) > 1:
+        return False
+    if la == lb:
+        diff = [i for i in range(la) if a[i] != b[i]]
+        if len(diff) == 1:
+            return True
+        return len(diff) == 2 and diff[1] == diff[0] + 1 and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]]
+    if la > lb:
+        a, b = b, a
+    return any(a == b[:i] + b[i + 1:] for i in range(len(b)))
+
+
+class SymbolIndex:
+    """
+    index แบบ sorted array (สร้างครั้งเดียว อ่านอย่างเดียว → ใช้ข้าม thread ได้)
+      _tickers    — ticker เรียงตามตัวอักษร (ซ้ำได้ถ้าอยู่หลายตลาด) คู่กับ listings
+      _words      — คำในชื่อบริษัท เรียงแล้ว คู่กับ _word_ids (ตำแหน่งใน listings)
+      _fuzzy      — ticker ที่ลบ 1 ตัวอักษร → ตำแหน่ง (symmetric delete)
+    """
+
+    def __init__(self, listings):
+        # หุ้นไทยมาก่อนเมื่อ ticker ซ้ำ (แอปนี้ผู้ใช้ส่วนใหญ่ถามหุ้น SET)
+        self.listings = sorted(set(listings), key=lambda l: (l.symbol, not l.is_thai, l.exchange))
+        self._tickers = [l.symbol for l in self.listings]
+
+        words = sorted({
+            (word, i)
+            for i, listing in enumerate(self.listings)
+            for word in _WORD_RE.findall(listing.name.upper())
+        })
+        self._words = [w for w, _ in words]
+        self._word_ids = [i for _, i in words]
+
+        self._fuzzy: dict[str, list[int]] = {}
+        for i, ticker in enumerate(self._tickers):
+            for variant in _deletes(ticker):
+                self._fuzzy.setdefault(variant, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.listings)
+
+    @staticmethod
+    def _prefix_range(keys: list[str], prefix: str) -> tuple[int, int]:
+        lo = bisect.bisect_left(keys, prefix)
+        return lo, bisect.bisect_left(keys, prefix + "\uffff", lo)
+
+    def lookup(self, ticker: str) -> list[Listing]:
+        """ticker ตรงตัว (normalize แล้ว) → ทุก listing ของ ticker นั้น (ไทยก่อน)"""
+        lo = bisect.bisect_left(self._tickers, ticker)
+        hi = bisect.bisect_right(self._tickers, ticker, lo)
+        return self.listings[lo:hi]
+
+    def _fuzzy_ids(self, ticker: str) -> list[int]:
+        """ticker ที่ห่างจาก query ไม่เกิน 1 edit (ไม่รวมตัวที่ตรงเป๊ะ)"""
+        candidates = set(self._fuzzy.get(ticker, ()))
+        for variant in _deletes(ticker):
+            lo, hi = bisect.bisect_left(self._tickers, variant), bisect.bisect_right(self._tickers, variant)
+            candidates.update(range(lo, hi))
+            candidates.update(self._fuzzy.get(variant, ()))
+        return sorted(
+            i for i in candidates
+            if self._tickers[i] != ticker and _within_one_edit(self._tickers[i], ticker)
+        )
+
+    def search(self, query: str, limit: int = 10) -> list[Listing]:
+        """
+        ลำดับผลลัพธ์: ticker ตรงตัว → ticker ขึ้นต้นด้วย query (สั้นก่อน)
+        → ชื่อบริษัทที่ทุกคำใน query เป็น prefix ของคำในชื่อ → ticker สะกดผิด 1 ตัว
+        """
+        ticker = normalize_ticker(query)
+        terms = _WORD_RE.findall(query.upper())
+        if not ticker or limit <= 0:
+            return []
+
+        seen: set[int] = set()
+        ordered: list[int] = []
+
+        def take(ids) -> bool:
+            for i in ids:
+                if i not in seen:
+                    seen.add(i)
+                    ordered.append(i)
+                    if len(ordered) >= limit:
+                        return True
+            return False
+
+        lo, hi = self._prefix_range(self._tickers, ticker)
+        if take(sorted(range(lo, hi), key=lambda i: (len(self._tickers[i]), i))):
+            return [self.listings[i] for i in ordered]
+
+        if terms:
+            # ใช้คำแรกเปิด range ใน index แล้วกรองคำที่เหลือกับชื่อเต็ม
+            lo, hi = self._prefix_range(self._words, terms[0])
+            ids = sorted(set(self._word_ids[lo:hi]))
+            if len(terms) > 1:
+                ids = [
+                    i for i in ids
+                    if all(
+                        any(word.startswith(term) for word in _WORD_RE.findall(self.listings[i].name.upper()))
+                        for term in terms[1:]
+                    )
+                ]
+            if take(ids):
+                return [self.listings[i] for i in ordered]
+
+        if len(ticker) >= 2:
+            take(self._fuzzy_ids(ticker))
+        return [self.listings[i] for i in ordered]
+
+
+def load_listings(path: Path) -> list[Listing]:
+    """อ่านไฟล์ TSV → list ของ Listing (ข้ามบรรทัดว่าง/comment/แถวที่ไม่ครบ 3 คอลัมน์)"""
+    listings = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) < 3:
+                continue
+            symbol, exchange, name = (p.strip() for p in parts[:3])
+            listings.append(Listing(normalize_ticker(symbol), exchange, name))
+    return listings
+
+
+_index: SymbolIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> SymbolIndex:
+    """โหลด index ครั้งแรกที่เรียก — ไฟล์หาย/อ่านไม่ได้ได้ index ว่าง (format_symbol ใช้ hint เดิมแทน)"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                try:
+                    listings = load_listings(SYMBOLS_PATH)
+                except OSError as e:
+                    logger.warning(f"[SymbolIndex] load {SYMBOLS_PATH} failed: {e}")
+                    listings = []
+                _index = SymbolIndex(listings)
+                logger.info(f"[SymbolIndex] loaded {len(_index)} listings")
+    return _index
+
+
+def lookup(ticker: str) -> list[Listing]:
+    """ทุก listing ของ ticker นี้ (รับ input ของ user ได้เลย เช่น "ptt", "BRK.B")"""
+    return get_index().lookup(normalize_ticker(ticker))
+
+
+def search(query: str, limit: int = 10) -> list[Listing]:
+    return get_index().search(query, limit)
@@ -0,0 +1,66 @@
+"""
+pytest fixtures ร่วม — รันจาก backend/: python -m pytest tests
+package ภายนอกที่ test ไม่ได้เรียกจริง (yfinance, firebase_admin) ถูกแทนด้วย module ปลอมถ้ายังไม่ได้ติดตั้ง
+→ import stock_service / push_sender ได้เสมอ ส่วนที่ต่อ network ถูก monkeypatch ใน test แต่ละตัว
+"""
+
+import importlib.util
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def _fake_module(name: str, **attrs):
+    """ใส่ module ปลอมใน sys.modules ถ้า package จริง (ชื่อระดับบนสุด) ยังไม่ได้ติดตั้ง"""
+    if importlib.util.find_spec(name.split(".")[0]) is not None:
+        return
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+
+
+class _FakeUnregisteredError(Exception):
+    def __init__(self, message, cause=None, http_response=None):
+        super().__init__(message)
+
+
+class _FakeMessage:
+    def __init__(self, data=None, notification=None, android=None, token=None):
+        self.data, self.notification, self.android, self.token = data, notification, android, token
+
+
+def _no_network(*args, **kwargs):
+    raise RuntimeError("external service is not available in tests")
+
+
+_fake_module("yfinance", Ticker=_no_network, download=_no_network)
+_fake_module("firebase_admin.credentials", Certificate=lambda cert: cert)
+_fake_module(
+    "firebase_admin.messaging",
+    Message=_FakeMessage,
+    AndroidConfig=lambda **kwargs: kwargs,
+    Notification=lambda **kwargs: kwargs,
+    UnregisteredError=_FakeUnregisteredError,
+    send_each=_no_network,
+)
+_fake_module(
+    "firebase_admin",
+    initialize_app=lambda *args, **kwargs: None,
+    credentials=sys.modules.get("firebase_admin.credentials"),
+    messaging=sys.modules.get("firebase_admin.messaging"),
+)
+
+import database as db  # noqa: E402
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    """SQLite ชั่วคราวต่อ test — ปิด connection pool เมื่อจบ"""
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "test.db")
+    db.init_db()
+    yield db
+    db.close_db_pool()
@@ -0,0 +1,106 @@
+"""retry ของ Messages API (post_messages / stream_messages) ผ่าน httpx.MockTransport — ไม่ยิง API จริง"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import ai_brain
+
+OK_BODY = {
+    "content": [{"type": "text", "text": "สวัสดี"}],
+    "usage": {"input_tokens": 10, "output_tokens": 3},
+}
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """
+    ตั้ง shared client ให้ตอบตามลำดับ responses (Response หรือ Exception ที่จะ raise)
+    Returns: list ของ request ที่ถูกส่ง
+    """
+    requests = []
+    responses = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        result = responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(ai_brain, "_http_client", client)
+    monkeypatch.setattr(ai_brain, "_retry_delay", lambda response, attempt: 0)
+    monkeypatch.setattr(ai_brain, "ANTHROPIC_MAX_RETRIES", 2)
+    yield responses, requests
+    asyncio.run(client.aclose())
+
+
+def test_post_retries_overloaded_and_rate_limited(mock_api):
+    responses, requests = mock_api
+    responses += [httpx.Response(529), httpx.Response(429), httpx.Response(200, json=OK_BODY)]
+    retries = ai_brain._llm_stats["retries"]
+
+    response = asyncio.run(ai_brain.post_messages({"model": ai_brain.MODEL}))
+
+    assert response.status_code == 200
+    assert response.json()["content"][0]["text"] == "สวัสดี"
+    assert len(requests) == 3
+    assert ai_brain._llm_stats["retries"] - retries == 2
+
+
+def test_post_returns_last_error_when_retries_exhausted(mock_api):
+    responses, requests = mock_api
+    responses += [httpx.Response(429)] * 3
+
+    response = asyncio.run(ai_brain.post_messages({}))
+
+    assert response.status_code == 429
+    assert len(requests) == 3
+
+
+def test_post_does_not_retry_client_errors(mock_api):
+    responses, requests = mock_api
+    responses += [httpx.Response(400, json={"error": {"type": "invalid_request_error"}})]
+
+    response = asyncio.run(ai_brain.post_messages({}))
+
+    assert response.status_code == 400
+    assert len(requests) == 1
+
+
+def test_post_retries_connection_errors(mock_api):
+    responses, requests = mock_api
+    responses += [httpx.ConnectError("refused"), httpx.Response(200, json=OK_BODY)]
+
+    response = asyncio.run(ai_brain.post_messages({}))
+
+    assert response.status_code == 200
+    assert len(requests) == 2
+
+
+def test_post_raises_after_repeated_connection_errors(mock_api):
+    responses, _ = mock_api
+    responses += [httpx.ConnectError("refused")] * 3
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(ai_brain.post_messages({}))
+
+
+def test_stream_retries_before_reading_body(mock_api):
+    responses, requests = mock_api
+    sse = (
+        'event: content_block_delta\ndata: {"delta": {"type": "text_delta", "text": "หวัดดี"}}\n\n'
+        'event: message_stop\ndata: {}\n\n'
+    )
+    responses += [httpx.Response(529), httpx.Response(200, text=sse)]
+
+    async def collect():
+        return [event async for event in ai_brain.stream_messages({})]
+
+    events = asyncio.run(collect())
+
+    assert [event_type for event_type, _ in events] == ["content_block_delta", "message_stop"]
+    assert len(requests) == 2
+    assert all(b'"stream":true' in r.content.replace(b" ", b"") for r in requests)
@@ -0,0 +1,146 @@
+"""answer cache — คำตอบที่ใช้ซ้ำข้ามผู้ใช้ต้องสร้างจากข้อมูลกลางเท่านั้น + template ชื่อเฉพาะคำทัก"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import ai_brain
+import answer_cache
+
+STOCK_CONTEXT = "📊 PTT: 34.25 บาท (+1.20%)"
+
+# ข้อมูลส่วนตัวของผู้ถามคนแรก — ห้ามโผล่ในคำตอบที่คนอื่นได้จาก cache
+PRIVATE = {
+    "memory": "เลี้ยงแมวชื่อส้มโอ",
+    "reminder": "ไปรับผลตรวจเลือด",
+    "routine": "กินยาความดัน",
+    "mood": "เครียดเรื่องหนี้บัตร",
+    "summary": "กำลังจะหย่ากับแฟน",
+    "history": "เงินเดือนฉันแปดหมื่นห้า",
+}
+
+
+def _full_llm_args(message: str) -> dict:
+    """kwargs ของ call_haiku แบบ context เต็มของผู้ถาม (เหมือนที่ /chat สร้าง)"""
+    return {
+        "message": message,
+        "user_name": "ต้น",
+        "personality": "friendly",
+        "memory": {"facts": [PRIVATE["memory"]], "recent_mood": PRIVATE["mood"]},
+        "recent_messages": [
+            {"role": "user", "content": PRIVATE["history"]},
+            {"role": "assistant", "content": "รับทราบ"},
+        ],
+        "user_context": {
+            "wake_time": "07:00",
+            "sleep_time": "23:00",
+            "mood_history": [{"score": 1, "note": "", "created_at": "2026-01-01 09:00"}],
+            "routine_status": [{"title": PRIVATE["routine"], "time": "08:00", "done": False, "points": 10}],
+            "pending_reminders": [{"message": PRIVATE["reminder"], "remind_at": "2026-01-02 09:00"}],
+            "streak": 3,
+            "total_points": 120,
+            "critical_alerts": [],
+        },
+        "conversation_summary": f"- {PRIVATE['summary']}",
+        "stock_context": STOCK_CONTEXT,
+    }
+
+
+@pytest.fixture
+def echo_llm(monkeypatch):
+    """
+    Claude ปลอมที่ "รั่ว" ทุกอย่างที่เห็น — reply = ทุกข้อความใน prompt (ตัดชื่อผู้ถามและคำสั่ง format ออก)
+    คำตอบจริงของ Claude มาจาก prompt เท่านั้น → ถ้า echo ไม่มีข้อมูลส่วนตัว คำตอบจริงก็ไม่มี
+    """
+    def handler(request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        texts = [block["text"] for block in payload["system"]]
+        texts += [m["content"] if isinstance(m["content"], str) else json.dumps(m["content"], ensure_ascii=False)
+                  for m in payload["messages"]]
+        echo = " ".join(texts).replace("ต้น", "")
+        for marker in ("MEMORY_UPDATE", "REMINDER", "STOCK_ALERT", "REPLY"):
+            echo = echo.replace(marker, "-")
+        return httpx.Response(200, json={
+            "content": [{"type": "text", "text": f"REPLY: {echo}"}],
+            "usage": {"input_tokens": 500, "output_tokens": 100},
+        })
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(ai_brain, "_http_client", client)
+    yield
+    asyncio.run(client.aclose())
+
+
+def _leaked(text: str) -> list[str]:
+    return [field for field, value in PRIVATE.items() if value in text]
+
+
+def test_full_context_echo_would_leak(echo_llm):
+    """ตัวควบคุม: ถ้าส่ง context เต็ม echo มีข้อมูลส่วนตัวครบทุก field (test ข้างล่างจึงจับการรั่วได้จริง)"""
+    result = asyncio.run(ai_brain.call_haiku(**_full_llm_args("PTT วันนี้เป็นไง")))
+    assert _leaked(result["reply"]) == list(PRIVATE)
+
+
+def test_cached_reply_has_no_field_from_first_askers_context(echo_llm):
+    message = "PTT วันนี้เป็นไง"
+    key = answer_cache.AnswerCache.key(message, "friendly", STOCK_CONTEXT)
+    cache = answer_cache.AnswerCache()
+
+    args = answer_cache.shared_llm_args(_full_llm_args(message), STOCK_CONTEXT)
+    result = asyncio.run(ai_brain.call_haiku(**args))
+    assert cache.put(key, result["reply"], "ต้น", result["usage"], ttl=60, source=f"{message}\n{STOCK_CONTEXT}")
+
+    served = cache.get(key, "บี")
+    assert served is not None
+    assert STOCK_CONTEXT in served  # ข้อมูลกลางยังส่งให้ Claude ครบ
+    assert _leaked(served) == []
+
+
+def test_shared_args_keep_only_whitelisted_fields():
+    args = answer_cache.shared_llm_args({**_full_llm_args("SET วันนี้"), "extra_private": "x"}, STOCK_CONTEXT)
+    assert args == {
+        "message": "SET วันนี้", "user_name": "ต้น", "personality": "friendly",
+        "memory": {}, "recent_messages": [], "stock_context": STOCK_CONTEXT,
+    }
+
+
+@pytest.mark.parametrize("message, symbols, expected", [
+    ("PTT วันนี้เป็นไง", ["PTT"], True),
+    ("SET วันนี้เป็นยังไง", [], True),
+    ("พอร์ตของฉัน PTT เป็นไง", ["PTT"], False),
+    ("แล้วตัวนั้นล่ะ", [], False),
+    ("ตั้งเตือน PTT ที่ 35", ["PTT"], False),
+    ("วันนี้เหนื่อยจัง", [], False),
+])
+def test_is_cacheable(message, symbols, expected):
+    assert answer_cache.is_cacheable(message, symbols) is expected
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ("PTT วันนี้ทรงตัว", ("PTT วันนี้ทรงตัว", None)),
+    ("สวัสดีต้น PTT ขึ้นนิดหน่อย", ("สวัสดี", " PTT ขึ้นนิดหน่อย")),
+    ("PTT ขึ้นนะต้น", None),                       # ชื่อไม่อยู่ที่คำทัก
+    ("ต้นทุน PTT สูงขึ้น", None),                 # ชื่อเป็นส่วนหนึ่งของคำอื่น
+    ("ต้น PTT ขึ้น ต้นลองดูนะ", None),            # ชื่อซ้ำ 2 ที่
+])
+def test_to_template_only_greeting_name(reply, expected):
+    assert answer_cache.to_template(reply, "ต้น") == expected
+
+
+def test_name_that_appears_in_source_is_not_templated():
+    assert answer_cache.to_template("PTT ขึ้น", "PTT", source="PTT วันนี้เป็นไง") is None
+
+
+def test_get_fills_in_askers_name_and_expires(monkeypatch):
+    cache = answer_cache.AnswerCache()
+    key = cache.key("PTT", "friendly", STOCK_CONTEXT)
+    now = 1000.0
+    monkeypatch.setattr(answer_cache.time, "time", lambda: now)
+    cache.put(key, "สวัสดีต้น PTT ขึ้น", "ต้น", {"input_tokens": 10}, ttl=60)
+
+    assert cache.get(key, "บี") == "สวัสดีบี PTT ขึ้น"
+    now += 61
+    assert cache.get(key, "บี") is None
+    assert cache.stats()["expired"] == 1
@@ -0,0 +1,104 @@
+"""fold_history — พับ backlog จากข้อความเก่าสุดก่อน ทีละไม่เกิน SUMMARY_MAX_FOLD และเหลือข้อความล่าสุดไว้เป็นประวัติดิบ"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import conversation_summary as cs
+
+USER = "u1"
+
+
+class FakeLLM:
+    """แทน ai_brain.post_messages — จำ transcript ที่ถูกส่งมา แล้วตอบ summary = ข้อความแรก..สุดท้ายของรอบนั้น"""
+
+    def __init__(self, status: int = 200):
+        self.status = status
+        self.transcripts: list[list[str]] = []
+
+    async def __call__(self, payload: dict) -> httpx.Response:
+        content = payload["messages"][0]["content"]
+        lines = content.split("บทสนทนาใหม่:\n", 1)[1].splitlines()
+        self.transcripts.append([line.split(": ", 1)[1] for line in lines])
+        if self.status != 200:
+            return httpx.Response(self.status, text="overloaded")
+        return httpx.Response(200, json={
+            "content": [{"type": "text", "text": f"- {lines[0]} .. {lines[-1]}"}],
+            "usage": {"input_tokens": 100, "output_tokens": 20},
+        })
+
+
+@pytest.fixture
+def chat(temp_db, monkeypatch):
+    monkeypatch.setattr(cs, "SUMMARY_TRIGGER_MESSAGES", 6)
+    monkeypatch.setattr(cs, "SUMMARY_KEEP_RECENT", 2)
+    monkeypatch.setattr(cs, "SUMMARY_MAX_FOLD", 40)
+    temp_db.create_user(USER, "ต้น")
+
+    def add(count: int):
+        start = len(temp_db.get_unsummarized_messages(USER, 0, 10 ** 6))
+        for i in range(start + 1, start + count + 1):
+            temp_db.save_message(USER, "user" if i % 2 else "assistant", f"m{i}")
+
+    return temp_db, add
+
+
+def fold(llm) -> int:
+    return asyncio.run(cs.fold_history(USER, "ต้น", post=llm))
+
+
+def test_backlog_folds_oldest_first_in_bounded_batches(chat):
+    db, add = chat
+    add(100)
+    llm = FakeLLM()
+
+    folded = [fold(llm) for _ in range(4)]
+
+    assert folded == [40, 40, 18, 0]
+    assert [(t[0], t[-1]) for t in llm.transcripts] == [("m1", "m40"), ("m41", "m80"), ("m81", "m98")]
+    state = db.get_conversation_summary(USER)
+    assert state["last_message_id"] == 98
+    assert state["folded_messages"] == 98
+    remaining = db.get_unsummarized_messages(USER, state["last_message_id"])
+    assert [m["content"] for m in remaining] == ["m99", "m100"]
+
+
+def test_no_fold_below_trigger(chat):
+    _, add = chat
+    add(cs.SUMMARY_TRIGGER_MESSAGES - 1)
+    llm = FakeLLM()
+
+    assert fold(llm) == 0
+    assert llm.transcripts == []
+
+
+def test_failed_summary_does_not_advance(chat):
+    db, add = chat
+    add(10)
+
+    assert fold(FakeLLM(status=529)) == 0
+    assert db.get_conversation_summary(USER)["last_message_id"] == 0
+
+
+def test_chat_context_without_summary_keeps_raw_window(chat):
+    db, add = chat
+    add(8)
+
+    ctx = db.load_chat_context(USER, "2026-01-01", **cs.history_limits())
+
+    assert ctx.conversation_summary == ""
+    assert [m["content"] for m in ctx.recent_messages] == ["m3", "m4", "m5", "m6", "m7", "m8"]
+
+
+def test_summary_replaces_raw_history(chat):
+    db, add = chat
+    add(10)
+    fold(FakeLLM())
+    add(3)  # ยังไม่ถึงเกณฑ์พับรอบถัดไป
+
+    ctx = db.load_chat_context(USER, "2026-01-01", **cs.history_limits())
+
+    assert ctx.conversation_summary == "- ต้น: m1 .. ฟ้า: m8"
+    assert [m["content"] for m in ctx.recent_messages] == ["m12", "m13"]
+    assert ctx.unsummarized_count == 5
@@ -0,0 +1,47 @@
+"""connection pool — 1 connection ต่อ thread, ใช้ซ้ำใน thread เดิม และถูกปิดเมื่อ thread จบ"""
+
+import gc
+import threading
+
+
+def _query_in_thread(db) -> threading.Thread:
+    def work():
+        with db.get_db() as conn:
+            conn.execute("SELECT 1").fetchone()
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    return thread
+
+
+def test_connection_is_reused_within_a_thread(temp_db):
+    with temp_db.get_db() as first:
+        pass
+    with temp_db.get_db() as second:
+        pass
+
+    assert first is second
+
+
+def test_finished_thread_connection_is_closed_by_finalizer(temp_db):
+    before = temp_db.get_pool_stats()
+
+    thread = _query_in_thread(temp_db)
+    del thread
+    gc.collect()
+
+    stats = temp_db.get_pool_stats()
+    assert stats["connections_opened"] == before["connections_opened"] + 1
+    assert stats["connections_closed"] == before["connections_closed"] + 1
+    assert stats["connections_open"] == before["connections_open"]
+
+
+def test_dead_thread_still_referenced_is_pruned(temp_db):
+    before = temp_db.get_pool_stats()
+
+    threads = [_query_in_thread(temp_db) for _ in range(5)]  # Thread object ยังอยู่ → finalizer ยังไม่ทำงาน
+
+    stats = temp_db.get_pool_stats()
+    assert stats["connections_open"] == before["connections_open"]
+    assert stats["connections_closed"] == before["connections_closed"] + len(threads)
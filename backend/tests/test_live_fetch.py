@@ -0,0 +1,127 @@
+"""single-flight + negative cache ของการดึงราคาสด — request พร้อมกันยิง Yahoo ครั้งเดียว, จำเฉพาะ "Not Found" จริง"""
+
+import threading
+import time
+
+import httpx
+import pytest
+
+import stock_service
+
+WORKERS = 8
+
+
+def _run_concurrently(fn, count: int = WORKERS) -> list:
+    results = [None] * count
+
+    def worker(i: int):
+        results[i] = fn()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def _wait_for(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_concurrent_calls_share_one_load():
+    flight = stock_service._SingleFlight()
+    calls = []
+
+    def load():
+        calls.append(1)
+        _wait_for(lambda: flight.shared == WORKERS - 1)  # ถือ flight ไว้จนทุกคนมารอ
+        return {"price": 34.25}
+
+    results = _run_concurrently(lambda: flight.do("price:PTT.BK", load))
+
+    assert len(calls) == 1
+    assert results == [{"price": 34.25}] * WORKERS
+    assert flight.stats() == {"leaders": 1, "shared": WORKERS - 1, "timeouts": 0, "in_flight": 0}
+
+
+def test_waiters_get_the_leaders_error():
+    flight = stock_service._SingleFlight()
+
+    def load():
+        _wait_for(lambda: flight.shared == WORKERS - 1)
+        raise ValueError("bad chart")
+
+    def call():
+        try:
+            return flight.do("analysis:PTT.BK", load)
+        except ValueError as e:
+            return str(e)
+
+    assert _run_concurrently(call) == ["bad chart"] * WORKERS
+    assert flight.stats()["in_flight"] == 0
+
+
+@pytest.fixture
+def yahoo(monkeypatch):
+    """Yahoo chart ปลอม: NOPE = Not Found (404), BUSY = 429, อื่น ๆ = ราคา 10"""
+    requests: list[str] = []
+    real_client = httpx.Client
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        symbol = request.url.path.rsplit("/", 1)[-1]
+        requests.append(symbol)
+        if symbol == "NOPE":
+            return httpx.Response(404, json={"chart": {"result": None, "error": {
+                "code": "Not Found", "description": "No data found, symbol may be delisted"}}})
+        if symbol == "BUSY":
+            return httpx.Response(429, text="Too Many Requests")
+        meta = {"regularMarketPrice": 10.0, "chartPreviousClose": 9.5, "currency": "USD", "symbol": symbol}
+        return httpx.Response(200, json={"chart": {"result": [{
+            "meta": meta, "timestamp": [1], "indicators": {"quote": [{"close": [10.0], "volume": [100]}]},
+        }], "error": None}})
+
+    monkeypatch.setattr(
+        stock_service.httpx, "Client",
+        lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs),
+    )
+    monkeypatch.setattr(stock_service, "_inflight", stock_service._SingleFlight())
+    monkeypatch.setattr(stock_service, "_missing_symbols", stock_service._TTLCache(1024, 300))
+    monkeypatch.setattr(stock_service, "_quote_cache", stock_service._TTLCache(16, 60))
+    return requests
+
+
+def _price(symbol: str):
+    return stock_service._fetch_live("price", symbol, stock_service.get_stock_price_direct)
+
+
+def test_not_found_is_cached_per_kind(yahoo):
+    hosts = len(stock_service.YAHOO_CHART_HOSTS)
+
+    assert _price("NOPE") is None
+    assert _price("NOPE") is None
+    assert yahoo == ["NOPE"] * hosts  # ครั้งที่ 2 ตอบจาก negative cache
+
+    # analysis ใช้ key แยก → ยังต้องถาม Yahoo เอง
+    assert stock_service._fetch_live("analysis", "NOPE", stock_service.get_stock_price_direct) is None
+    assert yahoo == ["NOPE"] * hosts * 2
+
+    # write-through ของ symbol นี้ล้าง negative cache
+    stock_service.cache_stock_rows([{"symbol": "NOPE", "price": 1.0}])
+    assert stock_service._missing_symbols.get("price:NOPE") is None
+
+
+def test_transient_errors_are_not_cached(yahoo):
+    hosts = len(stock_service.YAHOO_CHART_HOSTS)
+
+    assert _price("BUSY") is None
+    assert _price("BUSY") is None
+    assert yahoo == ["BUSY"] * hosts * 2
+
+
+def test_found_symbol_is_not_negative_cached(yahoo):
+    assert _price("AAPL")["price"] == 10.0
+    assert stock_service._missing_symbols.get("price:AAPL") is None
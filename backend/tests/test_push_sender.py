@@ -0,0 +1,85 @@
+"""send_push_batch — แบ่ง batch ละ FCM_BATCH_SIZE และลบ token ที่ unregistered (transport ปลอม ไม่ต่อ FCM)"""
+
+from types import SimpleNamespace
+
+from firebase_admin import messaging
+
+import push_sender
+
+
+class FakeSendEach:
+    """แทน messaging.send_each — token ที่ขึ้นต้นด้วย 'dead' = unregistered, 'bad' = error อื่น"""
+
+    def __init__(self, fail_batches: set[int] = frozenset()):
+        self.batches: list[list[str]] = []
+        self.fail_batches = fail_batches
+
+    def __call__(self, messages):
+        self.batches.append([m.token for m in messages])
+        if len(self.batches) - 1 in self.fail_batches:
+            raise RuntimeError("FCM unavailable")
+        responses = []
+        for m in messages:
+            if m.token.startswith("dead"):
+                error = messaging.UnregisteredError("unregistered", cause=None, http_response=None)
+                responses.append(SimpleNamespace(success=False, exception=error))
+            elif m.token.startswith("bad"):
+                responses.append(SimpleNamespace(success=False, exception=ValueError("invalid payload")))
+            else:
+                responses.append(SimpleNamespace(success=True, exception=None))
+        return SimpleNamespace(responses=responses)
+
+
+def _register(db, user_id: str, tokens: list[str]):
+    db.create_user(user_id, user_id)
+    for token in tokens:
+        db.save_device_token(user_id, token)
+
+
+def test_chunks_by_fcm_batch_size(temp_db):
+    users = [f"u{i}" for i in range(60)]
+    for user_id in users:
+        _register(temp_db, user_id, [f"{user_id}-t{j}" for j in range(20)])  # 1200 tokens
+    transport = FakeSendEach()
+
+    stats = push_sender.send_push_batch([(u, "title", "body") for u in users], "stock_alert", transport)
+
+    assert [len(b) for b in transport.batches] == [500, 500, 200]
+    assert stats["batches"] == 3
+    assert stats["tokens"] == stats["sent"] == 1200
+    assert stats["failed"] == stats["pruned"] == 0
+
+
+def test_prunes_only_unregistered_tokens(temp_db):
+    _register(temp_db, "alice", ["ok-1", "dead-1", "bad-1"])
+    _register(temp_db, "bob", ["dead-2"])
+
+    stats = push_sender.send_push_batch(
+        [("alice", "t", "b"), ("bob", "t", "b"), ("carol", "t", "b")], transport=FakeSendEach(),
+    )
+
+    assert (stats["sent"], stats["failed"], stats["pruned"]) == (1, 3, 2)
+    assert sorted(temp_db.get_user_fcm_tokens("alice")) == ["bad-1", "ok-1"]
+    assert temp_db.get_user_fcm_tokens("bob") == []
+
+
+def test_failed_batch_does_not_stop_the_rest(temp_db):
+    _register(temp_db, "alice", [f"t{i}" for i in range(push_sender.FCM_BATCH_SIZE + 10)])
+    transport = FakeSendEach(fail_batches={0})
+
+    stats = push_sender.send_push_batch([("alice", "t", "b")], transport=transport)
+
+    assert len(transport.batches) == 2
+    assert stats["failed"] == push_sender.FCM_BATCH_SIZE
+    assert stats["sent"] == 10
+    assert stats["pruned"] == 0
+
+
+def test_same_user_many_notifications_fans_out_per_token(temp_db):
+    _register(temp_db, "alice", ["a1", "a2"])
+    transport = FakeSendEach()
+
+    stats = push_sender.send_push_batch([("alice", "t", "1"), ("alice", "t", "2")], transport=transport)
+
+    assert stats["notifications"] == 2
+    assert sorted(transport.batches[0]) == ["a1", "a1", "a2", "a2"]
@@ -0,0 +1,115 @@
+"""ตาราง refresh ราคาตาม session ตลาด — ตลาดเปิดดึงตามจำนวนคนติดตาม, ปิดแล้วดึงราคาปิดครั้งเดียวแล้ว freeze"""
+
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import market_hours
+import stock_service
+
+BKK = ZoneInfo("Asia/Bangkok")
+NY = ZoneInfo("America/New_York")
+
+WED_MORNING = datetime(2026, 1, 7, 10, 0, tzinfo=BKK)   # SET เปิด (session เช้า)
+WED_EVENING = datetime(2026, 1, 7, 18, 0, tzinfo=BKK)   # SET ปิดแล้ว
+
+
+@pytest.mark.parametrize("now, expected", [
+    (WED_MORNING, True),
+    (datetime(2026, 1, 7, 13, 0, tzinfo=BKK), False),    # พักเที่ยง
+    (datetime(2026, 1, 7, 16, 39, tzinfo=BKK), True),    # closing auction
+    (datetime(2026, 1, 10, 10, 0, tzinfo=BKK), False),   # เสาร์
+])
+def test_set_sessions(now, expected):
+    assert market_hours.is_scheduled_open(market_hours.SET, now) is expected
+
+
+def test_us_session_follows_new_york_dst():
+    # 09:45 นิวยอร์ก = 14:45 UTC ช่วงฤดูหนาว แต่ 13:45 UTC ช่วง DST
+    assert market_hours.is_scheduled_open(market_hours.US, datetime(2026, 1, 7, 9, 45, tzinfo=NY))
+    assert market_hours.is_scheduled_open(market_hours.US, datetime(2026, 7, 1, 9, 45, tzinfo=NY))
+    assert not market_hours.is_scheduled_open(market_hours.US, datetime(2026, 7, 1, 9, 15, tzinfo=NY))
+
+
+def test_last_close_skips_the_weekend():
+    monday_early = datetime(2026, 1, 12, 8, 0, tzinfo=BKK)
+    assert market_hours.last_close(market_hours.SET, monday_early) == datetime(2026, 1, 9, 16, 40, tzinfo=BKK)
+    assert market_hours.last_close(market_hours.ALWAYS_OPEN, monday_early) is None
+
+
+def test_market_of():
+    assert [market_hours.market_of(s) for s in ("PTT.BK", "^SET.BK", "AAPL", "THB=X", "BTC-USD")] == [
+        market_hours.SET, market_hours.SET, market_hours.US, market_hours.ALWAYS_OPEN, market_hours.ALWAYS_OPEN,
+    ]
+
+
+@pytest.fixture
+def schedule(monkeypatch):
+    """_last_refreshed / _market_observed ว่างต่อ test — refreshed_ago(now, {symbol: วินาทีที่แล้ว}) ตั้งเวลาที่ refresh ล่าสุด"""
+    refreshed: dict[str, float] = {}
+    monkeypatch.setattr(stock_service, "_last_refreshed", refreshed)
+    monkeypatch.setattr(stock_service, "_market_observed", {})
+
+    def due(symbols, watchers, now):
+        return stock_service._due_symbols(symbols, watchers, now)
+
+    def refreshed_ago(now: datetime, ages: dict[str, float]):
+        for symbol, age in ages.items():
+            refreshed[symbol] = now.timestamp() - age
+
+    return due, refreshed_ago
+
+
+def test_open_market_refreshes_hot_symbols_more_often(schedule):
+    due, refreshed_ago = schedule
+    symbols = ["PTT.BK", "KBANK.BK", "AOT.BK"]
+    watchers = {"PTT.BK": stock_service.HOT_SYMBOL_WATCHERS, "KBANK.BK": 1, "AOT.BK": 2}
+    refreshed_ago(WED_MORNING, {
+        "PTT.BK": stock_service.STOCK_HOT_INTERVAL, "KBANK.BK": 90, "AOT.BK": stock_service.STOCK_OPEN_INTERVAL,
+    })
+
+    # PTT (hot) ถึงรอบ 1 นาที, AOT ถึงรอบ 5 นาที, KBANK เพิ่งดึงไป 90 วิ
+    assert due(symbols, watchers, WED_MORNING) == (["PTT.BK", "AOT.BK"], 0)
+
+
+def test_never_refreshed_symbols_come_first_by_watchers(schedule):
+    due, _ = schedule
+    symbols = ["A.BK", "B.BK", "C.BK"]
+
+    assert due(symbols, {"B.BK": 5, "C.BK": 2}, WED_MORNING) == (["B.BK", "C.BK", "A.BK"], 0)
+
+
+def test_closed_market_fetches_the_close_once_then_freezes(schedule):
+    due, refreshed_ago = schedule
+    # ดึงล่าสุดตอน 15:00 (ก่อนปิด 16:40) → ยังไม่มีราคาปิด
+    refreshed_ago(WED_EVENING, {"PTT.BK": 3 * 3600})
+    assert due(["PTT.BK"], {}, WED_EVENING) == (["PTT.BK"], 0)
+
+    refreshed_ago(WED_EVENING, {"PTT.BK": 60})  # ได้ราคาปิดแล้ว
+    later = datetime(2026, 1, 7, 23, 0, tzinfo=BKK)
+    assert due(["PTT.BK"], {}, later) == ([], 1)
+
+
+def test_holiday_probes_only_the_most_watched_symbol(schedule):
+    due, refreshed_ago = schedule
+    # ตามตารางเปิด แต่ Yahoo บอก CLOSED ตั้งแต่ต้น session (วันหยุด)
+    stock_service._market_observed[market_hours.SET] = ("CLOSED", WED_MORNING.timestamp() - 60)
+    symbols = ["PTT.BK", "KBANK.BK", "AOT.BK"]
+    watchers = {"PTT.BK": 1, "KBANK.BK": 4, "AOT.BK": 2}
+    recent = stock_service.STOCK_CLOSED_PROBE - 60
+    refreshed_ago(WED_MORNING, {"PTT.BK": recent, "KBANK.BK": recent, "AOT.BK": recent})
+
+    assert due(symbols, watchers, WED_MORNING) == ([], 3)  # ยังไม่ถึงรอบ probe
+
+    refreshed_ago(WED_MORNING, {"KBANK.BK": stock_service.STOCK_CLOSED_PROBE})
+    assert due(symbols, watchers, WED_MORNING) == (["KBANK.BK"], 2)
+
+
+def test_always_open_and_per_tick_cap(schedule, monkeypatch):
+    due, _ = schedule
+    monkeypatch.setattr(stock_service, "STOCK_REFRESH_MAX_PER_TICK", 2)
+    saturday = datetime(2026, 1, 10, 10, 0, tzinfo=BKK)
+    symbols = ["BTC-USD", "THB=X", "GC=F"]
+
+    assert due(symbols, {"GC=F": 3, "THB=X": 1}, saturday) == (["GC=F", "THB=X"], 0)
@@ -0,0 +1,115 @@
+"""stock alert engine — threshold index ต้องให้ผลเท่าเช็คทีละ alert และโหลด watchlist ใหม่เฉพาะตอน fingerprint เปลี่ยน"""
+
+import asyncio
+import random
+
+import pytest
+
+import stock_service
+
+KINDS = ("price_above", "price_below", "change_pct")
+
+
+def _alert(alert_id: int, symbol: str, kind: str, target: float, user_id: str = "u1") -> dict:
+    return {
+        "id": alert_id, "user_id": user_id, "symbol": symbol, "display_name": symbol,
+        "alert_type": kind, "target_value": target, "last_notified_at": None,
+    }
+
+
+def test_crossed_matches_per_alert_evaluation():
+    rng = random.Random(7)
+    alerts = [
+        _alert(i, rng.choice(["PTT", "KBANK", "AAPL"]), rng.choice(KINDS), round(rng.uniform(0, 10), 1))
+        for i in range(1, 301)
+    ]
+    index = stock_service._AlertIndex(alerts)
+
+    for _ in range(200):
+        symbol = rng.choice(["PTT", "KBANK", "AAPL", "UNWATCHED"])
+        # ราคาบางรอบเท่ากับ target พอดี — ขอบของ bisect
+        price = rng.choice([round(rng.uniform(0, 10), 1), rng.choice(alerts)["target_value"]])
+        change_pct = round(rng.uniform(-10, 10), 1)
+        price_data = {"price": price, "change_pct": change_pct}
+
+        expected = {
+            a["id"] for a in alerts
+            if a["symbol"] == symbol and stock_service._evaluate_stock_alert(a, price_data)
+        }
+        assert set(index.crossed(symbol, price, change_pct)) == expected
+
+
+def test_watchers_count_distinct_users():
+    index = stock_service._AlertIndex([
+        _alert(1, "PTT", "price_above", 40, "u1"),
+        _alert(2, "PTT", "price_below", 30, "u1"),
+        _alert(3, "PTT", "change_pct", 3, "u2"),
+        _alert(4, "AAPL", "change_pct", 3, "u2"),
+    ])
+
+    assert index.symbols == ["AAPL", "PTT"]
+    assert index.watchers == {"PTT": 2, "AAPL": 1}
+
+
+@pytest.fixture
+def watchlist(temp_db, monkeypatch):
+    monkeypatch.setattr(stock_service, "_alert_index", stock_service._AlertIndex())
+    temp_db.create_user("u1", "ต้น")
+    return temp_db
+
+
+def _load() -> stock_service._AlertIndex:
+    return asyncio.run(stock_service.load_alert_index())
+
+
+def test_index_reloads_only_when_watchlist_changes(watchlist):
+    first_id = watchlist.add_stock_alert("u1", "PTT", "PTT", "price_above", 35)
+    first = _load()
+    assert list(first.alerts) == [first_id]
+    assert _load() is first  # ไม่มีอะไรเปลี่ยน → ใช้ index เดิม
+
+    second_id = watchlist.add_stock_alert("u1", "KBANK", "KBANK", "price_below", 120)
+    added = _load()
+    assert added is not first
+    assert sorted(added.alerts) == [first_id, second_id]
+
+    watchlist.delete_stock_alert(first_id)
+    deleted = _load()
+    assert list(deleted.alerts) == [second_id]
+
+    # ลบ 1 + เพิ่ม 1 → จำนวนเท่าเดิม แต่ id ล่าสุดเปลี่ยน
+    watchlist.delete_stock_alert(second_id)
+    third_id = watchlist.add_stock_alert("u1", "AAPL", "AAPL", "change_pct", 3)
+    swapped = _load()
+    assert list(swapped.alerts) == [third_id]
+
+    # แจ้งเตือน/อัพเดทราคาไม่เปลี่ยน watchlist → ไม่ต้องโหลดใหม่
+    watchlist.update_stock_alert_state([("AAPL", 190.0)], [third_id])
+    assert _load() is swapped
+
+
+def test_check_alerts_batches_pushes_and_respects_cooldown(watchlist, monkeypatch):
+    above = watchlist.add_stock_alert("u1", "PTT", "PTT", "price_above", 35)
+    watchlist.add_stock_alert("u1", "PTT", "PTT", "price_below", 30)
+    pushes = []
+    monkeypatch.setattr(
+        stock_service.push_sender, "send_push_batch",
+        lambda notifications, notification_type: pushes.append(list(notifications)) or {"sent": len(notifications)},
+    )
+    prices = {"PTT": {"price": 36.0, "change_pct": 1.0, "currency": "THB"}}
+
+    index = _load()
+    triggered, stats = asyncio.run(stock_service.check_stock_alerts(index, prices))
+
+    assert triggered == 1
+    assert stats == {"sent": 1}
+    assert [user for user, _, _ in pushes[0]] == ["u1"]
+    rows = {a["id"]: a for a in watchlist.get_all_active_stock_alerts()}
+    assert rows[above]["last_notified_at"] is not None
+    assert {a["last_price"] for a in rows.values()} == {36.0}
+
+    # รอบถัดไปภายใน cooldown → ไม่แจ้งซ้ำ (index จำ last_notified_at เอง ไม่ต้องโหลดใหม่)
+    assert _load() is index
+    triggered, _ = asyncio.run(stock_service.check_stock_alerts(index, prices))
+    assert triggered == 0
+    assert len(pushes) == 1
@@ -0,0 +1,75 @@
+"""get_stock_prices — batch quote ทีละ QUOTE_BATCH_SIZE, symbol ที่ batch ไม่ได้ fallback ทีละตัว (Yahoo ปลอม)"""
+
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import stock_service
+
+
+def _quote(symbol: str, price: float) -> dict:
+    return {
+        "symbol": symbol, "regularMarketPrice": price, "regularMarketPreviousClose": price - 1,
+        "shortName": symbol, "marketState": "REGULAR",
+    }
+
+
+@pytest.fixture
+def yahoo(monkeypatch):
+    """quote endpoint ปลอม — status/ตัวที่ไม่ตอบตั้งได้ — และ fallback ทีละ symbol ที่จดไว้ว่าถูกเรียก"""
+    state = SimpleNamespace(requests=[], status=200, omit=set(), fallback=[])
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        symbols = request.url.params["symbols"].split(",")
+        state.requests.append(symbols)
+        if state.status != 200:
+            return httpx.Response(state.status)
+        result = [_quote(s, 10.0) for s in symbols if s not in state.omit]
+        return httpx.Response(200, json={"quoteResponse": {"result": result}})
+
+    def fallback(symbol: str):
+        state.fallback.append(symbol)
+        return {"symbol": symbol, "price": 1.0}
+
+    real_client = httpx.Client
+    monkeypatch.setattr(
+        stock_service, "httpx",
+        SimpleNamespace(Client=lambda **kw: real_client(transport=httpx.MockTransport(handler), **kw)),
+    )
+    monkeypatch.setattr(stock_service, "get_stock_price", fallback)
+    monkeypatch.setattr(stock_service, "_quote_batch_disabled_until", 0.0)
+    return state
+
+
+def test_batches_by_quote_batch_size(yahoo):
+    symbols = [f"S{i}.BK" for i in range(stock_service.QUOTE_BATCH_SIZE * 2 + 5)]
+
+    prices = stock_service.get_stock_prices(symbols + symbols[:3])  # ซ้ำได้ ดึงครั้งเดียว
+
+    assert [len(r) for r in yahoo.requests] == [50, 50, 5]
+    assert set(prices) == set(symbols)
+    assert prices["S0.BK"]["change"] == 1.0
+    assert yahoo.fallback == []
+
+
+def test_symbols_missing_from_batch_fall_back_individually(yahoo):
+    yahoo.omit = {"PTT.BK"}
+
+    prices = stock_service.get_stock_prices(["PTT.BK", "AAPL"])
+
+    assert yahoo.fallback == ["PTT.BK"]
+    assert prices["PTT.BK"]["price"] == 1.0
+    assert prices["AAPL"]["price"] == 10.0
+
+
+def test_unavailable_endpoint_disables_batch_for_cooldown(yahoo):
+    yahoo.status = 401
+
+    first = stock_service.get_stock_prices(["PTT.BK", "AAPL"])
+    second = stock_service.get_stock_prices(["KBANK.BK"])
+
+    assert len(yahoo.requests) == 1  # รอบที่สองไม่ยิง batch ซ้ำระหว่าง cooldown
+    assert set(first) == {"PTT.BK", "AAPL"}
+    assert sorted(yahoo.fallback) == ["AAPL", "KBANK.BK", "PTT.BK"]
+    assert set(second) == {"KBANK.BK"}
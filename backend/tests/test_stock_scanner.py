@@ -0,0 +1,50 @@
+"""StockScanner ต้องให้ผลเท่าวิธีเดิม (substring keyword + วนทุก symbol) — รวมกรณี ticker ที่ขึ้นต้นด้วย keyword"""
+
+import pytest
+
+import benchmark
+import stock_service
+
+MESSAGES = benchmark.SCANNER_MESSAGES + (
+    "SMA50 ของ PTT อยู่ตรงไหน",
+    "ขอราคา SETHI กับ RSI ของ ADVANC",
+    "ไม่มีอะไร แค่อยากคุยด้วย",
+    "AOT aot Aot ตัวไหนก็ตัวเดียวกัน",
+)
+
+
+@pytest.fixture(scope="module")
+def scanner():
+    return stock_service.StockScanner(
+        stock_service.STOCK_KEYWORDS, stock_service.THAI_STOCK_HINTS, stock_service.COMMON_WORDS,
+    )
+
+
+def test_matches_legacy_scan(scanner):
+    mismatches = benchmark.scanner_mismatches(
+        scanner, set(stock_service.THAI_STOCK_HINTS), stock_service.STOCK_KEYWORDS,
+        stock_service.COMMON_WORDS, MESSAGES,
+    )
+    assert mismatches == []
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("SMAR กับ SETI ตัวไหนน่าสนใจ", {"SMAR", "SETI"}),
+    ("RSIX และ SMALL ขึ้นแรงมาก", {"RSIX", "SMALL"}),
+])
+def test_keywords_do_not_eat_ticker_prefixes(scanner, message, expected):
+    _, symbols = scanner.scan(message)
+    assert expected <= set(symbols)
+
+
+def test_keyword_and_symbol_in_same_word(scanner):
+    keywords, symbols = scanner.scan("set กับ ptt วันนี้เป็นยังไง")
+    assert keywords
+    assert "PTT" in symbols
+
+
+def test_thai_symbols_come_first_without_duplicates(scanner):
+    _, symbols = scanner.scan("NVDA กับ PTT และ ptt อีกที")
+    assert symbols[0] == "PTT"
+    assert symbols.count("PTT") == 1
+    assert "NVDA" in symbols
@@ -0,0 +1,103 @@
+"""
+token_budget.py — คุมขนาด input ของ Claude ให้อยู่ในงบ (PROMPT_INPUT_TOKEN_BUDGET)
+prompt ถูกแบ่งเป็น section (กฎ, memory, สถานการณ์, หุ้น, ประวัติแชท, ข้อความล่าสุด)
+แต่ละ section มี priority — เกินงบเมื่อไหร่ ตัด section ที่ priority สูงสุด (สำคัญน้อยสุด) ก่อน
+ทีละหน่วย (บรรทัด / ข้อความในประวัติ) จนพอดีงบหรือเหลือขั้นต่ำของ section นั้น
+
+priority 0 = ห้ามตัด (กฎ + format คำตอบ, เวลาปัจจุบัน, ข้อความของผู้ใช้)
+
+นับ token แบบประมาณใน process (ไม่มี tokenizer ของ Claude ให้ใช้ offline):
+  อักษรไทย ~1.5 ตัว/token, อังกฤษ/ตัวเลข ~4 ตัว/token, สัญลักษณ์/emoji ~1 token/ตัว
+ค่าจริงดูได้จาก usage ใน log ของ call_haiku — ปรับอัตราผ่าน env ถ้าคลาดมาก
+"""
+
+import math
+import os
+import re
+from dataclasses import dataclass, field
+
+PROMPT_INPUT_TOKEN_BUDGET = int(os.getenv("PROMPT_INPUT_TOKEN_BUDGET", "4000"))
+
+THAI_CHARS_PER_TOKEN = float(os.getenv("TOKEN_EST_THAI_CHARS_PER_TOKEN", "1.5"))
+LATIN_CHARS_PER_TOKEN = float(os.getenv("TOKEN_EST_LATIN_CHARS_PER_TOKEN", "4"))
+MESSAGE_OVERHEAD = 4  # role + ตัวคั่นของแต่ละ message
+
+_THAI_RE = re.compile(r"[\u0e00-\u0e7f]")
+_LATIN_RE = re.compile(r"[A-Za-z0-9]")
+_SPACE_RE = re.compile(r"\s")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    thai = len(_THAI_RE.findall(text))
+    latin = len(_LATIN_RE.findall(text))
+    other = len(text) - thai - latin - len(_SPACE_RE.findall(text))
+    return math.ceil(thai / THAI_CHARS_PER_TOKEN + latin / LATIN_CHARS_PER_TOKEN + other)
+
+
+@dataclass
+class Section:
+    """
+    ส่วนหนึ่งของ prompt — units คือหน่วยที่ตัดทิ้งได้ (บรรทัด หรือ message dict)
+    keep="head" ตัดจากท้าย (ข้อมูลสำคัญอยู่ต้น), keep="tail" ตัดจากหัว (เก็บของล่าสุด เช่นประวัติแชท)
+    """
+    name: str
+    units: list
+    costs: list[int]
+    priority: int = 0
+    keep: str = "head"
+    min_units: int = 0
+    dropped: int = field(default=0, init=False)
+
+    @classmethod
+    def of_text(cls, name: str, text: str, priority: int = 0, min_units: int = 0) -> "Section":
+        lines = text.split("\n") if text else []
+        return cls(name, lines, [estimate_tokens(line) + 1 for line in lines], priority, "head", min_units)
+
+    @classmethod
+    def of_messages(cls, name: str, messages: list[dict], priority: int = 0, min_units: int = 0) -> "Section":
+        costs = [estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages]
+        return cls(name, list(messages), costs, priority, "tail", min_units)
+
+    @property
+    def tokens(self) -> int:
+        return sum(self.costs)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.units)
+
+    def drop_one(self) -> int:
+        """ตัด 1 หน่วยตาม keep → คืนจำนวน token ที่ลดลง"""
+        index = -1 if self.keep == "head" else 0
+        self.units.pop(index)
+        self.dropped += 1
+        return self.costs.pop(index)
+
+
+def fit(sections: list[Section], budget: int = PROMPT_INPUT_TOKEN_BUDGET) -> dict:
+    """
+    ตัด sections (แก้ใน object) ให้รวมแล้วไม่เกิน budget
+    Returns report: budget, used, over (ยังเกินแม้ตัดถึงขั้นต่ำ), tokens ต่อ section, หน่วยที่ถูกตัด
+    """
+    used = sum(s.tokens for s in sections)
+    for section in sorted((s for s in sections if s.priority > 0), key=lambda s: -s.priority):
+        while used > budget and len(section.units) > section.min_units:
+            used -= section.drop_one()
+        if used <= budget:
+            break
+    return {
+        "budget": budget,
+        "used": used,
+        "over": used > budget,
+        "sections": {s.name: s.tokens for s in sections},
+        "dropped": {s.name: s.dropped for s in sections if s.dropped},
+    }
+
+
+def format_report(report: dict) -> str:
+    sizes = " ".join(f"{name}={tokens}" for name, tokens in report["sections"].items())
+    dropped = ", ".join(f"{name}-{n}" for name, n in report["dropped"].items())
+    flags = (f" trimmed[{dropped}]" if dropped else "") + (" OVER" if report["over"] else "")
+    return f"[PromptBudget] {report['used']}/{report['budget']} est. tokens: {sizes}{flags}"